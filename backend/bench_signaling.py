@@ -0,0 +1,97 @@
+# bench_signaling.py - 信令热路径微基准：大 SDP offer 的中转与房间广播
+# 用法: python bench_signaling.py [--sdp-kb 8] [--rounds 20000]
+import argparse
+import asyncio
+import json
+import time
+
+import fastjson
+from websocket_server import ConnectionManager
+
+
+class NullWebSocket:
+    """只记录发送字节数的假连接"""
+
+    def __init__(self):
+        self.sent = 0
+
+    async def send_text(self, data: str):
+        self.sent += len(data)
+
+
+def make_sdp(size_kb: int) -> str:
+    lines = ["v=0", "o=- 4611731400430051336 2 IN IP4 127.0.0.1", "s=-", "t=0 0"]
+    i = 0
+    while sum(len(line) + 2 for line in lines) < size_kb * 1024:
+        lines.append(f"a=candidate:{i} 1 udp 2122260223 192.168.1.{i % 255} {50000 + i} typ host generation 0")
+        lines.append(f"a=rtpmap:{96 + i % 32} VP8/90000")
+        i += 1
+    return "\r\n".join(lines) + "\r\n"
+
+
+def build_manager(room_size: int) -> ConnectionManager:
+    manager = ConnectionManager()
+    manager.rooms["r"] = {"users": [], "created_at": None}
+    for n in range(room_size):
+        user_id = f"u{n}"
+        manager.active_connections[user_id] = NullWebSocket()
+        manager.rooms["r"]["users"].append(user_id)
+        manager.user_rooms[user_id] = "r"
+    return manager
+
+
+async def relay_decode(manager: ConnectionManager, data: str):
+    """旧路径：stdlib 完整解析，再为接收者重新编码"""
+    message = json.loads(data)
+    target = manager.get_room_other_user("r", "u0")
+    await manager.active_connections[target].send_text(json.dumps({
+        "type": "offer",
+        "from": "u0",
+        "offer": message.get("offer")
+    }))
+
+
+async def relay_passthrough(manager: ConnectionManager, data: str):
+    """新路径：只读 type，原始帧末尾拼接 from 后转发"""
+    if fastjson.peek_type(data) in fastjson.RELAY_TYPES:
+        target = manager.get_room_other_user("r", "u0")
+        await manager.send_raw(fastjson.append_field(data, "from", "u0"), target)
+
+
+async def broadcast_per_recipient(manager: ConnectionManager, message: dict):
+    """旧路径：每个接收者各自 json.dumps 一次"""
+    for user_id in manager.rooms["r"]["users"]:
+        await manager.active_connections[user_id].send_text(json.dumps(message))
+
+
+async def run_case(name: str, fn, rounds: int, *args):
+    start = time.perf_counter()
+    for _ in range(rounds):
+        await fn(*args)
+    elapsed = time.perf_counter() - start
+    print(f"{name:<32} {elapsed / rounds * 1e6:10.2f} µs/op")
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sdp-kb", type=int, default=8)
+    parser.add_argument("--rounds", type=int, default=20000)
+    parser.add_argument("--room-size", type=int, default=8)
+    args = parser.parse_args()
+
+    sdp = make_sdp(args.sdp_kb)
+    frame = json.dumps({"type": "offer", "offer": {"type": "offer", "sdp": sdp}})
+    print(f"SDP {len(sdp)} 字节, 帧 {len(frame)} 字节, 编码器: {fastjson.CODEC}")
+
+    pair = build_manager(2)
+    await run_case("relay offer (json decode)", relay_decode, args.rounds, pair, frame)
+    await run_case("relay offer (passthrough)", relay_passthrough, args.rounds, pair, frame)
+
+    room = build_manager(args.room_size)
+    message = {"type": "offer", "from": "u0", "offer": {"type": "offer", "sdp": sdp}}
+    await run_case(f"broadcast x{args.room_size} (per recipient)", broadcast_per_recipient, args.rounds // 10, room, message)
+    await run_case(f"broadcast x{args.room_size} (serialize once)", room.broadcast_to_room, args.rounds // 10, message, "r")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
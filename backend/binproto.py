@@ -0,0 +1,137 @@
+# binproto.py - 二进制信令协议（MessagePack），通过 WebSocket 子协议协商
+#
+# 帧格式: msgpack 数组 [type_code, body] 或 [type_code, body, from]
+#   - type_code: MESSAGE_CODES 中的整数；0 表示未登记的类型，此时 body 里保留 "type"
+#   - body: 除 type / from 以外的字段
+#   - offer / answer 中的 sdp 可以是 zlib 压缩后的 bin，解码时自动还原为字符串
+# 服务器转发时只把数组头从 0x92 改成 0x93 并在末尾追加 from，不解包 body。
+import os
+import zlib
+from typing import Optional
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+SUBPROTOCOL = "silver.signal.v1+msgpack"
+
+# 超过这个长度的 SDP 在发给二进制客户端时压缩
+SDP_COMPRESS_MIN = int(os.getenv("SDP_COMPRESS_MIN", "1024"))
+# 解压后 SDP 的上限；压缩比可达上千倍，不设上限时一个几百 KB 的帧就能解出几百 MB
+MAX_SDP_BYTES = int(os.getenv("MAX_SDP_BYTES", str(256 * 1024)))
+
+MESSAGE_CODES = {
+    "join-room": 1,
+    "room-joined": 2,
+    "offer": 3,
+    "answer": 4,
+    "ice-candidate": 5,
+    "leave-room": 6,
+    "user-joined": 7,
+    "user-left": 8,
+    "error": 9,
+    "room-reset": 10,
+    "rooms-reset": 11,
+    "ping": 12,
+    "pong": 13,
+    "match-request": 14,
+    "match-cancel": 15,
+    "match-queued": 16,
+    "match-found": 17,
+    "match-timeout": 18,
+    "rate-limited": 19,
+    "emotion-update": 20,
+}
+CODE_TYPES = {code: name for name, code in MESSAGE_CODES.items()}
+
+# 携带 SDP 的消息类型及其字段名
+SDP_FIELDS = {"offer": "offer", "answer": "answer"}
+
+_FIXARRAY_2 = 0x92
+_FIXARRAY_3 = 0x93
+
+
+def negotiate(subprotocols) -> Optional[str]:
+    """客户端请求了二进制子协议且服务器装有 msgpack 时才启用"""
+    if msgpack is not None and SUBPROTOCOL in subprotocols:
+        return SUBPROTOCOL
+    return None
+
+
+def peek_type(data: bytes) -> Optional[str]:
+    """只看前两个字节读出消息类型"""
+    if len(data) >= 2 and data[0] in (_FIXARRAY_2, _FIXARRAY_3) and data[1] < 0x80:
+        return CODE_TYPES.get(data[1])
+    return None
+
+
+def append_from(data: bytes, user_id: str) -> Optional[bytes]:
+    """给客户端原始帧追加 from；客户端自带 from 的帧返回 None，交给完整解码路径"""
+    if not data or data[0] != _FIXARRAY_2:
+        return None
+    return bytes((_FIXARRAY_3,)) + data[1:] + msgpack.packb(user_id)
+
+
+def _compress_sdp(body: dict, field: str):
+    desc = body.get(field)
+    if isinstance(desc, dict) and isinstance(desc.get("sdp"), str) and len(desc["sdp"]) >= SDP_COMPRESS_MIN:
+        body[field] = {**desc, "sdp": zlib.compress(desc["sdp"].encode(), 6)}
+
+
+def _check_keys(value):
+    """msgpack 的 map 键可以是 bytes；之后按 JSON 转发或打日志时会出错，解码时就拒绝"""
+    if isinstance(value, dict):
+        for key, item in value.items():
+            if not isinstance(key, str):
+                raise ValueError("二进制信令帧的键必须是字符串")
+            _check_keys(item)
+    elif isinstance(value, list):
+        for item in value:
+            _check_keys(item)
+
+
+def _decompress_sdp(body: dict, field: str):
+    desc = body.get(field)
+    if isinstance(desc, dict) and isinstance(desc.get("sdp"), bytes):
+        inflater = zlib.decompressobj()
+        try:
+            sdp = inflater.decompress(desc["sdp"], MAX_SDP_BYTES)
+        except zlib.error as e:
+            raise ValueError(f"SDP 解压失败: {e}")
+        if inflater.unconsumed_tail:
+            raise ValueError(f"SDP 解压后超过 {MAX_SDP_BYTES} 字节")
+        body[field] = {**desc, "sdp": sdp.decode()}
+
+
+def encode(message: dict) -> bytes:
+    body = dict(message)
+    message_type = body.pop("type", None)
+    sender = body.pop("from", None)
+    code = MESSAGE_CODES.get(message_type, 0)
+    if code == 0:
+        body["type"] = message_type
+    field = SDP_FIELDS.get(message_type)
+    if field:
+        _compress_sdp(body, field)
+    frame = [code, body] if sender is None else [code, body, sender]
+    return msgpack.packb(frame)
+
+
+def decode(data: bytes) -> dict:
+    frame = msgpack.unpackb(data)
+    if (not isinstance(frame, list) or len(frame) not in (2, 3) or not isinstance(frame[0], int)
+            or not isinstance(frame[1], dict) or (len(frame) == 3 and not isinstance(frame[2], str))):
+        raise ValueError("无效的二进制信令帧")
+    body = frame[1]
+    _check_keys(body)
+    message_type = CODE_TYPES.get(frame[0]) or body.get("type")
+    if message_type is not None and not isinstance(message_type, str):
+        raise ValueError("二进制信令帧的消息类型必须是字符串")
+    field = SDP_FIELDS.get(message_type)
+    if field:
+        _decompress_sdp(body, field)
+    message = {"type": message_type, **body}
+    if len(frame) == 3:
+        message["from"] = frame[2]
+    return message
@@ -0,0 +1,46 @@
+# budget.py - 按 key 的令牌桶，用于限制单个用户 / 单个房间的消息速率
+import time
+from typing import Callable, Dict, Hashable, List
+
+
+class TokenBuckets:
+    """每个 key 一个令牌桶：每秒补充 rate 个，最多积攒 burst 个
+
+    桶在第一次使用时创建，调用方在用户断开 / 房间删除时 discard，数量不会无限增长。
+    """
+
+    def __init__(self, rate: float, burst: float, clock: Callable[[], float] = time.monotonic):
+        self.rate = rate
+        self.burst = burst
+        self.clock = clock
+        # key -> [剩余令牌, 上次补充时间, 是否已经通知过超限]
+        self.buckets: Dict[Hashable, List] = {}
+
+    def allow(self, key: Hashable) -> bool:
+        if self.rate <= 0:
+            return True
+        now = self.clock()
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets[key] = [self.burst, now, False]
+        bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+        bucket[1] = now
+        if bucket[0] < 1:
+            return False
+        bucket[0] -= 1
+        bucket[2] = False
+        return True
+
+    def first_rejection(self, key: Hashable) -> bool:
+        """连续超限时只在第一次返回 True，避免每条被丢弃的消息都回一个错误"""
+        bucket = self.buckets.get(key)
+        if bucket is None or bucket[2]:
+            return False
+        bucket[2] = True
+        return True
+
+    def discard(self, key: Hashable):
+        self.buckets.pop(key, None)
+
+    def __len__(self):
+        return len(self.buckets)
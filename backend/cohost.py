@@ -0,0 +1,95 @@
+# cohost.py - 信令服务器和情绪识别服务合并部署
+#
+# 信令（websocket_server.app）照常跑在事件循环上；/fuse-emotion 的推理交给 inference_pool 里的
+# 独立进程，模型不加载进信令进程，推理跑满 CPU 也不会拖慢 SDP / ICE 中转。
+# 推理在途请求达到 INFERENCE_QUEUE 时直接返回 503，客户端稍后重试。
+#
+# 用法: python cohost.py
+#   或: uvicorn cohost:create_app --factory --host 0.0.0.0 --port 8000 --ws-max-size 262144
+#
+# 顶层只做轻量导入：spawn 出来的推理进程会重新导入本模块。
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def create_app():
+    from fastapi import Request
+    from fastapi.responses import JSONResponse
+    from starlette.datastructures import UploadFile
+
+    import websocket_server
+    from emotion_api.image_modes import select_mode
+    from emotion_api.service import EmotionService
+    from inference_pool import InferencePool, QueueFull
+
+    app = websocket_server.app
+    # 复用 websocket_server 的录制器，但轨迹要用 cohost 回放（只有它有 /fuse-emotion）；头在第一个事件时才写出
+    websocket_server.trace.source = "cohost"
+    pool = InferencePool()
+    # 采样间隔、时间线和 /timeline 接口与 emotion_api/main.py 共用
+    service = EmotionService()
+    cadence = service.cadence
+
+    def queue_full(retry_ms):
+        pool.counts["rejected"] += 1
+        return JSONResponse(status_code=503,
+                            content={"error": "Inference queue is full.", "next_interval_ms": int(retry_ms)},
+                            headers={"Retry-After": str(max(1, round(retry_ms / 1000)))})
+
+    @app.on_event("startup")
+    async def start_inference():
+        await pool.start()
+
+    @app.on_event("shutdown")
+    async def stop_inference():
+        pool.close()
+
+    @app.post("/fuse-emotion")
+    async def fuse_emotion_endpoint(request: Request):
+        """与 emotion_api/main.py 的接口相同，推理在独立进程中执行"""
+        # 队列已满时不读取、不解析上传内容，被拒绝的请求几乎不占事件循环
+        if pool.full:
+            return queue_full(cadence.max_ms * (1 + cadence.load_gain))
+        try:
+            form = await request.form()
+            # 模式在主进程里校验和选择，负载按推理池占用率
+            mode = select_mode(form.get("image_mode"), pool.load)
+            image = form.get("image") or None
+            # 普通表单字段是 str，没有 read()；单独部署的接口由 FastAPI 校验 UploadFile，这里手动校验
+            if image is not None and not isinstance(image, UploadFile):
+                return JSONResponse(status_code=400, content={"error": "Field 'image' must be a file upload."})
+            image_bytes = await image.read() if image else None
+            service.annotate(request, form.get("text"), image_bytes, form.get("user_id"),
+                             form.get("session_id"), form.get("image_mode"))
+            result = await pool.analyze(form.get("text"), image_bytes, mode)
+            service.finish(result, form.get("user_id"), form.get("session_id"), load=pool.load)
+            # 带 user_id 时同进程直接推送给房间里的其他人，不经过 HTTP
+            if form.get("user_id"):
+                websocket_server.manager.publish_emotion(form.get("user_id"), result)
+            return result
+        except QueueFull:
+            return queue_full(cadence.max_ms * (1 + cadence.load_gain))
+        except ValueError as e:
+            return JSONResponse(status_code=400, content={"error": str(e)})
+        except asyncio.TimeoutError:
+            return JSONResponse(status_code=504, content={"error": "Inference timed out."})
+        except Exception as e:
+            logger.error("情绪推理失败: %s", e, extra={"event": "error"})
+            return JSONResponse(status_code=500, content={"error": str(e)})
+
+    app.include_router(service.router)
+
+    @app.get("/api/inference-stats")
+    async def inference_stats():
+        return dict(pool.stats(), timeline=service.timeline.stats())
+
+    return app
+
+
+if __name__ == "__main__":
+    import uvicorn
+    import websocket_server
+    print("🚀 启动信令 + 情绪识别合并服务...")
+    uvicorn.run(create_app(), host="0.0.0.0", port=8000, ws_max_size=websocket_server.MAX_FRAME_BYTES)
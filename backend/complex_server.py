@@ -3,18 +3,37 @@
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel, Field
-import json
+import asyncio
+import os
+import random
 import uuid
-from typing import Dict, Optional
+from typing import Dict, List, Optional, Tuple
 import logging
 
+import fastjson
+from traffic_trace import TraceMiddleware, TraceRecorder
+from expiry import ExpiryWheel
+from logpipe import setup_logging
+from snapshot import StateStore
 
-# 配置日志
-logging.basicConfig(level=logging.INFO)
+
+# 配置日志（队列 + 后台线程写出，见 logpipe.py）
+setup_logging()
 logger = logging.getLogger(__name__)
 
 app = FastAPI(title="WebRTC 信令服务器")
 
+# 过期时间（秒）：等待匹配的房间、无人应答的呼叫、匹配后仍保留的 offer、匹配后的房间
+ROOM_WAITING_TTL = float(os.getenv("ROOM_WAITING_TTL", "300"))
+PENDING_CALL_TTL = float(os.getenv("PENDING_CALL_TTL", "30"))
+OFFER_TTL = float(os.getenv("OFFER_TTL", "120"))
+ROOM_MATCHED_TTL = float(os.getenv("ROOM_MATCHED_TTL", "3600"))
+
+# 重启前后的状态交接：快照文件（未设置则不持久化）、恢复后等待用户重连的时间、重连随机延迟上限（毫秒）
+SNAPSHOT_PATH = os.getenv("SNAPSHOT_PATH")
+RESTORE_GRACE = float(os.getenv("RESTORE_GRACE", "60"))
+DRAIN_JITTER_MS = int(os.getenv("DRAIN_JITTER_MS", "5000"))
+
 # 允许跨域
 app.add_middleware(
     CORSMiddleware,
@@ -24,6 +43,11 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# 流量轨迹录制（TRACE_PATH 开启，见 traffic_trace.py），用 replay_trace.py 回放
+trace = TraceRecorder("complex_server")
+if trace.enabled:
+    app.add_middleware(TraceMiddleware, recorder=trace)
+
 # 数据模型
 class SDPOffer(BaseModel):
     sdp: str
@@ -55,122 +79,208 @@ class ConnectionManager:
         self.rooms: Dict[str, Dict] = {}
         self.users: Dict[str, Dict] = {}
         self.pending_calls: Dict[str, Dict] = {}
+        self.expiry = ExpiryWheel()
+        self.background_tasks = set()
+        # 房间和待接呼叫的快照；从快照恢复、尚未重连的用户 {user_id: room_id}
+        self.state = StateStore(SNAPSHOT_PATH)
+        self.restored: Dict[str, str] = {}
+        self.draining = False
 
     async def connect_user(self, user_id: str, websocket: WebSocket):
         """用户连接"""
-        await
-        websocket.accept()
+        await websocket.accept()
         self.active_connections[user_id] = websocket
-        self.users[user_id] = {"status": "online", "room_id": None}
-        logger.info(f"用户 {user_id} 已连接")
+        if trace.enabled:
+            trace.opened(user_id)
+        # 重启前在房间里的用户重连后直接回到原房间
+        room_id = self.restored.pop(user_id, None)
+        self.users[user_id] = {"status": "busy" if room_id else "online", "room_id": room_id}
+        logger.info("用户 %s 已连接", user_id, extra={"event": "connect"})
         await self.broadcast_user_status(user_id, "online")
 
-    async def disconnect_user(self, user_id: str):
-        if user_id in self.active_connections:
-            del self.active_connections[user_id]
-
-        if user_id in self.users and self.users[user_id].get("room_id"):
-            await self.leave_room(user_id, self.users[user_id]["room_id"])
-
-        if user_id in self.users:
-            del self.users[user_id]
-
-        logger.info(f"用户 {user_id} 已断开连接")
+    async def disconnect_user(self, user_id: str, websocket: Optional[WebSocket] = None, reason: str = "client"):
+        # 连接已被同名用户的新连接替换时，不能把新连接的状态清掉
+        if websocket is not None and self.active_connections.get(user_id) is not websocket:
+            return
+        if user_id not in self.active_connections and user_id not in self.users:
+            return
+        if trace.enabled and user_id in self.active_connections:
+            trace.closed(user_id, "drain" if self.draining else reason)
+        self.active_connections.pop(user_id, None)
+        if self.draining:
+            # 服务即将重启：房间关系留给快照，由新进程恢复
+            self.users.pop(user_id, None)
+            return
+
+        room_id = self.users.get(user_id, {}).get("room_id")
+        if room_id:
+            await self.leave_room(user_id, room_id)
+
+        self.users.pop(user_id, None)
+
+        logger.info("用户 %s 已断开连接", user_id, extra={"event": "disconnect"})
         await self.broadcast_user_status(user_id, "offline")
 
+    def spawn(self, coro):
+        task = asyncio.create_task(coro)
+        self.background_tasks.add(task)
+        task.add_done_callback(self.background_tasks.discard)
+
     async def send_to_user(self, user_id: str, message: dict):
-        if user_id in self.active_connections:
+        return await self.send_raw_to_user(user_id, fastjson.dumps(message))
+
+    async def send_raw_to_user(self, user_id: str, data: str):
+        """发送已编码好的帧，广播时所有接收者复用同一份字符串"""
+        websocket = self.active_connections.get(user_id)
+        if websocket is not None:
             try:
-                await self.active_connections[user_id].send_text(json.dumps(message))
+                await websocket.send_text(data)
                 return True
             except Exception as e:
-                logger.error(f"发送消息给 {user_id} 失败: {e}")
-                await self.disconnect_user(user_id)
+                logger.error("发送消息给 %s 失败: %s", user_id, e, extra={"event": "send_failed"})
+                # 不在发送路径里递归断开（调用方可能正在处理房间），交给后台任务
+                self.spawn(self.disconnect_user(user_id, websocket))
                 return False
         return False
 
+    async def deliver(self, outbox: List[Tuple[str, dict]]):
+        """状态已经提交后再统一发送通知"""
+        for user_id, message in outbox:
+            await self.send_to_user(user_id, message)
+
     async def broadcast_user_status(self, user_id: str, status: str):
         """广播用户状态变化"""
-        message = {
+        data = fastjson.dumps({
             "type": "user_status",
             "user_id": user_id,
             "status": status
-        }
+        })
 
-        for uid, ws in self.active_connections.items():
+        # 发送失败会 disconnect_user，先复制一份连接列表
+        for uid in list(self.active_connections):
             if uid != user_id:
-                await self.send_to_user(uid, message)
+                await self.send_raw_to_user(uid, data)
 
     async def join_room(self, user_id: str, room_id: str, offer: dict):
-        if room_id not in self.rooms:
-            self.rooms[room_id] = {"users": [], "offers": {}, "answers": {}}
+        # 检查和修改房间状态之间没有 await，并发的加入 / 离开不会交错；通知在状态提交后统一发送
+        outbox = []
+        if user_id not in self.users:
+            return {"success": False, "message": "用户未连接"}
+
+        room = self.rooms.get(room_id)
+        if room is not None and room["users"] == [user_id] and user_id not in room["offers"]:
+            # 对方离开时自己的 offer 已过期：重新提交 offer 后继续等待
+            room["offers"][user_id] = offer
+            self.state.mark("room", room_id)
+            self.expiry.schedule(("room", room_id), ROOM_WAITING_TTL)
+            return {"success": True, "matched": False, "waiting": True}
 
-        room = self.rooms[room_id]
+        if room is not None and user_id in room["users"]:
+            return {"success": False, "message": "您已在此房间中"}
 
         # 检查房间是否已满
-        if len(room["users"]) >= 2:
+        if room is not None and len(room["users"]) >= 2:
             return {"success": False, "message": "房间已满"}
 
+        # 房间里等待的用户还没有可用的 offer，新加入者拿不到 peer_offer
+        if room is not None and room["users"] and room["users"][0] not in room["offers"]:
+            return {"success": False, "message": "房间内的用户尚未重新提交 offer，请稍后再试"}
+
+        # 一个用户同一时间只在一个房间里：先离开原来的房间
+        old_room = self.users[user_id]["room_id"]
+        if old_room:
+            self.remove_from_room(user_id, old_room, outbox)
+
+        if room is None:
+            room = self.rooms[room_id] = {"users": [], "offers": {}, "answers": {}}
+
         room["users"].append(user_id)
         room["offers"][user_id] = offer
+        self.state.mark("room", room_id)
         self.users[user_id]["room_id"] = room_id
         self.users[user_id]["status"] = "busy"
 
-        logger.info(f"用户 {user_id} 加入房间 {room_id}")
+        logger.info("用户 %s 加入房间 %s", user_id, room_id, extra={"event": "join"})
 
         if len(room["users"]) == 2:
             user1, user2 = room["users"]
             other_user = user2 if user_id == user1 else user1
-            other_offer = room["offers"][other_user]
+            other_offer = room["offers"].get(other_user)
 
-            await self.send_to_user(user_id, {
+            # 匹配后房间改为 ROOM_MATCHED_TTL 回收，offer 只保留一段时间供对方获取
+            self.expiry.schedule(("room", room_id), ROOM_MATCHED_TTL)
+            self.expiry.schedule(("offer", room_id, user1), OFFER_TTL)
+            self.expiry.schedule(("offer", room_id, user2), OFFER_TTL)
+
+            outbox.append((user_id, {
                 "type": "room_matched",
                 "room_id": room_id,
                 "peer_id": other_user,
                 "peer_offer": other_offer
-            })
-
-            await self.send_to_user(other_user, {
+            }))
+            outbox.append((other_user, {
                 "type": "room_matched",
                 "room_id": room_id,
                 "peer_id": user_id,
                 "peer_offer": offer
-            })
-
-            return {"success": True, "matched": True, "peer_id": other_user}
+            }))
+            result = {"success": True, "matched": True, "peer_id": other_user}
         else:
-            return {"success": True, "matched": False, "waiting": True}
+            self.expiry.schedule(("room", room_id), ROOM_WAITING_TTL)
+            result = {"success": True, "matched": False, "waiting": True}
 
-    async def leave_room(self, user_id: str, room_id: str):
-        if room_id in self.rooms:
-            room = self.rooms[room_id]
-            if user_id in room["users"]:
-                room["users"].remove(user_id)
+        await self.deliver(outbox)
+        return result
 
-                # 通知房间内其他用户
+    async def leave_room(self, user_id: str, room_id: str):
+        outbox = []
+        self.remove_from_room(user_id, room_id, outbox)
+        await self.deliver(outbox)
+
+    def remove_from_room(self, user_id: str, room_id: str, outbox: List[Tuple[str, dict]]):
+        """只改内存状态，要发给房间其他人的通知追加到 outbox"""
+        room = self.rooms.get(room_id)
+        if room is not None and user_id in room["users"]:
+            room["users"].remove(user_id)
+            room["offers"].pop(user_id, None)
+            self.expiry.cancel(("offer", room_id, user_id))
+            self.state.mark("room", room_id)
+
+            # 如果房间为空，删除房间；否则重新进入等待状态
+            if len(room["users"]) == 0:
+                del self.rooms[room_id]
+                self.expiry.cancel(("room", room_id))
+            else:
+                self.expiry.schedule(("room", room_id), ROOM_WAITING_TTL)
+                # 留下的用户的 offer 要一直保留给下一个加入者；已经过期的需要重新 join_room 提交
                 for other_user in room["users"]:
-                    await self.send_to_user(other_user, {
+                    self.expiry.cancel(("offer", room_id, other_user))
+                    outbox.append((other_user, {
                         "type": "peer_left",
                         "user_id": user_id,
-                        "room_id": room_id
-                    })
-
-                # 如果房间为空，删除房间
-                if len(room["users"]) == 0:
-                    del self.rooms[room_id]
+                        "room_id": room_id,
+                        "offer_required": other_user not in room["offers"]
+                    }))
 
-        if user_id in self.users:
-            self.users[user_id]["room_id"] = None
-            self.users[user_id]["status"] = "online"
+        user = self.users.get(user_id)
+        if user is not None and user["room_id"] == room_id:
+            user["room_id"] = None
+            user["status"] = "online"
 
     async def call_user(self, from_user: str, to_user: str, offer: dict):
         """直接呼叫用户"""
-        # 检查目标用户是否在线
+        # 检查目标用户是否在线；检查和状态修改之间没有 await，不会被并发呼叫插队
         if to_user not in self.users or self.users[to_user]["status"] != "online":
             return {"success": False, "message": "用户不在线或忙碌中"}
+        if from_user not in self.users:
+            return {"success": False, "message": "用户未连接"}
 
         call_id = str(uuid.uuid4())
         self.pending_calls[call_id] = {"from": from_user, "to": to_user, "offer": offer}
+        self.expiry.schedule(("call", call_id), PENDING_CALL_TTL)
+        self.state.mark("call", call_id)
+        self.users[from_user]["status"] = "calling"
+        self.users[to_user]["status"] = "receiving_call"
 
         await self.send_to_user(to_user, {
             "type": "incoming_call",
@@ -179,40 +289,135 @@ class ConnectionManager:
             "offer": offer
         })
 
-        self.users[from_user]["status"] = "calling"
-        self.users[to_user]["status"] = "receiving_call"
-
         return {"success": True, "call_id": call_id}
 
     async def answer_call(self, call_id: str, accept: bool, answer: dict = None):
-        if call_id not in self.pending_calls:
+        # 先出队再发送，重复应答只会有一次生效
+        call = self.pending_calls.pop(call_id, None)
+        if call is None:
             return {"success": False, "message": "呼叫不存在"}
 
-        call = self.pending_calls[call_id]
+        self.expiry.cancel(("call", call_id))
+        self.state.mark("call", call_id)
         from_user = call["from"]
         to_user = call["to"]
 
         if accept and answer:
+            self.set_status(from_user, "busy")
+            self.set_status(to_user, "busy")
             await self.send_to_user(from_user, {
                 "type": "call_accepted",
                 "call_id": call_id,
                 "from": to_user,
                 "answer": answer
             })
-            self.users[from_user]["status"] = "busy"
-            self.users[to_user]["status"] = "busy"
         else:
+            self.set_status(from_user, "online")
+            self.set_status(to_user, "online")
             await self.send_to_user(from_user, {
                 "type": "call_rejected",
                 "call_id": call_id,
                 "from": to_user
             })
-            self.users[from_user]["status"] = "online"
-            self.users[to_user]["status"] = "online"
 
-        del self.pending_calls[call_id]
         return {"success": True}
 
+    def set_status(self, user_id: str, status: str):
+        if user_id in self.users:
+            self.users[user_id]["status"] = status
+
+    async def expire(self, key: tuple):
+        """时间轮到期回调：回收无人应答的呼叫、超时未匹配的房间和过期 offer"""
+        kind = key[0]
+        if kind == "call":
+            call = self.pending_calls.pop(key[1], None)
+            if call is None:
+                return
+            self.state.mark("call", key[1])
+            logger.info("呼叫 %s 超时未应答: %s -> %s", key[1], call["from"], call["to"], extra={"event": "expired"})
+            self.set_status(call["from"], "online")
+            self.set_status(call["to"], "online")
+            await self.send_to_user(call["from"], {
+                "type": "call_rejected",
+                "call_id": key[1],
+                "from": call["to"],
+                "reason": "timeout"
+            })
+            await self.send_to_user(call["to"], {
+                "type": "call_cancelled",
+                "call_id": key[1],
+                "from": call["from"],
+                "reason": "timeout"
+            })
+        elif kind == "room":
+            room = self.rooms.get(key[1])
+            if room is None:
+                return
+            logger.info("回收超时%s的房间: %s", "" if len(room["users"]) >= 2 else "未匹配", key[1],
+                        extra={"event": "expired"})
+            for user_id in list(room["users"]):
+                await self.leave_room(user_id, key[1])
+                await self.send_to_user(user_id, {
+                    "type": "room_expired",
+                    "room_id": key[1]
+                })
+        elif kind == "offer":
+            room = self.rooms.get(key[1])
+            if room is not None:
+                room["offers"].pop(key[2], None)
+                self.state.mark("room", key[1])
+        elif kind == "restore":
+            # 恢复后只挂一个定时器，到期时统一清理仍未重连的用户
+            stale, self.restored = self.restored, {}
+            logger.info("%d 个恢复的用户未在 %.0fs 内重连，移出房间", len(stale), RESTORE_GRACE,
+                        extra={"event": "restore_expired"})
+            for user_id, room_id in stale.items():
+                await self.leave_room(user_id, room_id)
+
+    def snapshot_value(self, kind: str, key: str) -> Optional[dict]:
+        if kind == "call":
+            return self.pending_calls.get(key)
+        room = self.rooms.get(key)
+        return None if room is None else {"users": room["users"], "offers": room["offers"]}
+
+    def restore(self) -> Tuple[int, int]:
+        """从快照恢复房间和待接呼叫；定时器重新从头计时"""
+        for room_id, room in self.state.load("room").items():
+            self.rooms[room_id] = {"users": room["users"], "offers": room["offers"], "answers": {}}
+            for user_id in room["users"]:
+                self.restored[user_id] = room_id
+            if len(room["users"]) < 2:
+                self.expiry.schedule(("room", room_id), ROOM_WAITING_TTL)
+            else:
+                self.expiry.schedule(("room", room_id), ROOM_MATCHED_TTL)
+                for user_id in room["offers"]:
+                    self.expiry.schedule(("offer", room_id, user_id), OFFER_TTL)
+        for call_id, call in self.state.load("call").items():
+            self.pending_calls[call_id] = call
+            self.expiry.schedule(("call", call_id), PENDING_CALL_TTL)
+        self.expiry.schedule(("restore", ""), RESTORE_GRACE)
+        return len(self.rooms), len(self.pending_calls)
+
+    async def drain(self) -> int:
+        """通知所有客户端带随机延迟重连，然后关闭连接并写快照；房间和呼叫状态保持不变"""
+        self.draining = True
+        connections = list(self.active_connections.items())
+        for user_id, _ in connections:
+            await self.send_to_user(user_id, {
+                "type": "server-restart",
+                "reconnect_after_ms": random.randint(0, DRAIN_JITTER_MS)
+            })
+        for _, websocket in connections:
+            self.spawn(self.close_quietly(websocket))
+        await self.state.flush(self.snapshot_value)
+        return len(connections)
+
+    async def close_quietly(self, websocket: WebSocket):
+        try:
+            await asyncio.wait_for(websocket.close(code=1012), timeout=5)
+        except Exception:
+            pass
+
     def get_online_users(self, exclude_user: str = None):
         """获取在线用户列表"""
         online_users = []
@@ -227,6 +432,23 @@ class ConnectionManager:
 manager = ConnectionManager()
 
 
+@app.on_event("startup")
+async def start_expiry():
+    if manager.state.enabled:
+        rooms, calls = manager.restore()
+        logger.info("从快照恢复了 %d 个房间、%d 个待接呼叫", rooms, calls, extra={"event": "restore"})
+        app.state.snapshot_task = asyncio.create_task(manager.state.run(manager.snapshot_value))
+    app.state.expiry_task = asyncio.create_task(manager.expiry.run(manager.expire))
+
+
+@app.on_event("shutdown")
+async def save_snapshot():
+    # 未经 /api/drain 直接停止时，连接在此之前已被关闭、房间已清空，保留上一次定期快照
+    if manager.draining:
+        manager.state.flush_sync(manager.snapshot_value)
+    trace.stop()
+
+
 # WebSocket 连接
 @app.websocket("/ws/{user_id}")
 async def websocket_endpoint(websocket: WebSocket, user_id: str):
@@ -234,7 +456,9 @@ async def websocket_endpoint(websocket: WebSocket, user_id: str):
     try:
         while True:
             data = await websocket.receive_text()
-            message = json.loads(data)
+            if trace.enabled:
+                trace.message(user_id, data, fastjson.loads)
+            message = fastjson.loads(data)
 
             if message["type"] == "ice_candidate":
                 target = message.get("target")
@@ -247,8 +471,7 @@ async def websocket_endpoint(websocket: WebSocket, user_id: str):
 
             elif message["type"] == "answer":
                 if "call_id" in message:
-                    await
-                    manager.answer_call(
+                    await manager.answer_call(
                         message["call_id"],
                         True,
                         message["answer"]
@@ -263,19 +486,17 @@ async def websocket_endpoint(websocket: WebSocket, user_id: str):
                         })
 
     except WebSocketDisconnect:
-        await manager.disconnect_user(user_id)
+        await manager.disconnect_user(user_id, websocket)
     except Exception as e:
-        logger.error(f"WebSocket 错误: {e}")
-        await
-        manager.disconnect_user(user_id)
+        logger.error("WebSocket 错误: %s", e, extra={"event": "error"})
+        await manager.disconnect_user(user_id, websocket, reason="error")
 
 
 # HTTP API 端点
 @app.post("/api/join-room")
 async def join_room(request: JoinRoomRequest):
     """加入房间 API"""
-    result = await
-    manager.join_room(
+    result = await manager.join_room(
         request.userId,
         request.roomId,
         request.offer.dict()
@@ -285,8 +506,7 @@ async def join_room(request: JoinRoomRequest):
 @app.post("/api/call-user")
 async def call_user(request: CallUserRequest):
     """呼叫用户 API"""
-    result = await
-    manager.call_user(
+    result = await manager.call_user(
         request.from_user,
         request.to,
         request.offer.dict()
@@ -308,6 +528,19 @@ async def get_online_users(user_id: str):
     users = manager.get_online_users(exclude_user=user_id)
     return {"users": users}
 
+@app.get("/api/expiry-stats")
+async def get_expiry_stats():
+    """过期回收统计"""
+    return {**manager.expiry.stats(), "snapshot": manager.state.stats()}
+
+
+@app.post("/api/drain")
+async def drain():
+    """滚动重启前调用：客户端收到 server-restart 后按各自的随机延迟重连到新进程"""
+    notified = await manager.drain()
+    logger.info("已通知 %d 个连接重连", notified, extra={"event": "drain"})
+    return {"success": True, "notified": notified, "snapshot": manager.state.stats()}
+
 @app.get("/api/user-status/{user_id}")
 async def get_user_status(user_id: str):
     if user_id in manager.users:
@@ -0,0 +1,70 @@
+# cadence.py - 自适应采样间隔：情绪稳定时放慢、出现变化时加快，推理队列越满越慢
+#
+# /fuse-emotion 的响应里带 next_interval_ms，客户端按它决定下一帧什么时候上传。
+# 纯 Python，不依赖模型，cohost 的事件循环进程也可以直接使用。
+import os
+from collections import OrderedDict
+
+CADENCE_MIN_MS = int(os.getenv("CADENCE_MIN_MS", "500"))
+CADENCE_BASE_MS = int(os.getenv("CADENCE_BASE_MS", "1000"))
+CADENCE_MAX_MS = int(os.getenv("CADENCE_MAX_MS", "4000"))
+# 每次稳定结果后间隔乘以 BACKOFF；置信度低于 CONFIDENT 视为不稳定
+CADENCE_BACKOFF = float(os.getenv("CADENCE_BACKOFF", "1.5"))
+CADENCE_CONFIDENT = float(os.getenv("CADENCE_CONFIDENT", "0.7"))
+# 队列满载（load=1）时间隔放大到 1 + LOAD_GAIN 倍
+CADENCE_LOAD_GAIN = float(os.getenv("CADENCE_LOAD_GAIN", "3"))
+CADENCE_MAX_SESSIONS = int(os.getenv("CADENCE_MAX_SESSIONS", "10000"))
+
+
+def result_confidence(result):
+    """优先取图像置信度（连续采样的主要输入），没有图像时取文本置信度"""
+    source = result.get("image_emotion") or result.get("text_emotion") or {}
+    return source.get("confidence")
+
+
+class CadenceController:
+    def __init__(self, min_ms=CADENCE_MIN_MS, base_ms=CADENCE_BASE_MS, max_ms=CADENCE_MAX_MS,
+                 backoff=CADENCE_BACKOFF, confident=CADENCE_CONFIDENT, load_gain=CADENCE_LOAD_GAIN,
+                 max_sessions=CADENCE_MAX_SESSIONS):
+        self.min_ms = min_ms
+        self.base_ms = base_ms
+        self.max_ms = max_ms
+        self.backoff = backoff
+        self.confident = confident
+        self.load_gain = load_gain
+        self.max_sessions = max_sessions
+        # session -> [上一次的标签, 不计负载的间隔]；按最近使用排序，超出上限淘汰最久未用的
+        self.sessions = OrderedDict()
+
+    def recommend(self, session, label, confidence=None, load=0.0):
+        """返回建议的下一次采样间隔（毫秒）
+
+        - 标签变化：立即降到最小间隔，尽快确认新状态
+        - 标签不变但置信度低：不超过基础间隔
+        - 标签不变且置信度高：按 backoff 逐步放慢，直到最大间隔
+        - load 为推理队列占用率（0~1），整体再乘以 1 + load_gain * load
+        """
+        state = self.sessions.get(session) if session else None
+        if state is None:
+            interval = self.base_ms
+        elif label != state[0]:
+            interval = self.min_ms
+        elif confidence is not None and confidence < self.confident:
+            interval = min(state[1], self.base_ms)
+        else:
+            interval = min(state[1] * self.backoff, self.max_ms)
+
+        if session:
+            if state is None:
+                state = self.sessions[session] = [label, interval]
+                if len(self.sessions) > self.max_sessions:
+                    self.sessions.popitem(last=False)
+            else:
+                state[0], state[1] = label, interval
+                self.sessions.move_to_end(session)
+
+        load = min(max(load, 0.0), 1.0)
+        return int(interval * (1 + self.load_gain * load))
+
+    def forget(self, session):
+        self.sessions.pop(session, None)
@@ -1,11 +1,14 @@
 #image_api.py
 # image_api.py
 import io
+import os
 from PIL import Image
 import torch
 import torch.nn.functional as F
 from torchvision import models, transforms
 
+from image_modes import EXIT_BLOCK, format_mode, parse_mode
+
 DEVICE = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 MODEL_PATH = "best_mobilenet_mixup.pth"
 EMOTION_LABELS = ["angry", "disgusted", "afraid", "happy", "sad", "surprised", "neutral"]
@@ -13,32 +16,101 @@ IMAGE_TO_THREE_LABELS = {
     "angry": "negative", "disgusted": "negative", "afraid": "negative", "sad": "negative",
     "happy": "positive", "surprised": "positive", "neutral": "neutral"
 }
+# 早退头的置信度阈值，低于它继续跑完整个网络
+EXIT_CONFIDENCE = float(os.getenv("IMAGE_EXIT_CONFIDENCE", "0.8"))
+
+
+def build_model():
+    model = models.mobilenet_v2(weights=models.MobileNet_V2_Weights.DEFAULT)
+    model.features[0][0] = torch.nn.Conv2d(1, 32, kernel_size=3, stride=2, padding=1, bias=False)
+    model.classifier = torch.nn.Sequential(
+        torch.nn.Dropout(0.3),
+        torch.nn.Linear(model.last_channel, len(EMOTION_LABELS))
+    )
+    return model
+
+
+def build_exit_head():
+    # 第 13 个倒残差块输出 96 通道
+    return torch.nn.Sequential(
+        torch.nn.AdaptiveAvgPool2d(1),
+        torch.nn.Flatten(),
+        torch.nn.Dropout(0.2),
+        torch.nn.Linear(96, len(EMOTION_LABELS))
+    )
+
+
+def build_transform(resolution):
+    return transforms.Compose([
+        transforms.Grayscale(),
+        transforms.Resize((resolution, resolution)),
+        transforms.ToTensor(),
+        transforms.Normalize([0.5], [0.5])
+    ])
+
+
+def resolution_model_path(resolution):
+    return f"best_mobilenet_mixup_r{resolution}.pth"
+
+
+def exit_head_path(resolution):
+    return f"mobilenet_exit{EXIT_BLOCK}_r{resolution}.pth"
+
+
+def load_weights(module, path):
+    module.load_state_dict(torch.load(path, map_location=DEVICE))
+    module.to(DEVICE)
+    module.eval()
+    return module
+
 
 # 加载模型
-model = models.mobilenet_v2(weights=models.MobileNet_V2_Weights.DEFAULT)
-model.features[0][0] = torch.nn.Conv2d(1, 32, kernel_size=3, stride=2, padding=1, bias=False)
-model.classifier = torch.nn.Sequential(
-    torch.nn.Dropout(0.3),
-    torch.nn.Linear(model.last_channel, len(EMOTION_LABELS))
-)
-model.load_state_dict(torch.load(MODEL_PATH, map_location=DEVICE))
-model.to(DEVICE)
-model.eval()
-
-transform = transforms.Compose([
-    transforms.Grayscale(),
-    transforms.Resize((224, 224)),
-    transforms.ToTensor(),
-    transforms.Normalize([0.5], [0.5])
-])
-
-def predict_image_from_bytes(image_bytes):
+model = load_weights(build_model(), MODEL_PATH)
+transform = build_transform(224)
+
+# 分辨率 -> (模型, 早退头或 None, transform)，首次使用时加载
+_variants = {224: (model, None, transform)}
+_variants_loaded = set()
+
+
+def get_variant(resolution):
+    if resolution not in _variants_loaded:
+        path = resolution_model_path(resolution)
+        net = load_weights(build_model(), path) if os.path.exists(path) else model
+        head_path = exit_head_path(resolution)
+        head = load_weights(build_exit_head(), head_path) if os.path.exists(head_path) else None
+        _variants[resolution] = (net, head, build_transform(resolution))
+        _variants_loaded.add(resolution)
+    return _variants[resolution]
+
+
+def forward(img_tensor, resolution, early_exit):
+    """返回 (概率, 是否在早退点返回)"""
+    net, head, _ = get_variant(resolution)
+    if early_exit and head is not None:
+        x = net.features[:EXIT_BLOCK + 1](img_tensor)
+        probs = F.softmax(head(x), dim=1)
+        if probs.max().item() >= EXIT_CONFIDENCE:
+            return probs, True
+        x = net.features[EXIT_BLOCK + 1:](x)
+        x = torch.flatten(F.adaptive_avg_pool2d(x, 1), 1)
+        return F.softmax(net.classifier(x), dim=1), False
+    return F.softmax(net(img_tensor), dim=1), False
+
+
+def predict_image_from_bytes(image_bytes, mode=None):
+    resolution, early_exit = parse_mode(mode)
+    _, head, variant_transform = get_variant(resolution)
     image = Image.open(io.BytesIO(image_bytes)).convert("RGB")
-    img_tensor = transform(image).unsqueeze(0).to(DEVICE)
+    img_tensor = variant_transform(image).unsqueeze(0).to(DEVICE)
     with torch.no_grad():
-        output = model(img_tensor)
-        probs = F.softmax(output, dim=1)
+        probs, exited = forward(img_tensor, resolution, early_exit)
         pred = torch.argmax(probs, dim=1).item()
         confidence = probs[0][pred].item()
     label = IMAGE_TO_THREE_LABELS[EMOTION_LABELS[pred]]
-    return {"label": label, "confidence": round(confidence, 3)}
\ No newline at end of file
+    return {
+        "label": label,
+        "confidence": round(confidence, 3),
+        "mode": format_mode(resolution, early_exit and head is not None),
+        "early_exit": exited
+    }
@@ -0,0 +1,64 @@
+# image_modes.py - 图像模型的推理模式：输入分辨率 + 是否早退（不依赖 torch，cohost 主进程也可以用）
+#
+# 模式写作 "<分辨率>" 或 "<分辨率>-exit"，如 "224"、"128"、"160-exit"；"full" 等同于 "224"。
+#   - 分辨率：MobileNetV2 末端是全局平均池化，同一份权重可以直接接受更小的输入；
+#     存在 best_mobilenet_mixup_r{分辨率}.pth（tune_image_modes.py finetune 生成）时优先使用它
+#   - exit：在第 EXIT_BLOCK 个倒残差块（96 通道）后接一个小分类头，置信度达到 IMAGE_EXIT_CONFIDENCE 即返回，
+#     否则从中间特征继续跑完剩下的层；需要 mobilenet_exit13_r{分辨率}.pth（tune_image_modes.py train-exit 生成），
+#     缺失时退回不早退
+#
+# 计算量（MACs，单通道输入，按网络结构解析计算；exit 为在早退点返回时的开销）:
+#   | 模式 | 全网络   | 早退返回 |
+#   |------|---------|---------|
+#   | 224  | 292.3M  | 202.6M  |
+#   | 160  | 149.1M  | 103.4M  |
+#   | 128  |  95.4M  |  66.2M  |
+#   | 96   |  53.7M  |  37.2M  |
+# 准确率和实际延迟取决于权重和硬件，用 tune_image_modes.py evaluate 在本地标注数据上生成对照表。
+import os
+
+IMAGE_RESOLUTIONS = (224, 160, 128, 96)
+EXIT_BLOCK = 13
+
+# 未指定模式时使用的默认模式；自动模式下负载（0~1）达到阈值时切换到更便宜的模式
+DEFAULT_IMAGE_MODE = os.getenv("IMAGE_MODE", "224")
+IMAGE_AUTO_MODES = os.getenv("IMAGE_AUTO_MODES", "0.5:160,0.8:128-exit")
+
+
+def parse_mode(mode=None):
+    """返回 (分辨率, 是否早退)；无效模式抛 ValueError"""
+    mode = (mode or DEFAULT_IMAGE_MODE).strip().lower()
+    if mode == "full":
+        mode = "224"
+    resolution, _, suffix = mode.partition("-")
+    if not resolution.isdigit() or int(resolution) not in IMAGE_RESOLUTIONS or suffix not in ("", "exit"):
+        raise ValueError(f"Unknown image mode: {mode}")
+    return int(resolution), suffix == "exit"
+
+
+def format_mode(resolution, early_exit):
+    return f"{resolution}-exit" if early_exit else str(resolution)
+
+
+def parse_auto_modes(spec):
+    steps = []
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        threshold, _, mode = item.partition(":")
+        parse_mode(mode)
+        steps.append((float(threshold), mode.strip()))
+    return sorted(steps)
+
+
+AUTO_MODES = parse_auto_modes(IMAGE_AUTO_MODES)
+
+
+def select_mode(requested=None, load=0.0):
+    """请求指定了模式就用它；未指定或为 "auto" 时按负载选择"""
+    if requested and requested != "auto":
+        parse_mode(requested)
+        return requested
+    mode = DEFAULT_IMAGE_MODE
+    for threshold, candidate in AUTO_MODES:
+        if load >= threshold:
+            mode = candidate
+    return mode
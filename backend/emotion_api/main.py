@@ -1,16 +1,36 @@
 # main.py
 # ✅ main.py（优化版）
-from fastapi import FastAPI, File, UploadFile, Form
+import asyncio
+import os
+
+from fastapi import FastAPI, File, UploadFile, Form, BackgroundTasks, Request
 from fastapi.responses import JSONResponse
 from fastapi.middleware.cors import CORSMiddleware
+from starlette.concurrency import run_in_threadpool
+
+# ✅ 导入模块（识别 + 融合逻辑见 pipeline.py）
+from pipeline import analyze
+from publisher import publish_emotion
+from image_modes import select_mode
+from service import EmotionService
 
-# ✅ 导入模块
-from text_api import predict_text
-from image_api import predict_image_from_bytes
-from fuse_emotion import fuse_emotions
+try:
+    # 录制器在 backend/traffic_trace.py，与信令服务器共用；单独部署时需要把 backend/ 加进 PYTHONPATH
+    from traffic_trace import TraceMiddleware, TraceRecorder
+except ImportError:
+    TraceRecorder = None
 
 app = FastAPI(title="Multimodal Emotion API")
 
+# ✅ 自适应采样：响应里带 next_interval_ms，负载按（正在推理 + 排队等待）的请求数 / EMOTION_QUEUE_CAPACITY 估算
+# ✅ 推理放进线程池执行，最多 EMOTION_QUEUE_CAPACITY 个同时推理，其余在信号量上排队；
+#    事件循环不被阻塞，并发请求才会真正叠加出负载，自动图像模式和采样退避才会生效
+# ✅ 采样间隔、时间线和 /timeline 接口与 cohost.py 共用（见 service.py）
+service = EmotionService()
+EMOTION_QUEUE_CAPACITY = int(os.getenv("EMOTION_QUEUE_CAPACITY", "4"))
+inference_slots = asyncio.Semaphore(EMOTION_QUEUE_CAPACITY)
+in_flight = 0
+
 # ✅ 支持跨域请求（前端可以直接 fetch）
 app.add_middleware(
     CORSMiddleware,
@@ -20,48 +40,42 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# ✅ 流量轨迹录制（设置 TRACE_PATH 开启），只记录时间和请求形状，不记录文本和图像内容
+trace = TraceRecorder("emotion_api") if TraceRecorder else None
+if trace is not None and trace.enabled:
+    app.add_middleware(TraceMiddleware, recorder=trace)
+
 @app.post("/fuse-emotion")
 async def fuse_emotion_endpoint(
+    request: Request,
+    background_tasks: BackgroundTasks,
     text: str = Form(None),
-    image: UploadFile = File(None)
+    image: UploadFile = File(None),
+    user_id: str = Form(None),  # 可选：通话中的用户 ID，结果会经信令服务器推送给房间里的其他人
+    session_id: str = Form(None),  # 可选：采集会话 ID，用于计算建议的采样间隔，默认用 user_id
+    image_mode: str = Form(None)  # 可选：图像推理模式，如 "160"、"128-exit"；不传或 "auto" 时按负载自动选择
 ):
+    global in_flight
+    in_flight += 1
     try:
-        text_result, image_result = None, None
-
-        # ✅ 文本分析
-        if text:
-            text_result = predict_text(text)
-
-        # ✅ 图像分析
-        if image:
-            image_bytes = await image.read()
-            image_result = predict_image_from_bytes(image_bytes)
-
-        # ❌ 两个都没有传
-        if not text_result and not image_result:
-            return JSONResponse(
-                status_code=400,
-                content={"error": "Please provide either text or image input."}
-            )
-
-        # ✅ 情绪融合逻辑
-        if text_result and image_result:
-            final_emotion = fuse_emotions(
-                text_label=text_result["label"], text_conf=text_result["confidence"],
-                image_label=image_result["label"], image_conf=image_result["confidence"]
-            )
-        elif text_result:
-            final_emotion = text_result["label"]
-        else:
-            final_emotion = image_result["label"]
-
-        return {
-            "final_emotion": final_emotion,      # ✅ 前端重点字段（最终推荐用）
-            "text_emotion": text_result,         # 原始文本情绪分析结果
-            "image_emotion": image_result        # 原始图像情绪分析结果
-        }
+        load = (in_flight - 1) / EMOTION_QUEUE_CAPACITY
+        mode = select_mode(image_mode, load)
+        image_bytes = await image.read() if image else None
+        service.annotate(request, text, image_bytes, user_id, session_id, image_mode)
+        async with inference_slots:
+            result = await run_in_threadpool(analyze, text, image_bytes, mode)
+        service.finish(result, user_id, session_id, load=(in_flight - 1) / EMOTION_QUEUE_CAPACITY)
+        if user_id:
+            background_tasks.add_task(publish_emotion, user_id, result)
+        return result
 
+    # ❌ 两个都没有传
+    except ValueError as e:
+        return JSONResponse(status_code=400, content={"error": str(e)})
     except Exception as e:
         return JSONResponse(status_code=500, content={"error": str(e)})
+    finally:
+        in_flight -= 1
 
 
+app.include_router(service.router)
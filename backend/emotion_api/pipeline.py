@@ -0,0 +1,42 @@
+# pipeline.py - 文本 / 图像情绪识别 + 融合，供 main.py 和 cohost 的推理进程共用
+from text_api import predict_text
+from image_api import predict_image_from_bytes
+from fuse_emotion import fuse_emotions
+
+
+def analyze(text=None, image_bytes=None, image_mode=None):
+    """返回 /fuse-emotion 的响应体；两个输入都没有时抛出 ValueError
+
+    image_bytes 可以是 bytes 或 memoryview（cohost 直接传共享内存里的帧）
+    image_mode 见 image_modes.py，None 时使用 IMAGE_MODE
+    """
+    text_result, image_result = None, None
+
+    # ✅ 文本分析
+    if text:
+        text_result = predict_text(text)
+
+    # ✅ 图像分析
+    if image_bytes:
+        image_result = predict_image_from_bytes(image_bytes, image_mode)
+
+    # ❌ 两个都没有传
+    if not text_result and not image_result:
+        raise ValueError("Please provide either text or image input.")
+
+    # ✅ 情绪融合逻辑
+    if text_result and image_result:
+        final_emotion = fuse_emotions(
+            text_label=text_result["label"], text_conf=text_result["confidence"],
+            image_label=image_result["label"], image_conf=image_result["confidence"]
+        )
+    elif text_result:
+        final_emotion = text_result["label"]
+    else:
+        final_emotion = image_result["label"]
+
+    return {
+        "final_emotion": final_emotion,      # ✅ 前端重点字段（最终推荐用）
+        "text_emotion": text_result,         # 原始文本情绪分析结果
+        "image_emotion": image_result        # 原始图像情绪分析结果
+    }
@@ -0,0 +1,33 @@
+# publisher.py - 把融合结果推送给信令服务器，由它通过 WebSocket 转发给同房间的其他人
+import json
+import logging
+import os
+import urllib.error
+import urllib.request
+
+# ✅ 信令服务器地址，如 http://signaling:8000；和信令服务器共用的推送令牌，两者都设置了才推送
+SIGNALING_URL = os.getenv("SIGNALING_URL")
+EMOTION_PUBLISH_TOKEN = os.getenv("EMOTION_PUBLISH_TOKEN")
+
+logger = logging.getLogger(__name__)
+
+
+def publish_emotion(user_id, result):
+    """在后台任务里执行（BackgroundTasks），失败只记日志，不影响接口响应"""
+    if not SIGNALING_URL or not EMOTION_PUBLISH_TOKEN:
+        return
+    headers = {"Content-Type": "application/json", "X-Publish-Token": EMOTION_PUBLISH_TOKEN}
+    request = urllib.request.Request(
+        f"{SIGNALING_URL.rstrip('/')}/api/emotion-update",
+        data=json.dumps({"user_id": user_id, **result}).encode(),
+        headers=headers,
+        method="POST"
+    )
+    try:
+        urllib.request.urlopen(request, timeout=2).close()
+    except urllib.error.HTTPError as e:
+        # 404：该用户当前没有连接信令服务器（不在通话中），属于正常情况
+        if e.code != 404:
+            logger.warning("推送情绪结果失败: %s", e, extra={"event": "publish_failed"})
+    except Exception as e:
+        logger.warning("推送情绪结果失败: %s", e, extra={"event": "publish_failed"})
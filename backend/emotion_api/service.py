@@ -0,0 +1,64 @@
+# service.py - /fuse-emotion 两种部署方式共用的部分：请求形状记录、建议采样间隔、时间线写入和时间线查询接口
+#
+# emotion_api/main.py（单独部署，线程池推理、HTTP 推送）和 cohost.py（与信令合并部署，进程池推理、
+# 同进程推送）只在推理怎么执行、结果怎么推给房间上不同，其余都走这里。
+# 不导入模型，cohost 的事件循环进程也可以直接使用。
+from typing import Optional
+
+from fastapi import APIRouter, Query, Request
+from fastapi.responses import JSONResponse
+
+try:
+    from cadence import CadenceController, result_confidence
+    from timeline import TimelineStore
+except ImportError:
+    # 从 backend 目录以 emotion_api.service 导入（cohost.py）
+    from emotion_api.cadence import CadenceController, result_confidence
+    from emotion_api.timeline import TimelineStore
+
+try:
+    # 录制器在 backend/traffic_trace.py；单独部署 emotion_api 且 backend/ 不在导入路径上时不录制，也不用标注
+    from traffic_trace import binary
+except ImportError:
+    binary = None
+
+
+class EmotionService:
+    def __init__(self):
+        self.cadence = CadenceController()
+        # 每个会话的情绪时间线（定长数组环形缓冲），前端画图和统计直接查询，不必自己保存每次的结果
+        self.timeline = TimelineStore()
+        self.router = APIRouter()
+        self.router.add_api_route("/timeline/{session_id}", self.timeline_summary, methods=["GET"])
+        self.router.add_api_route("/timeline/{session_id}/series", self.timeline_series, methods=["GET"])
+
+    @staticmethod
+    def annotate(request: Request, text: Optional[str], image_bytes: Optional[bytes], user_id: Optional[str],
+                 session_id: Optional[str], image_mode: Optional[str]):
+        """multipart 请求体不经过轨迹中间件解析，由接口把字段交给录制器（只记录形状）"""
+        if binary is None:
+            return
+        request.state.trace = {"text": text, "image": binary(image_bytes), "user_id": user_id,
+                               "session_id": session_id, "image_mode": image_mode}
+
+    def finish(self, result: dict, user_id: Optional[str], session_id: Optional[str], load: float) -> dict:
+        """推理完成后：带上建议的下一次采样间隔，并写入会话时间线；会话默认用 user_id"""
+        session = session_id or user_id
+        result["next_interval_ms"] = self.cadence.recommend(
+            session, result["final_emotion"], result_confidence(result), load=load)
+        self.timeline.append(session, result)
+        return result
+
+    async def timeline_summary(self, session_id: str, window: float = Query(None, gt=0)):
+        """最近 window 秒（默认整个缓冲）的主导情绪、各标签次数和情绪切换次数"""
+        summary = self.timeline.summary(session_id, window)
+        if summary is None:
+            return JSONResponse(status_code=404, content={"error": "Unknown session."})
+        return summary
+
+    async def timeline_series(self, session_id: str, window: float = Query(None, gt=0)):
+        """时间戳、标签和置信度序列，供前端画图"""
+        series = self.timeline.series(session_id, window)
+        if series is None:
+            return JSONResponse(status_code=404, content={"error": "Unknown session."})
+        return series
@@ -0,0 +1,227 @@
+# timeline.py - 每个采集会话的情绪时间线：定长 array 环形缓冲，O(1) 追加，窗口聚合不遍历 Python 对象
+#
+# 每条记录占 TIMELINE_ENTRY_BYTES 字节，分列存放在 array 里（不是每条一个 dict）:
+#   时间戳 'd'、标签编码 'B'、文本 / 图像置信度 'f'（缺失为 NaN），
+#   以及每个标签的累计计数和累计标签切换次数 'I'（前缀和）
+# 窗口查询先在时间戳上二分找到起点，直方图和切换次数用前缀和相减得到，与窗口长度无关。
+#
+# 缓冲按 2 倍扩容到 TIMELINE_CAPACITY 条后开始循环覆盖最旧的记录；
+# 超过 TIMELINE_IDLE 秒没有新记录的会话、以及总内存超过 TIMELINE_MAX_BYTES 时最久未用的会话会被淘汰。
+# 纯 Python，不依赖模型，cohost 的事件循环进程也可以直接使用。
+import math
+import os
+import time
+from array import array
+from collections import OrderedDict
+
+TIMELINE_CAPACITY = int(os.getenv("TIMELINE_CAPACITY", "3600"))
+TIMELINE_IDLE = float(os.getenv("TIMELINE_IDLE", "900"))
+TIMELINE_MAX_BYTES = int(os.getenv("TIMELINE_MAX_BYTES", str(64 * 1024 * 1024)))
+TIMELINE_INITIAL_CAPACITY = 64
+
+LABELS = ("positive", "neutral", "negative", "unknown")
+LABEL_CODES = {label: code for code, label in enumerate(LABELS)}
+# 时间戳 8 + 标签 1 + 两个置信度 8 + 各标签累计计数和切换次数 4 * (len(LABELS) + 1)
+TIMELINE_ENTRY_BYTES = 8 + 1 + 8 + 4 * (len(LABELS) + 1)
+
+NAN = float("nan")
+
+
+def _confidence(source):
+    value = (source or {}).get("confidence")
+    return NAN if value is None else value
+
+
+class Timeline:
+    """单个会话的环形缓冲；n 为写入过的总条数，第 i 条（绝对序号）存放在 i % capacity"""
+
+    def __init__(self, max_capacity: int = TIMELINE_CAPACITY):
+        self.max_capacity = max_capacity
+        self.capacity = 0
+        self.n = 0
+        self.last_seen = time.monotonic()
+        self.times = array("d")
+        self.labels = array("B")
+        self.text_confidence = array("f")
+        self.image_confidence = array("f")
+        self.counts = [array("I") for _ in LABELS]
+        self.transitions = array("I")
+        self.grow()
+
+    @property
+    def nbytes(self) -> int:
+        return self.capacity * TIMELINE_ENTRY_BYTES
+
+    def grow(self):
+        # 只在写满且尚未开始循环时扩容，此时记录按顺序存放，直接在末尾补零即可
+        capacity = min(max(self.capacity * 2, TIMELINE_INITIAL_CAPACITY), self.max_capacity)
+        extra = capacity - self.capacity
+        for column in (self.times, self.labels, self.text_confidence, self.image_confidence,
+                       self.transitions, *self.counts):
+            column.frombytes(bytes(extra * column.itemsize))
+        self.capacity = capacity
+
+    def append(self, t: float, code: int, text_confidence: float, image_confidence: float) -> int:
+        """返回新增的字节数（扩容时）"""
+        added = 0
+        if self.n == self.capacity and self.capacity < self.max_capacity:
+            before = self.nbytes
+            self.grow()
+            added = self.nbytes - before
+        slot = self.n % self.capacity
+        if self.n:
+            prev = (self.n - 1) % self.capacity
+            t = max(t, self.times[prev])
+            changed = self.labels[prev] != code
+            for label, column in enumerate(self.counts):
+                column[slot] = column[prev] + (label == code)
+            self.transitions[slot] = self.transitions[prev] + changed
+        else:
+            for label, column in enumerate(self.counts):
+                column[slot] = label == code
+            self.transitions[slot] = 0
+        self.times[slot] = t
+        self.labels[slot] = code
+        self.text_confidence[slot] = text_confidence
+        self.image_confidence[slot] = image_confidence
+        self.n += 1
+        self.last_seen = time.monotonic()
+        return added
+
+    @property
+    def first(self) -> int:
+        return max(0, self.n - self.capacity)
+
+    def find(self, since: float) -> int:
+        """时间戳 >= since 的第一条记录的绝对序号（二分，时间戳单调不减）"""
+        lo, hi = self.first, self.n
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.times[mid % self.capacity] < since:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def window(self, seconds: float = None, now: float = None) -> tuple:
+        """返回窗口内记录的绝对序号范围 [start, end)"""
+        if seconds is None:
+            return self.first, self.n
+        return self.find((now if now is not None else time.time()) - seconds), self.n
+
+    def summary(self, seconds: float = None, now: float = None) -> dict:
+        start, end = self.window(seconds, now)
+        samples = end - start
+        histogram = dict.fromkeys(LABELS, 0)
+        transitions = 0
+        if samples:
+            first, last = start % self.capacity, (end - 1) % self.capacity
+            for code, column in enumerate(self.counts):
+                histogram[LABELS[code]] = column[last] - column[first] + (self.labels[first] == code)
+            transitions = self.transitions[last] - self.transitions[first]
+        # 次数相同时取窗口内最近出现的标签
+        dominant = None
+        if samples:
+            latest = self.labels[(end - 1) % self.capacity]
+            dominant = max(LABELS, key=lambda label: (histogram[label], label == LABELS[latest]))
+        return {
+            "samples": samples,
+            "dominant": dominant,
+            "histogram": {label: count for label, count in histogram.items() if count},
+            "transitions": transitions,
+            "since": self.times[start % self.capacity] if samples else None,
+            "until": self.times[(end - 1) % self.capacity] if samples else None,
+        }
+
+    def slice(self, column: array, start: int, end: int) -> array:
+        """按绝对序号取一段，处理环绕"""
+        a = start % self.capacity
+        b = a + (end - start)
+        if b <= self.capacity:
+            return column[a:b]
+        return column[a:] + column[:b - self.capacity]
+
+    def series(self, seconds: float = None, now: float = None) -> dict:
+        """给前端画图用的原始序列"""
+        start, end = self.window(seconds, now)
+
+        def values(column):
+            return [None if math.isnan(v) else round(v, 3) for v in self.slice(column, start, end)]
+
+        return {
+            "t": self.slice(self.times, start, end).tolist(),
+            "label": [LABELS[code] for code in self.slice(self.labels, start, end)],
+            "text_confidence": values(self.text_confidence),
+            "image_confidence": values(self.image_confidence),
+        }
+
+
+class TimelineStore:
+    def __init__(self, capacity: int = TIMELINE_CAPACITY, idle: float = TIMELINE_IDLE,
+                 max_bytes: int = TIMELINE_MAX_BYTES):
+        self.capacity = capacity
+        self.idle = idle
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.evicted = {"idle": 0, "memory": 0}
+        # 按最近使用排序，最久未用的在前
+        self.sessions = OrderedDict()
+
+    def append(self, session: str, result: dict, t: float = None):
+        """记录一次 /fuse-emotion 的结果"""
+        if not session:
+            return
+        timeline = self.sessions.get(session)
+        if timeline is None:
+            timeline = self.sessions[session] = Timeline(self.capacity)
+            self.nbytes += timeline.nbytes
+        else:
+            self.sessions.move_to_end(session)
+        code = LABEL_CODES.get(result.get("final_emotion"), LABEL_CODES["unknown"])
+        self.nbytes += timeline.append(t if t is not None else time.time(), code,
+                                       _confidence(result.get("text_emotion")),
+                                       _confidence(result.get("image_emotion")))
+        self.evict()
+
+    def evict(self):
+        # 队首是最久未用的会话：空闲淘汰只需从头检查到第一个未过期的
+        deadline = time.monotonic() - self.idle
+        while self.sessions:
+            session, timeline = next(iter(self.sessions.items()))
+            if timeline.last_seen >= deadline:
+                break
+            self.drop(session, "idle")
+        # 刚写入的会话在队尾，至少保留它
+        while self.nbytes > self.max_bytes and len(self.sessions) > 1:
+            self.drop(next(iter(self.sessions)), "memory")
+
+    def drop(self, session: str, reason: str):
+        self.nbytes -= self.sessions.pop(session).nbytes
+        self.evicted[reason] += 1
+
+    def get(self, session: str):
+        timeline = self.sessions.get(session)
+        if timeline is not None and timeline.last_seen < time.monotonic() - self.idle:
+            self.drop(session, "idle")
+            return None
+        return timeline
+
+    def summary(self, session: str, seconds: float = None):
+        timeline = self.get(session)
+        return timeline.summary(seconds) if timeline else None
+
+    def series(self, session: str, seconds: float = None):
+        timeline = self.get(session)
+        return timeline.series(seconds) if timeline else None
+
+    def forget(self, session: str):
+        if session in self.sessions:
+            self.nbytes -= self.sessions.pop(session).nbytes
+
+    def stats(self) -> dict:
+        return {
+            "sessions": len(self.sessions),
+            "bytes": self.nbytes,
+            "max_bytes": self.max_bytes,
+            "evicted": dict(self.evicted),
+        }
@@ -0,0 +1,179 @@
+# tune_image_modes.py - 在本地标注数据上微调 / 评估图像模型的各推理模式（见 image_modes.py）
+#
+# 数据目录按 torchvision ImageFolder 组织，子目录名为 EMOTION_LABELS 中的标签：
+#   data/train/happy/xxx.jpg, data/train/sad/...   data/val/happy/...
+#
+# 用法（在 emotion_api 目录下运行，和服务使用同一套相对路径的权重）:
+#   python tune_image_modes.py finetune --data data --resolution 128      -> best_mobilenet_mixup_r128.pth
+#   python tune_image_modes.py train-exit --data data --resolution 128    -> mobilenet_exit13_r128.pth
+#   python tune_image_modes.py evaluate --data data/val [--modes 224,160,128-exit]
+#
+# evaluate 输出 markdown 表格（7 类 / 3 类准确率、早退比例、单张 CPU 延迟 p50/p95），
+# 可直接贴进部署文档作为准确率-延迟对照表。
+import argparse
+import statistics
+import time
+
+import torch
+import torch.nn.functional as F
+from torch.utils.data import DataLoader
+from torchvision import datasets, transforms
+
+import image_api
+from image_api import (EMOTION_LABELS, IMAGE_TO_THREE_LABELS, DEVICE, build_exit_head, exit_head_path,
+                       forward, get_variant, resolution_model_path)
+from image_modes import EXIT_BLOCK, IMAGE_RESOLUTIONS, format_mode, parse_mode
+
+
+def load_folder(path, resolution, augment=False):
+    steps = [transforms.Grayscale(), transforms.Resize((resolution, resolution))]
+    if augment:
+        steps += [transforms.RandomHorizontalFlip(), transforms.RandomRotation(10)]
+    steps += [transforms.ToTensor(), transforms.Normalize([0.5], [0.5])]
+    dataset = datasets.ImageFolder(path, transform=transforms.Compose(steps))
+    unknown = set(dataset.classes) - set(EMOTION_LABELS)
+    if unknown:
+        raise SystemExit(f"未知的标签目录: {sorted(unknown)}，应为 {EMOTION_LABELS}")
+    # ImageFolder 按目录名排序编号，映射回模型的标签顺序
+    remap = [EMOTION_LABELS.index(name) for name in dataset.classes]
+    dataset.target_transform = lambda target: remap[target]
+    return dataset
+
+
+def run_epochs(module, params, loader, epochs, lr, step, save_path, val_loader=None, score=None):
+    optimizer = torch.optim.AdamW(params, lr=lr)
+    best = -1.0
+    for epoch in range(epochs):
+        module.train()
+        total, count = 0.0, 0
+        for images, targets in loader:
+            images, targets = images.to(DEVICE), targets.to(DEVICE)
+            loss = step(images, targets)
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
+            total += loss.item() * len(targets)
+            count += len(targets)
+        module.eval()
+        accuracy = score(val_loader) if val_loader else 0.0
+        print(f"epoch {epoch + 1}/{epochs}  loss {total / count:.4f}  val_acc {accuracy:.3f}")
+        if accuracy >= best:
+            best = accuracy
+            torch.save(module.state_dict(), save_path)
+    print(f"✅ 已保存 {save_path}（val_acc {best:.3f}）")
+
+
+def accuracy(predict, loader):
+    correct = count = 0
+    with torch.no_grad():
+        for images, targets in loader:
+            logits = predict(images.to(DEVICE))
+            correct += (logits.argmax(dim=1).cpu() == targets).sum().item()
+            count += len(targets)
+    return correct / count if count else 0.0
+
+
+def finetune(args):
+    """在原模型权重基础上，用目标分辨率的输入 + mixup 微调整个网络"""
+    model = image_api.build_model()
+    model.load_state_dict(torch.load(image_api.MODEL_PATH, map_location=DEVICE))
+    model.to(DEVICE)
+    train = DataLoader(load_folder(f"{args.data}/train", args.resolution, augment=True),
+                       batch_size=args.batch_size, shuffle=True, num_workers=args.workers)
+    val = DataLoader(load_folder(f"{args.data}/val", args.resolution),
+                     batch_size=args.batch_size, num_workers=args.workers)
+
+    def step(images, targets):
+        lam = float(torch.distributions.Beta(0.2, 0.2).sample())
+        index = torch.randperm(len(targets), device=DEVICE)
+        logits = model(lam * images + (1 - lam) * images[index])
+        return lam * F.cross_entropy(logits, targets) + (1 - lam) * F.cross_entropy(logits, targets[index])
+
+    run_epochs(model, model.parameters(), train, args.epochs, args.lr, step,
+               resolution_model_path(args.resolution), val, lambda loader: accuracy(model, loader))
+
+
+def train_exit(args):
+    """主干冻结，只训练早退头；主干取该分辨率下服务实际使用的权重"""
+    net, _, _ = get_variant(args.resolution)
+    for param in net.parameters():
+        param.requires_grad = False
+    head = build_exit_head().to(DEVICE)
+    stem = net.features[:EXIT_BLOCK + 1]
+    train = DataLoader(load_folder(f"{args.data}/train", args.resolution, augment=True),
+                       batch_size=args.batch_size, shuffle=True, num_workers=args.workers)
+    val = DataLoader(load_folder(f"{args.data}/val", args.resolution),
+                     batch_size=args.batch_size, num_workers=args.workers)
+
+    def step(images, targets):
+        with torch.no_grad():
+            features = stem(images)
+        return F.cross_entropy(head(features), targets)
+
+    run_epochs(head, head.parameters(), train, args.epochs, args.lr, step,
+               exit_head_path(args.resolution), val, lambda loader: accuracy(lambda x: head(stem(x)), loader))
+
+
+def evaluate(args):
+    modes = args.modes.split(",") if args.modes else \
+        [format_mode(res, exit_) for res in IMAGE_RESOLUTIONS for exit_ in (False, True)]
+    three = [IMAGE_TO_THREE_LABELS[label] for label in EMOTION_LABELS]
+    rows, total = [], 0
+    for mode in modes:
+        resolution, early_exit = parse_mode(mode)
+        _, head, _ = get_variant(resolution)
+        if early_exit and head is None:
+            print(f"跳过 {mode}: 缺少 {exit_head_path(resolution)}")
+            continue
+        dataset = load_folder(args.data, resolution)
+        if args.limit:
+            dataset = torch.utils.data.Subset(dataset, range(min(args.limit, len(dataset))))
+        # 逐张推理，延迟与线上单请求一致
+        correct7 = correct3 = exited = 0
+        latencies = []
+        with torch.no_grad():
+            for i, (image, target) in enumerate(dataset):
+                start = time.perf_counter()
+                probs, was_exit = forward(image.unsqueeze(0).to(DEVICE), resolution, early_exit)
+                pred = probs.argmax(dim=1).item()
+                if i >= args.warmup:
+                    latencies.append((time.perf_counter() - start) * 1000)
+                correct7 += pred == target
+                correct3 += three[pred] == three[target]
+                exited += was_exit
+        total = len(dataset)
+        latencies.sort()
+        rows.append((mode, correct7 / total, correct3 / total, exited / total,
+                     statistics.median(latencies) if latencies else 0.0,
+                     latencies[int(len(latencies) * 0.95)] if latencies else 0.0))
+
+    print(f"\n{total} 张图像，设备 {DEVICE}，torch 线程数 {torch.get_num_threads()}\n")
+    print("| 模式 | 7 类准确率 | 3 类准确率 | 早退比例 | 延迟 p50 | 延迟 p95 |")
+    print("|------|-----------|-----------|---------|---------|---------|")
+    for mode, acc7, acc3, exit_rate, p50, p95 in rows:
+        print(f"| {mode} | {acc7:.1%} | {acc3:.1%} | {exit_rate:.0%} | {p50:.1f}ms | {p95:.1f}ms |")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    commands = parser.add_subparsers(dest="command", required=True)
+    for name in ("finetune", "train-exit"):
+        command = commands.add_parser(name)
+        command.add_argument("--data", required=True, help="包含 train/ 和 val/ 的目录")
+        command.add_argument("--resolution", type=int, choices=IMAGE_RESOLUTIONS, required=True)
+        command.add_argument("--epochs", type=int, default=10 if name == "finetune" else 5)
+        command.add_argument("--lr", type=float, default=1e-4 if name == "finetune" else 1e-3)
+        command.add_argument("--batch-size", type=int, default=64)
+        command.add_argument("--workers", type=int, default=2)
+    command = commands.add_parser("evaluate")
+    command.add_argument("--data", required=True, help="验证集目录")
+    command.add_argument("--modes", help="逗号分隔，默认评估全部分辨率及其早退版本")
+    command.add_argument("--limit", type=int, default=0)
+    command.add_argument("--warmup", type=int, default=10, help="不计入延迟统计的前几张")
+    args = parser.parse_args()
+
+    {"finetune": finetune, "train-exit": train_exit, "evaluate": evaluate}[args.command](args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+# expiry.py - 基于哈希时间轮的过期调度器（等待中的房间 / 待接呼叫 / 已交付的 offer）
+import asyncio
+import inspect
+import logging
+import math
+import time
+from collections import Counter
+from typing import Callable, Dict, Hashable, List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class ExpiryWheel:
+    """哈希时间轮：schedule / cancel 均摊 O(1)，advance 只扫描到期的槽位
+
+    key 约定为元组，第一个元素是类别（如 ("room", room_id)），用于统计回收数量。
+    """
+
+    def __init__(self, tick: float = 1.0, slots: int = 512, clock: Callable[[], float] = time.monotonic):
+        self.tick = tick
+        self.clock = clock
+        # 每个槽位: {key: deadline}
+        self.slots: List[Dict[Hashable, float]] = [{} for _ in range(slots)]
+        # key -> 槽位下标，用于 O(1) 取消
+        self.index: Dict[Hashable, int] = {}
+        self.current_tick = int(clock() / tick)
+        self.reaped: Counter = Counter()
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, key: Hashable):
+        return key in self.index
+
+    def schedule(self, key: Hashable, ttl: float):
+        """注册（或刷新）一个 key 的过期时间"""
+        self.cancel(key)
+        deadline = self.clock() + ttl
+        # 向上取整，保证扫描到该槽位时 deadline 一定已到
+        tick = max(math.ceil(deadline / self.tick), self.current_tick + 1)
+        slot = tick % len(self.slots)
+        self.slots[slot][key] = deadline
+        self.index[key] = slot
+
+    def cancel(self, key: Hashable) -> bool:
+        slot = self.index.pop(key, None)
+        if slot is None:
+            return False
+        del self.slots[slot][key]
+        return True
+
+    def clear(self):
+        for slot in self.slots:
+            slot.clear()
+        self.index.clear()
+
+    def advance(self, now: Optional[float] = None) -> List[Hashable]:
+        """推进时间轮，返回所有已到期的 key（已从时间轮中移除）"""
+        now = self.clock() if now is None else now
+        target = int(now / self.tick)
+        steps = min(target - self.current_tick, len(self.slots))
+        expired = []
+        for step in range(1, steps + 1):
+            slot = self.slots[(self.current_tick + step) % len(self.slots)]
+            # 同一槽位中可能有下一圈才到期的 key
+            due = [key for key, deadline in slot.items() if deadline <= now]
+            for key in due:
+                del slot[key]
+                del self.index[key]
+            expired.extend(due)
+        self.current_tick = max(self.current_tick, target)
+        return expired
+
+    async def run(self, handler: Callable):
+        """后台循环：每个 tick 推进一次，对到期 key 调用 handler（支持同步或异步）"""
+        while True:
+            await asyncio.sleep(self.tick)
+            for key in self.advance():
+                self.reaped[key[0]] += 1
+                try:
+                    result = handler(key)
+                    if inspect.isawaitable(result):
+                        await result
+                except Exception as e:
+                    logger.error("处理过期事件 %s 失败: %s", key, e, extra={"event": "error"})
+
+    def stats(self) -> dict:
+        return {
+            "scheduled": len(self.index),
+            "reaped": dict(self.reaped),
+        }
@@ -0,0 +1,44 @@
+# fastjson.py - 信令热路径用的 JSON 编解码：优先 orjson，缺失时回退到标准库
+import re
+from typing import Optional
+
+try:
+    import orjson
+
+    CODEC = "orjson"
+
+    def dumps(obj) -> str:
+        return orjson.dumps(obj).decode()
+
+    loads = orjson.loads
+except ImportError:
+    import json
+
+    CODEC = "json"
+
+    dumps = json.JSONEncoder(ensure_ascii=False, separators=(",", ":")).encode
+    loads = json.loads
+
+# 只需中转、服务器不关心内容的消息类型
+RELAY_TYPES = {"offer", "answer", "ice-candidate"}
+
+# 前端发出的消息 type 总在第一个键，匹配不到时调用方应退回完整解析
+_TYPE_PREFIX = re.compile(r'\s*\{\s*"type"\s*:\s*"([A-Za-z_-]+)"')
+
+
+def peek_type(data: str) -> Optional[str]:
+    """不解析整帧，只读出开头的 type 字段"""
+    match = _TYPE_PREFIX.match(data)
+    return match.group(1) if match else None
+
+
+def append_field(data: str, key: str, value) -> Optional[str]:
+    """在原始 JSON 对象末尾追加一个字段
+
+    JSON.parse 遇到重复键时取最后一个，所以客户端自带的同名字段（如伪造的 from）会被覆盖。
+    这里只看结尾的 "}"，不校验 data 本身是否合法，调用方要先解析确认。
+    """
+    end = data.rstrip()
+    if not end.endswith("}"):
+        return None
+    return f"{end[:-1]},{dumps(key)}:{dumps(value)}}}"
@@ -0,0 +1,170 @@
+# inference_pool.py - 隔离的情绪推理进程池：图像帧走共享内存，进程间管道里只传槽位号和长度
+#
+# 共享内存被切成 INFERENCE_QUEUE 个固定大小的槽位，每个在途请求占一个槽位直到推理进程用完，
+# 槽位用完即拒绝（QueueFull），所以排队的请求数有上限，不会在事件循环里无限堆积。
+# 推理进程限制 torch 线程数并降低调度优先级，CPU 跑满时信令的事件循环仍能及时得到调度。
+#
+# 环境变量:
+#   INFERENCE_WORKERS=1       推理进程数
+#   INFERENCE_THREADS=1       每个推理进程的 torch 线程数
+#   INFERENCE_QUEUE=8         在途请求上限（= 共享内存槽位数）
+#   INFERENCE_FRAME_BYTES=2097152   单帧图像最大字节数（= 槽位大小）
+#   INFERENCE_TIMEOUT=30      单次推理超时（秒）
+#   INFERENCE_NICE=10         推理进程的 nice 增量，0 表示不调整
+#   EMOTION_API_DIR           emotion_api 目录（模型文件所在位置），默认与本文件同级
+import asyncio
+import logging
+import multiprocessing
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import shared_memory
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+INFERENCE_WORKERS = int(os.getenv("INFERENCE_WORKERS", "1"))
+INFERENCE_THREADS = int(os.getenv("INFERENCE_THREADS", "1"))
+INFERENCE_QUEUE = int(os.getenv("INFERENCE_QUEUE", str(INFERENCE_WORKERS * 8)))
+INFERENCE_FRAME_BYTES = int(os.getenv("INFERENCE_FRAME_BYTES", str(2 * 1024 * 1024)))
+INFERENCE_TIMEOUT = float(os.getenv("INFERENCE_TIMEOUT", "30"))
+INFERENCE_NICE = int(os.getenv("INFERENCE_NICE", "10"))
+
+EMOTION_API_DIR = os.getenv(
+    "EMOTION_API_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "emotion_api"))
+
+
+class QueueFull(Exception):
+    """所有槽位都在使用中"""
+
+
+# ---- 以下在推理进程中执行 ----
+
+_frames: Optional[shared_memory.SharedMemory] = None
+_frame_bytes = 0
+
+
+def _init_worker(shm_name: str, frame_bytes: int, threads: int, nice: int):
+    global _frames, _frame_bytes
+    # emotion_api 的模型路径是相对路径，模块也是平铺导入
+    os.chdir(EMOTION_API_DIR)
+    sys.path.insert(0, EMOTION_API_DIR)
+    if nice:
+        os.nice(nice)
+    import torch
+    torch.set_num_threads(threads)
+    _frames = shared_memory.SharedMemory(name=shm_name)
+    _frame_bytes = frame_bytes
+    import pipeline  # noqa: F401  在进程启动时加载模型，而不是第一个请求
+
+
+def _warmup() -> int:
+    return os.getpid()
+
+
+def _infer(slot: int, length: int, text: Optional[str], image_mode: Optional[str] = None) -> dict:
+    import pipeline
+    frame = None
+    if length:
+        offset = slot * _frame_bytes
+        frame = _frames.buf[offset:offset + length]
+    try:
+        return pipeline.analyze(text, frame, image_mode)
+    finally:
+        if frame is not None:
+            frame.release()
+
+
+# ---- 以下在事件循环所在进程中执行 ----
+
+class InferencePool:
+    def __init__(self, workers: int = INFERENCE_WORKERS, slots: int = INFERENCE_QUEUE,
+                 frame_bytes: int = INFERENCE_FRAME_BYTES, timeout: float = INFERENCE_TIMEOUT):
+        self.workers = workers
+        self.frame_bytes = frame_bytes
+        self.timeout = timeout
+        self.frames = shared_memory.SharedMemory(create=True, size=slots * frame_bytes)
+        self.free = list(range(slots))
+        self.slots = slots
+        self.executor = self.create_executor()
+        self.counts = {"completed": 0, "rejected": 0, "failed": 0, "timeouts": 0, "restarts": 0}
+
+    def create_executor(self) -> ProcessPoolExecutor:
+        # spawn：推理进程不继承事件循环、socket 等父进程状态
+        return ProcessPoolExecutor(
+            max_workers=self.workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_worker,
+            initargs=(self.frames.name, self.frame_bytes, INFERENCE_THREADS, INFERENCE_NICE),
+        )
+
+    async def start(self):
+        """提前拉起所有推理进程并加载模型"""
+        loop = asyncio.get_running_loop()
+        pids = await asyncio.gather(*(loop.run_in_executor(self.executor, _warmup) for _ in range(self.workers)))
+        logger.info("推理进程已就绪: %s", sorted(set(pids)), extra={"event": "inference_ready"})
+
+    async def analyze(self, text: Optional[str], image: Optional[bytes], image_mode: Optional[str] = None) -> dict:
+        if image and len(image) > self.frame_bytes:
+            raise ValueError(f"Image too large (max {self.frame_bytes} bytes).")
+        if not self.free:
+            raise QueueFull()
+
+        slot = self.free.pop()
+        length = len(image) if image else 0
+        if length:
+            offset = slot * self.frame_bytes
+            self.frames.buf[offset:offset + length] = image
+        try:
+            future = asyncio.get_running_loop().run_in_executor(
+                self.executor, _infer, slot, length, text, image_mode)
+        except BrokenProcessPool:
+            self.free.append(slot)
+            self.restart()
+            raise
+        # 超时后推理进程可能仍在读这个槽位，等它真正结束才归还
+        future.add_done_callback(lambda _: self.free.append(slot))
+        try:
+            result = await asyncio.wait_for(asyncio.shield(future), self.timeout)
+        except asyncio.TimeoutError:
+            self.counts["timeouts"] += 1
+            raise
+        except BrokenProcessPool:
+            self.counts["failed"] += 1
+            self.restart()
+            raise
+        except Exception:
+            self.counts["failed"] += 1
+            raise
+        self.counts["completed"] += 1
+        return result
+
+    @property
+    def full(self) -> bool:
+        return not self.free
+
+    @property
+    def load(self) -> float:
+        """在途请求占用率（0~1），用于自适应采样间隔"""
+        return 1 - len(self.free) / self.slots
+
+    def restart(self):
+        """推理进程崩溃（如 OOM）后整个进程池不可用，换一个新的"""
+        logger.error("推理进程池已损坏，重新创建", extra={"event": "inference_restart"})
+        self.counts["restarts"] += 1
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        self.executor = self.create_executor()
+
+    def close(self):
+        self.executor.shutdown(wait=True, cancel_futures=True)
+        self.frames.close()
+        self.frames.unlink()
+
+    def stats(self) -> dict:
+        return {
+            "workers": self.workers,
+            "slots": self.slots,
+            "in_flight": self.slots - len(self.free),
+            **self.counts,
+        }
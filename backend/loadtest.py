@@ -0,0 +1,366 @@
+# loadtest.py - 信令服务器压测：模拟成对的 WebRTC 客户端
+#
+# 用法（在 backend 目录下）:
+#   python loadtest.py --server websocket_server --pairs 2000
+#   python loadtest.py --server complex_server --pairs 500 --scenario churn --iterations 5
+#   python loadtest.py --server websocket_server --scenario storm --pairs 1000
+#   python loadtest.py --url ws://127.0.0.1:8000 --spawn none    # 压已在运行的服务器
+#
+# 场景:
+#   call  - 每对用户跑一遍 join-room → offer → answer → ice-candidate → leave-room
+#   churn - 每对用户用新连接重复 call 流程 --iterations 次
+#   storm - 所有用户先进入房间，然后同时断线并立即重连重新加入
+import argparse
+import asyncio
+import json
+import os
+import resource
+import socket
+import subprocess
+import sys
+import time
+import uuid
+from typing import List, Optional
+
+import websockets
+
+FAKE_SDP = "v=0\r\no=- 0 2 IN IP4 127.0.0.1\r\ns=-\r\nt=0 0\r\n" + "a=rtpmap:96 VP8/90000\r\n" * 80
+FAKE_CANDIDATE = {"candidate": "candidate:1 1 udp 2122260223 10.0.0.1 50000 typ host", "sdpMid": "0", "sdpMLineIndex": 0}
+
+
+class Stats:
+    def __init__(self):
+        self.match_latency: List[float] = []
+        self.call_latency: List[float] = []
+        self.sent = 0
+        self.received = 0
+        self.errors = 0
+        self.peak_connections = 0
+        self.open_connections = 0
+
+    def opened(self):
+        self.open_connections += 1
+        self.peak_connections = max(self.peak_connections, self.open_connections)
+
+    def closed(self):
+        self.open_connections -= 1
+
+
+def percentile(values: List[float], p: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))]
+
+
+def proc_usage(pid: int):
+    """读取 /proc 中的 CPU 秒数和常驻内存（KB）"""
+    with open(f"/proc/{pid}/stat") as f:
+        fields = f.read().rsplit(")", 1)[1].split()
+    cpu = (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+    rss = 0
+    with open(f"/proc/{pid}/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                rss = int(line.split()[1])
+    return cpu, rss
+
+
+def raise_fd_limit():
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+class Client:
+    """一个模拟的信令客户端"""
+
+    def __init__(self, base_url: str, user_id: str, stats: Stats):
+        self.url = f"{base_url}/ws/{user_id}"
+        self.user_id = user_id
+        self.stats = stats
+        self.ws = None
+
+    async def open(self):
+        self.ws = await websockets.connect(self.url, max_size=None, ping_interval=None, open_timeout=60)
+        self.stats.opened()
+
+    async def close(self, abrupt: bool = False):
+        if self.ws is None:
+            return
+        if abrupt:
+            self.ws.transport.abort()
+        else:
+            await self.ws.close()
+        self.ws = None
+        self.stats.closed()
+
+    async def send(self, message: dict):
+        await self.ws.send(json.dumps(message))
+        self.stats.sent += 1
+
+    async def expect(self, *types: str, timeout: float = 30.0) -> dict:
+        """读到指定类型的消息为止，顺手应答心跳"""
+        deadline = time.perf_counter() + timeout
+        while True:
+            raw = await asyncio.wait_for(self.ws.recv(), deadline - time.perf_counter())
+            self.stats.received += 1
+            message = json.loads(raw)
+            if message.get("type") == "ping":
+                await self.send({"type": "pong"})
+            elif message.get("type") in types:
+                return message
+
+
+async def http_post(host: str, port: int, path: str, payload: dict) -> dict:
+    """最小化的 HTTP/1.1 POST，避免为压测引入额外依赖"""
+    body = json.dumps(payload).encode()
+    reader, writer = await asyncio.open_connection(host, port)
+    writer.write(
+        f"POST {path} HTTP/1.1\r\nHost: {host}\r\nContent-Type: application/json\r\n"
+        f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body
+    )
+    await writer.drain()
+    response = await reader.read()
+    writer.close()
+    return json.loads(response.split(b"\r\n\r\n", 1)[1] or b"{}")
+
+
+async def pair_websocket_server(base_url: str, room_id: str, stats: Stats, ice: int, **_):
+    """websocket_server.py 的通话流程"""
+    a = Client(base_url, f"a-{room_id}", stats)
+    b = Client(base_url, f"b-{room_id}", stats)
+    await asyncio.gather(a.open(), b.open())
+    try:
+        start = time.perf_counter()
+        await a.send({"type": "join-room", "room_id": room_id})
+        await a.expect("room-joined")
+        joined = time.perf_counter()
+        await b.send({"type": "join-room", "room_id": room_id})
+        await asyncio.gather(b.expect("room-joined"), a.expect("user-joined"))
+        stats.match_latency.append(time.perf_counter() - joined)
+
+        await b.send({"type": "offer", "offer": {"type": "offer", "sdp": FAKE_SDP}})
+        await a.expect("offer")
+        await a.send({"type": "answer", "answer": {"type": "answer", "sdp": FAKE_SDP}})
+        await b.expect("answer")
+        for _ in range(ice):
+            await a.send({"type": "ice-candidate", "candidate": FAKE_CANDIDATE})
+            await b.send({"type": "ice-candidate", "candidate": FAKE_CANDIDATE})
+        for _ in range(ice):
+            await asyncio.gather(a.expect("ice-candidate"), b.expect("ice-candidate"))
+        stats.call_latency.append(time.perf_counter() - start)
+
+        await a.send({"type": "leave-room"})
+        await b.expect("user-left")
+    finally:
+        await asyncio.gather(a.close(), b.close())
+
+
+async def pair_complex_server(base_url: str, room_id: str, stats: Stats, ice: int, host: str, port: int):
+    """complex_server.py 的通话流程：HTTP 加入房间，WebSocket 收匹配结果和中转"""
+    a = Client(base_url, f"a-{room_id}", stats)
+    b = Client(base_url, f"b-{room_id}", stats)
+    await asyncio.gather(a.open(), b.open())
+    try:
+        offer = {"type": "offer", "sdp": FAKE_SDP}
+        start = time.perf_counter()
+        await http_post(host, port, "/api/join-room", {"roomId": room_id, "userId": a.user_id, "offer": offer})
+        joined = time.perf_counter()
+        await http_post(host, port, "/api/join-room", {"roomId": room_id, "userId": b.user_id, "offer": offer})
+        await asyncio.gather(a.expect("room_matched"), b.expect("room_matched"))
+        stats.match_latency.append(time.perf_counter() - joined)
+
+        await b.send({"type": "answer", "target": a.user_id, "answer": {"type": "answer", "sdp": FAKE_SDP}})
+        await a.expect("answer")
+        for _ in range(ice):
+            await a.send({"type": "ice_candidate", "target": b.user_id, "candidate": FAKE_CANDIDATE})
+            await b.send({"type": "ice_candidate", "target": a.user_id, "candidate": FAKE_CANDIDATE})
+        for _ in range(ice):
+            await asyncio.gather(a.expect("ice_candidate"), b.expect("ice_candidate"))
+        stats.call_latency.append(time.perf_counter() - start)
+    finally:
+        await asyncio.gather(a.close(), b.close())
+
+
+FLOWS = {
+    "websocket_server": pair_websocket_server,
+    "complex_server": pair_complex_server,
+}
+
+
+async def guarded(coro, stats: Stats, limiter: asyncio.Semaphore):
+    async with limiter:
+        try:
+            await coro
+        except Exception as e:
+            stats.errors += 1
+            if stats.errors <= 5:
+                print(f"⚠️ 客户端错误: {type(e).__name__}: {e}")
+
+
+async def scenario_call(args, flow, stats: Stats, limiter: asyncio.Semaphore, iterations: int = 1):
+    async def repeat(pair: int):
+        for i in range(iterations):
+            await guarded(flow(args.base_url, f"lt-{pair}-{i}", stats, args.ice, host=args.host, port=args.port),
+                          stats, limiter)
+
+    await asyncio.gather(*(repeat(pair) for pair in range(args.pairs)))
+
+
+async def scenario_storm(args, flow, stats: Stats, limiter: asyncio.Semaphore):
+    """所有人进入房间后同时掉线，再同时重连并重新加入同一房间"""
+    if args.server != "websocket_server":
+        raise SystemExit("storm 场景目前只支持 websocket_server")
+    clients = [Client(args.base_url, f"s{n}-{uuid.uuid4().hex[:6]}", stats) for n in range(args.pairs * 2)]
+
+    async def join(client: Client, room_id: str):
+        async with limiter:
+            await client.open()
+            await client.send({"type": "join-room", "room_id": room_id})
+            reply = await client.expect("room-joined")
+            # 服务器拒绝时也回 room-joined（success: false，如"您已在此房间中"），按失败计
+            if not reply.get("success"):
+                raise RuntimeError(f"加入房间失败: {reply.get('message')}")
+
+    async def rejoin(client: Client, room_id: str):
+        start = time.perf_counter()
+        await join(client, room_id)
+        stats.match_latency.append(time.perf_counter() - start)
+
+    rooms = [f"storm-{n // 2}" for n in range(len(clients))]
+    results = await asyncio.gather(*(join(c, r) for c, r in zip(clients, rooms)), return_exceptions=True)
+    stats.errors += sum(isinstance(r, Exception) for r in results)
+    await asyncio.gather(*(c.close(abrupt=True) for c in clients))
+    results = await asyncio.gather(*(rejoin(c, r) for c, r in zip(clients, rooms)), return_exceptions=True)
+    stats.errors += sum(isinstance(r, Exception) for r in results)
+    await asyncio.gather(*(c.close() for c in clients))
+
+
+def start_subprocess_server(args) -> subprocess.Popen:
+    env = dict(os.environ, PYTHONUNBUFFERED="1")
+    proc = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", f"{args.server}:app", "--host", args.host,
+         "--port", str(args.port), "--log-level", "warning", "--ws-max-size", str(1 << 24)],
+        cwd=os.path.dirname(os.path.abspath(__file__)), env=env,
+        stdout=subprocess.DEVNULL if args.quiet_server else None,
+        stderr=subprocess.DEVNULL if args.quiet_server else None,
+    )
+    return proc
+
+
+async def start_inprocess_server(args):
+    import uvicorn
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    config = uvicorn.Config(f"{args.server}:app", host=args.host, port=args.port, log_level="warning")
+    server = uvicorn.Server(config)
+    task = asyncio.create_task(server.serve())
+    return server, task
+
+
+async def wait_for_port(host: str, port: int, timeout: float = 30.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            _, writer = await asyncio.open_connection(host, port)
+            writer.close()
+            return
+        except OSError:
+            await asyncio.sleep(0.1)
+    raise RuntimeError(f"服务器 {host}:{port} 未能启动")
+
+
+def report(args, stats: Stats, elapsed: float, cpu: Optional[float], rss_delta: Optional[int]):
+    print()
+    print(f"场景: {args.scenario}  服务器: {args.server}  用户对: {args.pairs}  耗时: {elapsed:.2f}s")
+    print(f"峰值连接: {stats.peak_connections}  错误: {stats.errors}")
+    print(f"消息: 发送 {stats.sent}  接收 {stats.received}  吞吐 {(stats.sent + stats.received) / elapsed:.0f} msg/s")
+    for name, values in (("加入→匹配", stats.match_latency), ("完整通话建立", stats.call_latency)):
+        if values:
+            print(f"{name} 延迟 (ms): p50={percentile(values, 50) * 1e3:.1f} "
+                  f"p95={percentile(values, 95) * 1e3:.1f} p99={percentile(values, 99) * 1e3:.1f} "
+                  f"max={max(values) * 1e3:.1f}  (n={len(values)})")
+    if cpu is not None and stats.peak_connections:
+        print(f"服务器 CPU: {cpu:.2f}s ({cpu / max(stats.sent, 1) * 1e6:.1f} µs/入站消息)")
+        print(f"服务器内存: 峰值 +{rss_delta / 1024:.1f} MB ({rss_delta / stats.peak_connections:.1f} KB/连接)")
+        if args.spawn == "inprocess":
+            print("（inprocess 模式下 CPU/内存包含压测客户端本身）")
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="WebRTC 信令服务器压测")
+    parser.add_argument("--server", choices=sorted(FLOWS), default="websocket_server")
+    parser.add_argument("--spawn", choices=["subprocess", "inprocess", "none"], default="subprocess")
+    parser.add_argument("--url", help="--spawn none 时压测的服务器地址，如 ws://127.0.0.1:8000")
+    parser.add_argument("--scenario", choices=["call", "churn", "storm"], default="call")
+    parser.add_argument("--pairs", type=int, default=500)
+    parser.add_argument("--iterations", type=int, default=3, help="churn 场景每对用户重复的次数")
+    parser.add_argument("--ice", type=int, default=4, help="每个用户发送的 ICE candidate 数")
+    parser.add_argument("--concurrency", type=int, default=1000, help="同时建立中的用户对上限")
+    parser.add_argument("--quiet-server", action="store_true", help="丢弃服务器输出")
+    args = parser.parse_args()
+
+    raise_fd_limit()
+    server_proc = server = server_task = None
+    if args.spawn == "none":
+        if not args.url:
+            parser.error("--spawn none 需要同时指定 --url")
+        args.base_url = args.url.rstrip("/")
+        host_port = args.base_url.split("://", 1)[1]
+        args.host, port = host_port.split(":") if ":" in host_port else (host_port, "80")
+        args.port = int(port)
+        pid = None
+    else:
+        args.host, args.port = "127.0.0.1", free_port()
+        args.base_url = f"ws://{args.host}:{args.port}"
+        if args.spawn == "subprocess":
+            server_proc = start_subprocess_server(args)
+            pid = server_proc.pid
+        else:
+            server, server_task = await start_inprocess_server(args)
+            pid = os.getpid()
+        await wait_for_port(args.host, args.port)
+
+    stats = Stats()
+    limiter = asyncio.Semaphore(args.concurrency)
+    flow = FLOWS[args.server]
+    before = proc_usage(pid) if pid else None
+    peak_rss = 0
+
+    async def sample_rss():
+        nonlocal peak_rss
+        while True:
+            peak_rss = max(peak_rss, proc_usage(pid)[1])
+            await asyncio.sleep(0.2)
+
+    sampler = asyncio.create_task(sample_rss()) if pid else None
+    start = time.perf_counter()
+    try:
+        if args.scenario == "storm":
+            await scenario_storm(args, flow, stats, limiter)
+        else:
+            await scenario_call(args, flow, stats, limiter, args.iterations if args.scenario == "churn" else 1)
+        elapsed = time.perf_counter() - start
+        if pid:
+            report(args, stats, elapsed, proc_usage(pid)[0] - before[0], max(peak_rss - before[1], 0))
+        else:
+            report(args, stats, elapsed, None, None)
+    finally:
+        if sampler:
+            sampler.cancel()
+        if server_proc:
+            server_proc.terminate()
+            server_proc.wait()
+        if server:
+            server.should_exit = True
+            await server_task
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
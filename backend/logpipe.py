@@ -0,0 +1,185 @@
+# logpipe.py - 非阻塞日志管道：事件循环线程只入队，后台线程格式化并写出
+#
+# - 惰性格式化：调用方用 logger.info("用户 %s 加入房间 %s", user_id, room_id)，字符串拼接在后台线程完成
+# - 按事件采样和限流：extra={"event": "join"}；未指定 event 时以消息模板作为事件名
+# - 默认输出 JSON 行；SDP / ICE candidate 默认脱敏，过长字段截断
+#
+# 环境变量:
+#   LOG_LEVEL=INFO  LOG_FORMAT=json|text  LOG_QUEUE_SIZE=10000
+#   LOG_SAMPLE_RATES="join=0.1,leave=0.1,*=1"   WARNING 及以上不采样
+#   LOG_RATE_LIMIT=100      每个事件每秒最多条数，0 表示不限
+#   LOG_REDACT=1            0 关闭脱敏
+#   LOG_MAX_FIELD=200       字符串字段最大长度
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+import time
+from collections import Counter
+from typing import Dict, Optional
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json")
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+LOG_RATE_LIMIT = float(os.getenv("LOG_RATE_LIMIT", "100"))
+LOG_REDACT = os.getenv("LOG_REDACT", "1") != "0"
+LOG_MAX_FIELD = int(os.getenv("LOG_MAX_FIELD", "200"))
+
+# 值会被整体替换的字段
+REDACTED_KEYS = {"sdp", "candidate"}
+MAX_DEPTH = 4
+MAX_ITEMS = 20
+
+# LogRecord 自带的属性，剩下的才是 extra 字段
+_RECORD_ATTRS = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime", "event"}
+
+
+def parse_sample_rates(spec: str) -> Dict[str, float]:
+    rates = {}
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        event, _, rate = item.partition("=")
+        rates[event.strip()] = float(rate)
+    return rates
+
+
+def redact(value, depth: int = 0):
+    """复制一份可安全交给后台线程的快照，同时脱敏 / 截断"""
+    if depth >= MAX_DEPTH:
+        return "…"
+    if isinstance(value, dict):
+        result = {}
+        for key, item in list(value.items())[:MAX_ITEMS]:
+            if LOG_REDACT and key in REDACTED_KEYS and item is not None:
+                size = len(item) if isinstance(item, str) else len(json.dumps(item, default=str))
+                result[key] = f"<{key} {size} bytes>"
+            else:
+                result[key] = redact(item, depth + 1)
+        return result
+    if isinstance(value, (list, tuple, set)):
+        return [redact(item, depth + 1) for item in list(value)[:MAX_ITEMS]]
+    if isinstance(value, str) and LOG_REDACT and len(value) > LOG_MAX_FIELD:
+        return f"{value[:LOG_MAX_FIELD]}…(+{len(value) - LOG_MAX_FIELD})"
+    return value
+
+
+class SamplingFilter(logging.Filter):
+    """按事件概率采样 + 令牌桶限流，在调用线程上执行，只做计数和比较"""
+
+    def __init__(self, rates: Dict[str, float], rate_limit: float):
+        super().__init__()
+        self.rates = rates
+        self.default_rate = rates.get("*", 1.0)
+        self.rate_limit = rate_limit
+        self.buckets: Dict[str, list] = {}
+        self.suppressed: Counter = Counter()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        event = getattr(record, "event", None) or str(record.msg)
+        if record.levelno < logging.WARNING:
+            rate = self.rates.get(event, self.default_rate)
+            if rate < 1.0 and random.random() >= rate:
+                self.suppressed[event] += 1
+                return False
+        if self.rate_limit > 0:
+            now = time.monotonic()
+            bucket = self.buckets.get(event)
+            if bucket is None:
+                bucket = self.buckets[event] = [self.rate_limit, now]
+            bucket[0] = min(self.rate_limit, bucket[0] + (now - bucket[1]) * self.rate_limit)
+            bucket[1] = now
+            if bucket[0] < 1:
+                self.suppressed[event] += 1
+                return False
+            bucket[0] -= 1
+        return True
+
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """队列满时直接丢弃并计数，不阻塞事件循环"""
+
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # 不在这里拼接消息；可变参数先做快照，避免后台线程读到正在被修改的对象
+        if record.args:
+            if isinstance(record.args, dict):
+                record.args = redact(record.args)
+            else:
+                record.args = tuple(
+                    redact(arg) if isinstance(arg, (dict, list, tuple, set, str)) else arg
+                    for arg in record.args
+                )
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": round(record.created, 3),
+            "level": record.levelname,
+            "logger": record.name,
+            "event": getattr(record, "event", None),
+            "msg": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRS:
+                entry[key] = redact(value)
+        if record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+_listener: Optional[logging.handlers.QueueListener] = None
+_handler: Optional[NonBlockingQueueHandler] = None
+_sampler: Optional[SamplingFilter] = None
+
+
+def setup_logging(level: str = LOG_LEVEL):
+    """替换 logging.basicConfig：根 logger 只挂一个非阻塞的队列 handler"""
+    global _listener, _handler, _sampler
+    if _listener is not None:
+        return
+    stream = logging.StreamHandler(sys.stderr)
+    if LOG_FORMAT == "json":
+        stream.setFormatter(JsonFormatter())
+    else:
+        stream.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+
+    log_queue = queue.Queue(LOG_QUEUE_SIZE)
+    _sampler = SamplingFilter(parse_sample_rates(os.getenv("LOG_SAMPLE_RATES", "")), LOG_RATE_LIMIT)
+    _handler = NonBlockingQueueHandler(log_queue)
+    _handler.addFilter(_sampler)
+
+    root = logging.getLogger()
+    root.handlers[:] = [_handler]
+    root.setLevel(level)
+
+    _listener = logging.handlers.QueueListener(log_queue, stream)
+    _listener.start()
+    atexit.register(_listener.stop)
+
+
+def stats() -> dict:
+    """日志管道自身的计数：被采样 / 限流掉的条数、队列满丢弃的条数"""
+    if _handler is None:
+        return {}
+    return {
+        "queued": _handler.queue.qsize(),
+        "dropped": _handler.dropped,
+        "suppressed": dict(_sampler.suppressed),
+    }
@@ -1,16 +1,39 @@
 # simple_server.py - 简化版 FastAPI 服务器，只处理房间模式
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Query, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
+import asyncio
 import logging
-from typing import Dict
+import os
+from typing import Dict, Optional, Set, Tuple
 
-# 配置日志
-logging.basicConfig(level=logging.INFO)
+import fastjson
+from traffic_trace import TraceMiddleware, TraceRecorder
+from expiry import ExpiryWheel
+from logpipe import setup_logging
+from snapshot import StateStore
+
+# 配置日志（队列 + 后台线程写出，见 logpipe.py）
+setup_logging()
 logger = logging.getLogger(__name__)
 
 app = FastAPI(title="简化版 WebRTC 信令服务器")
 
+# 过期时间（秒）：等待匹配的房间、匹配后仍保留的 offer、匹配后的房间
+# （REST 模式没有连接可以判断用户是否还在，被遗弃的已匹配房间靠 ROOM_MATCHED_TTL 回收）
+ROOM_WAITING_TTL = float(os.getenv("ROOM_WAITING_TTL", "300"))
+OFFER_TTL = float(os.getenv("OFFER_TTL", "120"))
+ROOM_MATCHED_TTL = float(os.getenv("ROOM_MATCHED_TTL", "3600"))
+
+# 房间状态快照文件（SQLite），未设置则不持久化
+SNAPSHOT_PATH = os.getenv("SNAPSHOT_PATH")
+
+# 等待匹配：长轮询最长挂起时间、SSE 最长连接时间和保活间隔（秒）
+LONG_POLL_MAX_TIMEOUT = 60
+SSE_MAX_TIMEOUT = 600
+SSE_KEEPALIVE = 15
+
 # 允许跨域
 app.add_middleware(
     CORSMiddleware,
@@ -20,6 +43,11 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# 流量轨迹录制（TRACE_PATH 开启，见 traffic_trace.py），用 replay_trace.py 回放
+trace = TraceRecorder("main")
+if trace.enabled:
+    app.add_middleware(TraceMiddleware, recorder=trace)
+
 
 # 数据模型
 class SDPOffer(BaseModel):
@@ -38,10 +66,16 @@ class RoomManager:
     def __init__(self):
         # 房间数据结构: {room_id: {"users": [user1, user2], "offers": {user1: offer1, user2: offer2}}}
         self.rooms: Dict[str, Dict] = {}
+        # 关闭页面而未调用 leave-room 的用户，靠时间轮回收
+        self.expiry = ExpiryWheel()
+        # 等待匹配的长轮询 / SSE 请求: {(room_id, user_id): {future, ...}}
+        self.waiters: Dict[Tuple[str, str], Set[asyncio.Future]] = {}
+        # 只写变化过的房间，重启后从快照恢复
+        self.state = StateStore(SNAPSHOT_PATH)
 
     def join_room(self, room_id: str, user_id: str, offer: dict):
         """用户加入房间"""
-        logger.info(f"用户 {user_id} 尝试加入房间 {room_id}")
+        logger.info("用户 %s 尝试加入房间 %s", user_id, room_id, extra={"event": "join"})
 
         # 如果房间不存在，创建房间
         if room_id not in self.rooms:
@@ -49,33 +83,66 @@ class RoomManager:
                 "users": [],
                 "offers": {}
             }
-            logger.info(f"创建新房间: {room_id}")
+            logger.info("创建新房间: %s", room_id, extra={"event": "room_created"})
 
         room = self.rooms[room_id]
 
+        # 对方离开时自己的 offer 已过期：重新提交 offer 后继续等待
+        if room["users"] == [user_id] and user_id not in room["offers"]:
+            room["offers"][user_id] = offer
+            self.state.mark("room", room_id)
+            self.expiry.schedule(("room", room_id), ROOM_WAITING_TTL)
+            logger.info("用户 %s 重新提交了房间 %s 的 offer", user_id, room_id, extra={"event": "join"})
+            return {
+                "success": True,
+                "matched": False,
+                "waiting": True,
+                "message": "已更新 offer，等待其他用户加入"
+            }
+
         # 检查房间是否已满（最多2人）
         if len(room["users"]) >= 2:
-            logger.warning(f"房间 {room_id} 已满")
+            logger.warning("房间 %s 已满", room_id, extra={"event": "room_full"})
             return {"success": False, "message": "房间已满（最多2人）"}
 
         # 检查用户是否已在房间中
         if user_id in room["users"]:
-            logger.warning(f"用户 {user_id} 已在房间 {room_id} 中")
+            logger.warning("用户 %s 已在房间 %s 中", user_id, room_id, extra={"event": "join_duplicate"})
             return {"success": False, "message": "您已在此房间中"}
 
+        # 房间里等待的用户还没有可用的 offer，新加入者拿不到 peer_offer
+        if room["users"] and room["users"][0] not in room["offers"]:
+            return {"success": False, "message": "房间内的用户尚未重新提交 offer，请稍后再试"}
+
         # 加入房间
         room["users"].append(user_id)
         room["offers"][user_id] = offer
+        self.state.mark("room", room_id)
 
-        logger.info(f"用户 {user_id} 成功加入房间 {room_id}，当前人数: {len(room['users'])}")
+        logger.info("用户 %s 成功加入房间 %s，当前人数: %d", user_id, room_id, len(room["users"]),
+                    extra={"event": "join"})
 
         # 如果房间有2个人，返回匹配成功
         if len(room["users"]) == 2:
             user1, user2 = room["users"]
             other_user = user2 if user_id == user1 else user1
-            other_offer = room["offers"][other_user]
+            other_offer = room["offers"].get(other_user)
 
-            logger.info(f"房间 {room_id} 匹配成功: {user1} <-> {user2}")
+            # 匹配成功后房间改为 ROOM_MATCHED_TTL 回收，offer 只保留一段时间供对方获取
+            self.expiry.schedule(("room", room_id), ROOM_MATCHED_TTL)
+            self.expiry.schedule(("offer", room_id, user1), OFFER_TTL)
+            self.expiry.schedule(("offer", room_id, user2), OFFER_TTL)
+
+            logger.info("房间 %s 匹配成功: %s <-> %s", room_id, user1, user2, extra={"event": "matched"})
+
+            # 唤醒正在等待的一方，直接把新加入者的 offer 交给它
+            self.notify_waiters(room_id, other_user, {
+                "success": True,
+                "matched": True,
+                "peer_id": user_id,
+                "peer_offer": offer,
+                "message": f"与 {user_id} 匹配成功"
+            })
 
             return {
                 "success": True,
@@ -85,6 +152,7 @@ class RoomManager:
                 "message": f"与 {other_user} 匹配成功"
             }
         else:
+            self.expiry.schedule(("room", room_id), ROOM_WAITING_TTL)
             return {
                 "success": True,
                 "matched": False,
@@ -98,13 +166,113 @@ class RoomManager:
             self.rooms[room_id]["users"].remove(user_id)
             if user_id in self.rooms[room_id]["offers"]:
                 del self.rooms[room_id]["offers"][user_id]
+            self.expiry.cancel(("offer", room_id, user_id))
+            self.state.mark("room", room_id)
 
-            # 如果房间空了，删除房间
+            # 如果房间空了，删除房间；否则重新进入等待状态
             if len(self.rooms[room_id]["users"]) == 0:
                 del self.rooms[room_id]
-                logger.info(f"删除空房间: {room_id}")
-
-            logger.info(f"用户 {user_id} 离开房间 {room_id}")
+                self.expiry.cancel(("room", room_id))
+                logger.info("删除空房间: %s", room_id, extra={"event": "room_deleted"})
+            else:
+                self.expiry.schedule(("room", room_id), ROOM_WAITING_TTL)
+                # 重新等待：留下的用户的 offer 要一直保留给下一个加入者；已经过期的需要重新提交
+                remaining = self.rooms[room_id]["users"][0]
+                self.expiry.cancel(("offer", room_id, remaining))
+                if remaining not in self.rooms[room_id]["offers"]:
+                    self.notify_waiters(room_id, remaining, self.offer_required_result())
+
+            logger.info("用户 %s 离开房间 %s", user_id, room_id, extra={"event": "leave"})
+            self.notify_waiters(room_id, user_id, self.closed_result())
+
+    def cancel_room_timers(self, room_id: str):
+        """取消房间及其 offer 的所有定时器"""
+        self.expiry.cancel(("room", room_id))
+        room = self.rooms.get(room_id)
+        if room:
+            for user_id in room["users"]:
+                self.expiry.cancel(("offer", room_id, user_id))
+
+    def close_room(self, room_id: str):
+        """删除房间，并让仍在等待的请求返回"""
+        self.cancel_room_timers(room_id)
+        room = self.rooms.pop(room_id)
+        self.state.mark("room", room_id)
+        for user_id in room["users"]:
+            self.notify_waiters(room_id, user_id, self.closed_result())
+
+    @staticmethod
+    def closed_result() -> dict:
+        return {"success": False, "matched": False, "message": "房间已关闭或您不在房间中"}
+
+    @staticmethod
+    def offer_required_result() -> dict:
+        return {"success": True, "matched": False, "waiting": True, "offer_required": True,
+                "message": "对方已离开，请通过 join-room 重新提交 offer"}
+
+    def match_state(self, room_id: str, user_id: str) -> Optional[dict]:
+        """已匹配或已不在房间时返回结果；仍在等待时返回 None"""
+        room = self.rooms.get(room_id)
+        if room is None or user_id not in room["users"]:
+            return self.closed_result()
+        if len(room["users"]) < 2:
+            return None if user_id in room["offers"] else self.offer_required_result()
+        peer_id = next(u for u in room["users"] if u != user_id)
+        return {
+            "success": True,
+            "matched": True,
+            "peer_id": peer_id,
+            "peer_offer": room["offers"].get(peer_id),
+            "message": f"与 {peer_id} 匹配成功"
+        }
+
+    def add_waiter(self, room_id: str, user_id: str) -> asyncio.Future:
+        future = asyncio.get_running_loop().create_future()
+        self.waiters.setdefault((room_id, user_id), set()).add(future)
+        return future
+
+    def remove_waiter(self, room_id: str, user_id: str, future: asyncio.Future):
+        key = (room_id, user_id)
+        waiters = self.waiters.get(key)
+        if waiters is not None:
+            waiters.discard(future)
+            if not waiters:
+                del self.waiters[key]
+
+    def notify_waiters(self, room_id: str, user_id: str, result: dict):
+        for future in self.waiters.pop((room_id, user_id), ()):
+            if not future.done():
+                future.set_result(result)
+
+    def expire(self, key: tuple):
+        """时间轮到期回调"""
+        kind, room_id = key[0], key[1]
+        room = self.rooms.get(room_id)
+        if room is None:
+            return
+        if kind == "room":
+            matched = len(room["users"]) >= 2
+            self.close_room(room_id)
+            logger.info("回收超时%s的房间: %s", "" if matched else "未匹配", room_id, extra={"event": "expired"})
+        elif kind == "offer":
+            room["offers"].pop(key[2], None)
+            self.state.mark("room", room_id)
+
+    def snapshot_value(self, kind: str, room_id: str) -> Optional[dict]:
+        room = self.rooms.get(room_id)
+        return None if room is None else {"users": room["users"], "offers": room["offers"]}
+
+    def restore(self) -> int:
+        """从快照恢复房间；定时器重新从头计时"""
+        for room_id, room in self.state.load("room").items():
+            self.rooms[room_id] = {"users": room["users"], "offers": room["offers"]}
+            if len(room["users"]) < 2:
+                self.expiry.schedule(("room", room_id), ROOM_WAITING_TTL)
+            else:
+                self.expiry.schedule(("room", room_id), ROOM_MATCHED_TTL)
+                for user_id in room["offers"]:
+                    self.expiry.schedule(("offer", room_id, user_id), OFFER_TTL)
+        return len(self.rooms)
 
     def get_room_info(self, room_id: str):
         """获取房间信息"""
@@ -133,6 +301,20 @@ class RoomManager:
 room_manager = RoomManager()
 
 
+@app.on_event("startup")
+async def start_expiry():
+    if room_manager.state.enabled:
+        logger.info("从快照恢复了 %d 个房间", room_manager.restore(), extra={"event": "restore"})
+        app.state.snapshot_task = asyncio.create_task(room_manager.state.run(room_manager.snapshot_value))
+    app.state.expiry_task = asyncio.create_task(room_manager.expiry.run(room_manager.expire))
+
+
+@app.on_event("shutdown")
+async def save_snapshot():
+    room_manager.state.flush_sync(room_manager.snapshot_value)
+    trace.stop()
+
+
 # API 端点
 @app.get("/")
 async def root():
@@ -144,7 +326,7 @@ async def root():
 async def join_room(request: JoinRoomRequest):
     """加入房间 API"""
     try:
-        logger.info(f"收到加入房间请求: {request.userId} -> {request.roomId}")
+        logger.info("收到加入房间请求: %s -> %s", request.userId, request.roomId, extra={"event": "join"})
 
         result = room_manager.join_room(
             request.roomId,
@@ -152,11 +334,11 @@ async def join_room(request: JoinRoomRequest):
             request.offer.model_dump()
         )
 
-        logger.info(f"加入房间结果: {result}")
+        logger.info("加入房间结果: %s", result, extra={"event": "join"})
         return result
 
     except Exception as e:
-        logger.error(f"加入房间失败: {e}")
+        logger.error("加入房间失败: %s", e, extra={"event": "error"})
         raise HTTPException(status_code=500, detail=f"服务器错误: {str(e)}")
 
 @app.get("/api/rooms")
@@ -164,6 +346,11 @@ async def get_all_rooms():
     """获取所有房间信息（调试用）"""
     return {"rooms": room_manager.get_all_rooms(), "total_rooms": len(room_manager.rooms)}
 
+@app.get("/api/expiry-stats")
+async def get_expiry_stats():
+    """过期回收统计"""
+    return {**room_manager.expiry.stats(), "snapshot": room_manager.state.stats()}
+
 @app.get("/api/online-users/{user_id}")
 async def get_online_users(user_id: str):
     return {"users": [], "message": "服务器连接正常"}
@@ -174,10 +361,80 @@ async def leave_room(room_id: str, user_id: str):
         room_manager.leave_room(room_id, user_id)
         return {"success": True, "message": f"用户 {user_id} 已离开房间 {room_id}"}
     except Exception as e:
-        logger.error(f"离开房间失败: {e}")
+        logger.error("离开房间失败: %s", e, extra={"event": "error"})
         raise HTTPException(status_code=500, detail=f"服务器错误: {str(e)}")
 
 
+async def wait_for_disconnect(request: Request):
+    while True:
+        message = await request.receive()
+        if message["type"] == "http.disconnect":
+            return
+
+
+@app.get("/api/wait-match/{room_id}/{user_id}")
+async def wait_match(
+    room_id: str,
+    user_id: str,
+    request: Request,
+    timeout: float = Query(25, gt=0, le=LONG_POLL_MAX_TIMEOUT)
+):
+    """长轮询：第二个用户加入的瞬间返回对方的 offer，超时返回 waiting"""
+    state = room_manager.match_state(room_id, user_id)
+    if state is not None:
+        return state
+
+    future = room_manager.add_waiter(room_id, user_id)
+    disconnect = asyncio.ensure_future(wait_for_disconnect(request))
+    try:
+        await asyncio.wait({future, disconnect}, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+        if future.done():
+            return future.result()
+        return {"success": True, "matched": False, "waiting": True, "message": "等待其他用户加入"}
+    finally:
+        disconnect.cancel()
+        room_manager.remove_waiter(room_id, user_id, future)
+
+
+@app.get("/api/wait-match/{room_id}/{user_id}/events")
+async def wait_match_events(
+    room_id: str,
+    user_id: str,
+    timeout: float = Query(300, gt=0, le=SSE_MAX_TIMEOUT)
+):
+    """SSE：先推送 waiting，匹配成功推送 matched，需要重新提交 offer 推送 offer_required，
+    房间关闭推送 closed，超时推送 timeout"""
+    async def event_stream():
+        state = room_manager.match_state(room_id, user_id)
+        if state is None:
+            # 客户端断开时 StreamingResponse 会取消生成器，finally 负责清理
+            future = room_manager.add_waiter(room_id, user_id)
+            try:
+                yield "event: waiting\ndata: {}\n\n"
+                loop = asyncio.get_running_loop()
+                deadline = loop.time() + timeout
+                while not future.done() and loop.time() < deadline:
+                    try:
+                        await asyncio.wait_for(asyncio.shield(future), min(SSE_KEEPALIVE, deadline - loop.time()))
+                    except asyncio.TimeoutError:
+                        yield ": keepalive\n\n"
+                state = future.result() if future.done() else None
+            finally:
+                room_manager.remove_waiter(room_id, user_id, future)
+
+        if state is None:
+            yield "event: timeout\ndata: {}\n\n"
+        else:
+            event = "matched" if state["matched"] else "offer_required" if state.get("offer_required") else "closed"
+            yield f"event: {event}\ndata: {fastjson.dumps(state)}\n\n"
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
 @app.get("/api/room/{room_id}")
 async def get_room_info(room_id: str):
     """获取房间信息"""
@@ -194,8 +451,10 @@ async def reset_all_rooms():
     """重置所有房间（调试用）"""
     rooms = room_manager.rooms
     room_count = len(rooms)
-    rooms.clear()
-    print(f"🧹 已清空所有房间，共清理了 {room_count} 个房间")
+    for room_id in list(rooms):
+        room_manager.close_room(room_id)
+    room_manager.expiry.clear()
+    logger.info("已清空所有房间，共清理了 %d 个房间", room_count, extra={"event": "reset"})
     return {"success": True, "message": f"已清空 {room_count} 个房间", "rooms_cleared": room_count}
 
 @app.delete("/api/reset-room/{room_id}")
@@ -203,8 +462,8 @@ async def reset_single_room(room_id: str):
     """重置指定房间"""
     rooms = room_manager.rooms
     if room_id in rooms:
-        del rooms[room_id]
-        print(f"🧹 已清空房间: {room_id}")
+        room_manager.close_room(room_id)
+        logger.info("已清空房间: %s", room_id, extra={"event": "reset"})
         return {"success": True, "message": f"已清空房间 {room_id}"}
     else:
         return {"success": False, "message": f"房间 {room_id} 不存在"}
@@ -0,0 +1,85 @@
+# matchmaking.py - 服务器端匹配队列：按属性分桶的 FIFO，入队 / 取消 / 配对均为 O(1)
+import time
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+from expiry import ExpiryWheel
+
+# 限制属性数量和长度，避免客户端制造大量桶；超出时拒绝而不是截断，截断会让属性不同的用户落进同一个桶
+MAX_ATTRIBUTES = 4
+MAX_ATTRIBUTE_LENGTH = 32
+
+
+def bucket_key(attributes: Optional[dict]) -> Tuple:
+    """只有属性完全相同的用户才会被配对；属性不合法时抛出 ValueError"""
+    if attributes is None:
+        return ()
+    if not isinstance(attributes, dict):
+        raise ValueError("attributes 必须是对象")
+    if len(attributes) > MAX_ATTRIBUTES:
+        raise ValueError(f"attributes 最多 {MAX_ATTRIBUTES} 项")
+    items = sorted((str(k), str(v)) for k, v in attributes.items())
+    if any(len(k) > MAX_ATTRIBUTE_LENGTH or len(v) > MAX_ATTRIBUTE_LENGTH for k, v in items):
+        raise ValueError(f"attributes 的键和值最长 {MAX_ATTRIBUTE_LENGTH} 个字符")
+    return tuple(items)
+
+
+class MatchQueue:
+    def __init__(self, timeout: float):
+        self.timeout = timeout
+        # 桶: {属性: OrderedDict(user_id -> 入队时间)}，先入队的先配对
+        self.buckets: Dict[Tuple, OrderedDict] = {}
+        self.waiting: Dict[str, Tuple] = {}
+        self.timeouts = ExpiryWheel()
+        self.matched = 0
+        self.timed_out = 0
+
+    def __len__(self):
+        return len(self.waiting)
+
+    def __contains__(self, user_id: str):
+        return user_id in self.waiting
+
+    def enqueue(self, user_id: str, attributes: Optional[dict] = None) -> Optional[Tuple[str, float]]:
+        """入队；同桶里已有人等待时直接出队并返回 (对方, 对方等待秒数)；属性不合法时抛出 ValueError"""
+        key = bucket_key(attributes)
+        self.remove(user_id)
+        bucket = self.buckets.get(key)
+        if bucket:
+            peer, enqueued_at = bucket.popitem(last=False)
+            if not bucket:
+                del self.buckets[key]
+            del self.waiting[peer]
+            self.timeouts.cancel(("match", peer))
+            self.matched += 1
+            return peer, time.monotonic() - enqueued_at
+        self.buckets.setdefault(key, OrderedDict())[user_id] = time.monotonic()
+        self.waiting[user_id] = key
+        self.timeouts.schedule(("match", user_id), self.timeout)
+        return None
+
+    def remove(self, user_id: str) -> bool:
+        key = self.waiting.pop(user_id, None)
+        if key is None:
+            return False
+        bucket = self.buckets[key]
+        del bucket[user_id]
+        if not bucket:
+            del self.buckets[key]
+        self.timeouts.cancel(("match", user_id))
+        return True
+
+    def expire(self, user_id: str) -> bool:
+        """等待超时出队"""
+        if self.remove(user_id):
+            self.timed_out += 1
+            return True
+        return False
+
+    def stats(self) -> dict:
+        return {
+            "waiting": len(self.waiting),
+            "buckets": len(self.buckets),
+            "matched": self.matched,
+            "timed_out": self.timed_out,
+        }
@@ -0,0 +1,155 @@
+# metrics.py - 信令服务器指标：固定桶直方图 + 计数器，输出 Prometheus 文本格式
+#
+# 热路径上每条消息只有一次 bisect 和几次整数加法，可以常开。
+# 标签只取有限集合（未知消息类型归入 "other"），避免客户端乱发 type 撑爆内存。
+import asyncio
+import math
+import time
+from bisect import bisect_left
+from collections import Counter
+from typing import Dict, Iterable, List, Optional, Sequence
+
+# 秒
+LATENCY_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0)
+LOOP_LAG_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+ROOM_LIFETIME_BUCKETS = (1, 5, 10, 30, 60, 300, 600, 1800, 3600, 7200, 21600)
+
+LOOP_LAG_INTERVAL = 0.5
+
+
+class Histogram:
+    def __init__(self, buckets: Sequence[float]):
+        self.buckets = tuple(buckets)
+        # 最后一个是 +Inf
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q: float) -> Optional[float]:
+        """按桶上界估算分位数，够容量规划用；没有样本时返回 None，落在 +Inf 桶时返回 inf"""
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return math.inf
+
+    def render(self, name: str, labels: str = "") -> List[str]:
+        prefix = f"{labels}," if labels else ""
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{{{prefix}le="{bound}"}} {cumulative}')
+        lines.append(f'{name}_bucket{{{prefix}le="+Inf"}} {self.count}')
+        suffix = f"{{{labels}}}" if labels else ""
+        lines.append(f"{name}_sum{suffix} {self.sum:.6f}")
+        lines.append(f"{name}_count{suffix} {self.count}")
+        return lines
+
+    def summary(self) -> dict:
+        return {
+            "count": self.count,
+            "mean": round(self.sum / self.count, 6) if self.count else None,
+            "p50": self._json_quantile(0.5),
+            "p99": self._json_quantile(0.99),
+        }
+
+    def _json_quantile(self, q: float):
+        """JSON 不能表示 inf，落在 +Inf 桶时输出 ">最大上界" 字符串"""
+        value = self.quantile(q)
+        if value is not None and math.isinf(value):
+            return f">{self.buckets[-1]}"
+        return value
+
+
+class SignalingMetrics:
+    def __init__(self, message_types: Iterable[str]):
+        self.message_types = frozenset(message_types)
+        self.messages: Counter = Counter()
+        self.latency: Dict[str, Histogram] = {}
+        self.send_failures = 0
+        # 超出消息预算被丢弃的消息数，按范围（user / room）
+        self.rate_limited: Counter = Counter()
+        # 情绪推送：published 为收到的结果数，coalesced 为被同一发送者更新的结果覆盖、没有发出的条数
+        self.emotion_updates: Counter = Counter()
+        self.connections_opened = 0
+        self.connections_closed: Counter = Counter()
+        self.room_lifetime = Histogram(ROOM_LIFETIME_BUCKETS)
+        self.loop_lag = Histogram(LOOP_LAG_BUCKETS)
+        self.loop_lag_max = 0.0
+        self.started = time.time()
+
+    def observe_message(self, message_type: Optional[str], received: float):
+        """received 是 time.perf_counter() 记录的收到时刻，到处理（含发送）完成为止"""
+        label = message_type if message_type in self.message_types else "other"
+        self.messages[label] += 1
+        histogram = self.latency.get(label)
+        if histogram is None:
+            histogram = self.latency[label] = Histogram(LATENCY_BUCKETS)
+        histogram.observe(time.perf_counter() - received)
+
+    async def monitor_loop_lag(self, interval: float = LOOP_LAG_INTERVAL):
+        """sleep 实际醒来时间比预期晚多少，就是事件循环被阻塞了多久"""
+        loop = asyncio.get_running_loop()
+        while True:
+            expected = loop.time() + interval
+            await asyncio.sleep(interval)
+            lag = max(0.0, loop.time() - expected)
+            self.loop_lag.observe(lag)
+            self.loop_lag_max = max(self.loop_lag_max, lag)
+
+    def render(self, gauges: Dict[str, float]) -> str:
+        lines = [
+            "# TYPE signaling_messages_total counter",
+            *(f'signaling_messages_total{{type="{t}"}} {n}' for t, n in sorted(self.messages.items())),
+            "# TYPE signaling_message_latency_seconds histogram",
+        ]
+        for label, histogram in sorted(self.latency.items()):
+            lines += histogram.render("signaling_message_latency_seconds", f'type="{label}"')
+        lines += [
+            "# TYPE signaling_send_failures_total counter",
+            f"signaling_send_failures_total {self.send_failures}",
+            "# TYPE signaling_rate_limited_total counter",
+            *(f'signaling_rate_limited_total{{scope="{s}"}} {n}' for s, n in sorted(self.rate_limited.items())),
+            "# TYPE signaling_emotion_updates_total counter",
+            *(f'signaling_emotion_updates_total{{result="{r}"}} {n}'
+              for r, n in sorted(self.emotion_updates.items())),
+            "# TYPE signaling_connections_opened_total counter",
+            f"signaling_connections_opened_total {self.connections_opened}",
+            "# TYPE signaling_connections_closed_total counter",
+            *(f'signaling_connections_closed_total{{reason="{r}"}} {n}'
+              for r, n in sorted(self.connections_closed.items())),
+            "# TYPE signaling_room_lifetime_seconds histogram",
+            *self.room_lifetime.render("signaling_room_lifetime_seconds"),
+            "# TYPE signaling_event_loop_lag_seconds histogram",
+            *self.loop_lag.render("signaling_event_loop_lag_seconds"),
+            "# TYPE signaling_event_loop_lag_max_seconds gauge",
+            f"signaling_event_loop_lag_max_seconds {self.loop_lag_max:.6f}",
+        ]
+        for name, value in gauges.items():
+            lines += [f"# TYPE signaling_{name} gauge", f"signaling_{name} {value}"]
+        return "\n".join(lines) + "\n"
+
+    def summary(self, gauges: Dict[str, float]) -> dict:
+        return {
+            "uptime": round(time.time() - self.started, 1),
+            "messages": dict(self.messages),
+            "latency": {label: h.summary() for label, h in self.latency.items()},
+            "send_failures": self.send_failures,
+            "rate_limited": dict(self.rate_limited),
+            "emotion_updates": dict(self.emotion_updates),
+            "connections_opened": self.connections_opened,
+            "connections_closed": dict(self.connections_closed),
+            "room_lifetime": self.room_lifetime.summary(),
+            "event_loop_lag": {**self.loop_lag.summary(), "max": round(self.loop_lag_max, 6)},
+            **gauges,
+        }
@@ -0,0 +1,161 @@
+# replay_cadence.py - 离线回放：比较固定间隔采样和自适应采样（emotion_api/cadence.py）
+# 用法: python replay_cadence.py [--trace frames.jsonl] [--sessions 200] [--minutes 10] [--fixed-ms 1000]
+#
+# --trace: 按固定频率采集的真实推理结果，每行 {"session": "...", "t": 秒, "label": "...", "confidence": 0.83}，
+#          回放时把它当作“真实情绪”，在任意时刻取该时刻之前最近的一帧。
+# 不给 trace 时生成合成会话：情绪片段时长服从指数分布，片段交界前后置信度下降，另有少量低置信度误判。
+#
+# 输出：推理次数、变化检测延迟（真实情绪变化到第一次采样看到新标签）、漏检的短暂变化、
+# 以及“显示错误时间占比”（客户端当前显示的标签与真实情绪不一致的时间比例）。
+import argparse
+import bisect
+import json
+import random
+import statistics
+from collections import defaultdict
+
+from emotion_api.cadence import CadenceController
+
+LABELS = ("positive", "neutral", "negative")
+
+
+class Session:
+    """真实情绪是阶梯函数；observe 返回模型在该时刻的输出（标签, 置信度）"""
+
+    def __init__(self, times, labels, confidences, duration, noise=None):
+        self.times = times
+        self.labels = labels
+        self.confidences = confidences
+        self.duration = duration
+        self.noise = noise
+
+    def truth(self, t):
+        return self.labels[max(bisect.bisect_right(self.times, t) - 1, 0)]
+
+    def observe(self, t):
+        i = max(bisect.bisect_right(self.times, t) - 1, 0)
+        if self.noise:
+            return self.noise(t, self.labels[i], self.confidences[i], self.times)
+        return self.labels[i], self.confidences[i]
+
+    def changes(self):
+        return [(self.times[i], self.labels[i]) for i in range(1, len(self.times))
+                if self.labels[i] != self.labels[i - 1]]
+
+
+def synthetic_sessions(count, minutes, mean_segment, seed):
+    rng = random.Random(seed)
+    sessions = []
+    for _ in range(count):
+        duration = minutes * 60
+        times, labels, confidences = [0.0], [rng.choice(LABELS)], [rng.uniform(0.75, 0.95)]
+        while times[-1] < duration:
+            times.append(times[-1] + rng.expovariate(1 / mean_segment))
+            labels.append(rng.choice([label for label in LABELS if label != labels[-1]]))
+            confidences.append(rng.uniform(0.75, 0.95))
+
+        def noise(t, label, confidence, times, rng=random.Random(rng.random())):
+            # 片段交界前后 2 秒内置信度下降；5% 的帧是低置信度误判
+            i = bisect.bisect_right(times, t)
+            near = min(abs(t - times[i - 1]), abs(times[i] - t) if i < len(times) else 1e9)
+            if near < 2:
+                confidence = min(confidence, 0.5 + 0.1 * near)
+            if rng.random() < 0.05:
+                return rng.choice([other for other in LABELS if other != label]), rng.uniform(0.4, 0.6)
+            return label, confidence
+
+        sessions.append(Session(times, labels, confidences, duration, noise))
+    return sessions
+
+
+def trace_sessions(path):
+    frames = defaultdict(list)
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                frame = json.loads(line)
+                frames[frame["session"]].append((frame["t"], frame["label"], frame.get("confidence")))
+    sessions = []
+    for items in frames.values():
+        items.sort()
+        start = items[0][0]
+        times = [t - start for t, _, _ in items]
+        sessions.append(Session(times, [label for _, label, _ in items], [c for _, _, c in items],
+                                times[-1] + (times[-1] - times[-2] if len(times) > 1 else 1)))
+    return sessions
+
+
+def replay(sessions, next_interval):
+    """next_interval(session_id, label, confidence) -> 毫秒"""
+    samples = 0
+    delays, missed, wrong_time, total_time = [], 0, 0.0, 0.0
+    for n, session in enumerate(sessions):
+        sample_times, shown = [], []
+        t = 0.0
+        while t < session.duration:
+            label, confidence = session.observe(t)
+            sample_times.append(t)
+            shown.append(label)
+            t += next_interval(f"s{n}", label, confidence) / 1000
+        samples += len(sample_times)
+
+        changes = session.changes()
+        for i, (change_at, label) in enumerate(changes):
+            until = changes[i + 1][0] if i + 1 < len(changes) else session.duration
+            j = bisect.bisect_left(sample_times, change_at)
+            while j < len(sample_times) and sample_times[j] < until and shown[j] != label:
+                j += 1
+            if j < len(sample_times) and sample_times[j] < until:
+                delays.append(sample_times[j] - change_at)
+            else:
+                missed += 1
+
+        # 显示错误时间：把时间轴按采样点和真实变化点切段逐段比较
+        points = sorted(set(sample_times) | {c for c, _ in changes} | {session.duration})
+        for a, b in zip(points, points[1:]):
+            k = bisect.bisect_right(sample_times, a) - 1
+            if shown[k] != session.truth(a):
+                wrong_time += b - a
+            total_time += b - a
+
+    delays.sort()
+    return {
+        "samples": samples,
+        "delay_mean": statistics.mean(delays) if delays else 0.0,
+        "delay_p95": delays[int(len(delays) * 0.95)] if delays else 0.0,
+        "missed": missed,
+        "wrong": wrong_time / total_time if total_time else 0.0,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--trace")
+    parser.add_argument("--sessions", type=int, default=200)
+    parser.add_argument("--minutes", type=float, default=10)
+    parser.add_argument("--mean-segment", type=float, default=30, help="合成会话中情绪片段的平均时长（秒）")
+    parser.add_argument("--fixed-ms", type=int, default=1000)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    sessions = (trace_sessions(args.trace) if args.trace
+                else synthetic_sessions(args.sessions, args.minutes, args.mean_segment, args.seed))
+
+    controller = CadenceController()
+    adaptive = replay(sessions, lambda s, label, conf: controller.recommend(s, label, conf))
+    fixed = replay(sessions, lambda s, label, conf: args.fixed_ms)
+    # 同样的推理预算下的固定间隔，用来区分“少采样”和“采样时机更好”
+    total = sum(session.duration for session in sessions)
+    same_budget_ms = int(total / adaptive["samples"] * 1000)
+    same_budget = replay(sessions, lambda s, label, conf: same_budget_ms)
+
+    print(f"{'策略':<22}{'推理次数':>10}{'检测延迟均值':>14}{'p95':>8}{'漏检':>7}{'显示错误':>10}")
+    for name, result in ((f"固定 {args.fixed_ms}ms", fixed), ("自适应", adaptive),
+                         (f"固定 {same_budget_ms}ms（同预算）", same_budget)):
+        print(f"{name:<22}{result['samples']:>10}{result['delay_mean']:>13.2f}s{result['delay_p95']:>7.2f}s"
+              f"{result['missed']:>7}{result['wrong']:>10.1%}")
+    print(f"自适应相对固定 {args.fixed_ms}ms 减少推理 {1 - adaptive['samples'] / fixed['samples']:.0%}")
+
+
+if __name__ == "__main__":
+    main()
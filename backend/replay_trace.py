@@ -0,0 +1,460 @@
+# replay_trace.py - 按录制的流量轨迹（traffic_trace.py）回放，比较两个代码版本的延迟和资源占用
+#
+# 用法（在 backend 目录下）:
+#   python replay_trace.py trace.jsonl.gz --speed 10                      # 回放到当前代码
+#   python replay_trace.py trace.jsonl.gz --speed 10 --baseline main      # 再用 git 的 main 分支回放一次并对比
+#   python replay_trace.py trace.jsonl.gz --baseline ../old-checkout/backend
+#   python replay_trace.py trace.jsonl.gz --url ws://127.0.0.1:8000       # 回放到已在运行的服务器
+#
+# 服务器默认取轨迹头里的 source（websocket_server / complex_server / main / cohost / emotion_api），
+# 每个版本各自在子进程里启动，回放时不开启录制。
+# 轨迹里的 "#" 伪名 ID 原样作为用户 / 房间 ID 使用；SDP、candidate、文本、图像按记录的形状合成同等大小的内容。
+#
+# 延迟:
+#   - offer / answer / ice-candidate：合成内容里带序号，从发送到对端收到
+#   - join-room、ping、match-request：从发送到收到对应回复
+#   - HTTP：完整请求耗时，按路径模板分组
+# 资源：服务器进程 CPU 秒数和峰值常驻内存（/proc）
+import argparse
+import asyncio
+import io
+import json
+import os
+import random
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
+
+import websockets
+
+import binproto
+from traffic_trace import read_trace
+from loadtest import free_port, percentile, proc_usage, raise_fd_limit, wait_for_port
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+# 轨迹头里的 source -> (工作目录, uvicorn 目标, 额外参数)
+SERVERS = {
+    "websocket_server": ("", "websocket_server:app", ()),
+    "complex_server": ("", "complex_server:app", ()),
+    "main": ("", "main:app", ()),
+    "cohost": ("", "cohost:create_app", ("--factory",)),
+    "emotion_api": ("emotion_api", "main:app", ()),
+}
+REPLIES = {
+    "join-room": ("room-joined", "error"),
+    "ping": ("pong",),
+    "match-request": ("match-queued", "match-found"),
+}
+RELAY_TYPES = {"offer", "answer", "ice-candidate", "ice_candidate"}
+SEQ = re.compile(r"seq(\d+)")
+
+
+def pseudonym_id(value: str) -> str:
+    # "#" 开头的伪名不能直接放进 URL
+    return "p" + value[1:]
+
+
+def make_sdp(length: int, lines: int, media: int, candidates: int, seq: int) -> str:
+    body = ["v=0", f"o=- {seq} 2 IN IP4 127.0.0.1", f"s=seq{seq}", "t=0 0"]
+    body += ["m=video 9 UDP/TLS/RTP/SAVPF 96"] * media
+    body += [f"a=candidate:{i} 1 udp 2122260223 10.0.{i // 250}.{i % 250 + 1} {50000 + i} typ host"
+             for i in range(candidates)]
+    while len(body) < lines - 1:
+        body.append(f"a=rtpmap:{96 + len(body) % 32} VP8/90000")
+    sdp = "\r\n".join(body) + "\r\n"
+    if len(sdp) < length:
+        sdp += "a=x-pad:" + "0" * max(length - len(sdp) - 10, 0) + "\r\n"
+    return sdp
+
+
+def make_candidate(length: int, kind: str, seq: int) -> str:
+    candidate = f"candidate:seq{seq} 1 udp 2122260223 10.0.0.1 50000 typ {kind or 'host'}"
+    if len(candidate) < length:
+        candidate += " generation 0 ufrag " + "x" * max(length - len(candidate) - 19, 0)
+    return candidate
+
+
+def make_image(length: int) -> bytes:
+    """合成大小接近 length 的 JPEG；没有 Pillow 时退回随机字节（图像服务会返回错误）"""
+    if Image is None or length < 1000:
+        return os.urandom(length)
+    side = max(16, int((length / 0.6) ** 0.5))
+    image = Image.effect_noise((side, side), 40).convert("RGB")
+    buffer = io.BytesIO()
+    image.save(buffer, format="JPEG", quality=75)
+    return buffer.getvalue()
+
+
+class Synthesizer:
+    """把记录的形状还原成同等大小的内容；含 SDP / candidate 时打上序号用于测量中转延迟"""
+
+    def __init__(self):
+        self.next_seq = 0
+
+    def build(self, shape, state: dict):
+        if isinstance(shape, dict):
+            return {k: self.build(v, state) for k, v in shape.items()}
+        if isinstance(shape, list):
+            return [self.build(v, state) for v in shape]
+        if not isinstance(shape, str) or shape[:1] not in ("#", "$"):
+            return shape
+        if shape.startswith("#"):
+            return pseudonym_id(shape)
+        kind, _, rest = shape[1:].partition(":")
+        if kind in ("sdp", "cand"):
+            if state.get("seq") is None:
+                state["seq"] = self.next_seq
+                self.next_seq += 1
+            fields = rest.split(":")
+            if kind == "sdp":
+                return make_sdp(*(int(f) for f in fields), state["seq"])
+            return make_candidate(int(fields[0]), fields[1], state["seq"])
+        if kind == "bin":
+            return make_image(int(rest))
+        return "x" * int(kind) if kind.isdigit() else shape
+
+
+class Result:
+    def __init__(self):
+        self.latency: Dict[str, List[float]] = defaultdict(list)
+        self.sent = 0
+        self.received = 0
+        self.errors = 0
+        self.rate_limited = 0
+        self.lost = 0
+        self.cpu: Optional[float] = None
+        self.peak_rss: Optional[int] = None
+        self.elapsed = 0.0
+        self.lag = 0.0
+
+
+class Replayer:
+    def __init__(self, events: List[dict], base_url: str, http_url: str, speed: float, result: Result):
+        self.events = events
+        self.base_url = base_url
+        self.http_url = http_url
+        self.speed = speed
+        self.result = result
+        self.synth = Synthesizer()
+        # 序号 -> (消息类型, 发送时间)
+        self.relays: Dict[int, tuple] = {}
+        # 连接 -> [(期望的回复类型, 请求类型, 发送时间)]
+        self.waiting: Dict[str, list] = defaultdict(list)
+        self.http_pool = ThreadPoolExecutor(max_workers=64)
+        self.tasks = set()
+        # 尚未收到回复的 join-room / match-request 数；中转消息要等它们完成，否则可能先于对端进房间到达
+        self.unanswered = 0
+        self.answered = asyncio.Condition()
+
+    async def run(self):
+        # 所有事件在一个循环里按时间顺序发出：各连接之间的先后关系（先进房间、再发 offer）和录制时一致
+        sockets = {}
+        self.start = time.perf_counter()
+        for event in self.events:
+            await self.wait_until(event["t"])
+            try:
+                await self.dispatch(event, sockets)
+            except Exception:
+                self.result.errors += 1
+                sockets.pop(event.get("c"), None)
+        for opening in sockets.values():
+            self.spawn(self.close(opening))
+        await asyncio.gather(*self.tasks)
+        # 留一点时间给最后几条中转消息
+        await asyncio.sleep(0.5)
+        self.result.elapsed = time.perf_counter() - self.start
+        self.result.lost = len(self.relays)
+        self.http_pool.shutdown(wait=False)
+
+    def spawn(self, coro):
+        task = asyncio.create_task(coro)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def wait_until(self, t: float):
+        delay = self.start + t / self.speed - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        else:
+            # 回放跟不上轨迹的节奏（客户端本身成为瓶颈）时，报告里能看出来
+            self.result.lag = max(self.result.lag, -delay)
+
+    async def dispatch(self, event: dict, sockets: dict):
+        kind, conn = event["e"], event.get("c")
+        if kind == "http":
+            self.spawn(self.request(event))
+        elif kind == "open":
+            # 握手并发进行，只有这个连接的下一条消息需要等它完成
+            if conn not in sockets:
+                sockets[conn] = asyncio.create_task(self.open(conn, bool(event.get("b"))))
+        elif kind == "close":
+            if conn in sockets:
+                self.spawn(self.close(sockets.pop(conn)))
+        elif event.get("m"):
+            if conn not in sockets:
+                # 录制开始前就已建立的连接
+                sockets[conn] = asyncio.create_task(self.open(conn, bool(event.get("b"))))
+            ws, _ = await sockets[conn]
+            if event["m"].get("type") in RELAY_TYPES and self.unanswered:
+                await self.settle()
+            await self.send(conn, ws, event)
+
+    async def settle(self, timeout: float = 1.0):
+        async with self.answered:
+            try:
+                await asyncio.wait_for(self.answered.wait_for(lambda: self.unanswered == 0), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def open(self, conn: str, binary_protocol: bool):
+        subprotocols = [binproto.SUBPROTOCOL] if binary_protocol else None
+        ws = await websockets.connect(f"{self.base_url}/ws/{pseudonym_id(conn)}", max_size=None,
+                                      ping_interval=None, open_timeout=60, subprotocols=subprotocols)
+        return ws, asyncio.create_task(self.read(conn, ws))
+
+    async def answer(self):
+        async with self.answered:
+            self.unanswered -= 1
+            self.answered.notify_all()
+
+    async def close(self, opening: asyncio.Task):
+        ws, reader = await opening
+        await ws.close()
+        await reader
+
+    async def send(self, conn: str, ws, event: dict):
+        state = {}
+        message = self.synth.build(event["m"], state)
+        frame = binproto.encode(message) if event.get("b") else json.dumps(message)
+        now = time.perf_counter()
+        if state.get("seq") is not None:
+            self.relays[state["seq"]] = (message.get("type"), now)
+        if message.get("type") in REPLIES:
+            self.waiting[conn].append((REPLIES[message["type"]], message["type"], now))
+            if message["type"] != "ping":
+                self.unanswered += 1
+        await ws.send(frame)
+        self.result.sent += 1
+
+    async def read(self, conn: str, ws):
+        try:
+            async for frame in ws:
+                now = time.perf_counter()
+                self.result.received += 1
+                binary = isinstance(frame, bytes)
+                message_type = binproto.peek_type(frame) if binary else json.loads(frame).get("type")
+                if message_type == "ping":
+                    pong = {"type": "pong"}
+                    await ws.send(binproto.encode(pong) if binary else json.dumps(pong))
+                elif message_type == "rate-limited":
+                    self.result.rate_limited += 1
+                waiting = self.waiting.get(conn)
+                if waiting:
+                    for i, (expected, request_type, sent) in enumerate(waiting):
+                        if message_type in expected:
+                            self.result.latency[request_type].append(now - sent)
+                            del waiting[i]
+                            if request_type != "ping":
+                                await self.answer()
+                            break
+                text = json.dumps(binproto.decode(frame)) if binary else frame
+                for match in SEQ.finditer(text):
+                    relay = self.relays.pop(int(match.group(1)), None)
+                    if relay:
+                        self.result.latency[relay[0]].append(now - relay[1])
+        except websockets.ConnectionClosed:
+            pass
+        finally:
+            # 连接断开后不会再有回复
+            for _, request_type, _ in self.waiting.pop(conn, []):
+                if request_type != "ping":
+                    await self.answer()
+
+    async def request(self, event: dict):
+        path = re.sub(r"#([0-9a-f]+)", r"p\1", event["p"])
+        # 按路径模板分组：伪名部分替换成 {id}
+        name = f"{event['x']} {re.sub(r'#[0-9a-f]+', '{id}', event['p'])}"
+        body, headers = None, {}
+        if event.get("m") is not None:
+            fields = self.synth.build(event["m"], {})
+            if any(isinstance(v, bytes) for v in fields.values()):
+                body, content_type = multipart(fields)
+            else:
+                body, content_type = json.dumps(fields).encode(), "application/json"
+            headers["Content-Type"] = content_type
+        request = urllib.request.Request(self.http_url + path, data=body, headers=headers, method=event["x"])
+        started = time.perf_counter()
+        try:
+            await asyncio.get_running_loop().run_in_executor(self.http_pool, http_call, request)
+            self.result.latency[name].append(time.perf_counter() - started)
+        except Exception:
+            self.result.errors += 1
+
+
+def http_call(request):
+    # 非 2xx（urlopen 抛出 HTTPError）计为错误，不计入延迟：回放到缺少该路由的服务器时 404 不会被当成成功
+    with urllib.request.urlopen(request, timeout=60) as response:
+        response.read()
+
+
+def multipart(fields: dict):
+    boundary = f"trace{random.getrandbits(64):x}"
+    parts = []
+    for name, value in fields.items():
+        if value is None:
+            continue
+        if isinstance(value, bytes):
+            head = (f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"; filename="frame.jpg"\r\n'
+                    f"Content-Type: image/jpeg\r\n\r\n")
+            parts.append(head.encode() + value + b"\r\n")
+        else:
+            parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode())
+    return b"".join(parts) + f"--{boundary}--\r\n".encode(), f"multipart/form-data; boundary={boundary}"
+
+
+def start_server(directory: str, server: str, port: int, quiet: bool) -> subprocess.Popen:
+    subdir, target, extra = SERVERS[server]
+    env = dict(os.environ, PYTHONUNBUFFERED="1")
+    env.pop("TRACE_PATH", None)
+    return subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", target, "--host", "127.0.0.1", "--port", str(port),
+         "--log-level", "warning", "--ws-max-size", str(1 << 24), *extra],
+        cwd=os.path.join(directory, subdir), env=env,
+        stdout=subprocess.DEVNULL if quiet else None, stderr=subprocess.DEVNULL if quiet else None,
+    )
+
+
+async def replay_version(args, events: List[dict], directory: Optional[str]) -> Result:
+    result = Result()
+    proc = None
+    if directory is None:
+        base_url = args.url.rstrip("/")
+        http_url = "http" + base_url[2:] if base_url.startswith("ws") else base_url
+    else:
+        port = free_port()
+        proc = start_server(directory, args.server, port, args.quiet_server)
+        await wait_for_port("127.0.0.1", port, timeout=120)
+        base_url, http_url = f"ws://127.0.0.1:{port}", f"http://127.0.0.1:{port}"
+
+    peak_rss = 0
+
+    async def sample_rss():
+        nonlocal peak_rss
+        while True:
+            peak_rss = max(peak_rss, proc_usage(proc.pid)[1])
+            await asyncio.sleep(0.2)
+
+    sampler = asyncio.create_task(sample_rss()) if proc else None
+    before = proc_usage(proc.pid) if proc else None
+    try:
+        await Replayer(events, base_url, http_url, args.speed, result).run()
+        if proc:
+            result.cpu = proc_usage(proc.pid)[0] - before[0]
+            result.peak_rss = peak_rss
+    finally:
+        if sampler:
+            sampler.cancel()
+        if proc:
+            proc.terminate()
+            proc.wait()
+    return result
+
+
+def checkout(ref: str) -> tuple:
+    """把 git ref 检出到临时 worktree，返回 (backend 目录, worktree 根目录)"""
+    root = subprocess.check_output(["git", "rev-parse", "--show-toplevel"], cwd=BACKEND_DIR, text=True).strip()
+    prefix = subprocess.check_output(["git", "rev-parse", "--show-prefix"], cwd=BACKEND_DIR, text=True).strip()
+    worktree = tempfile.mkdtemp(prefix="replay-")
+    subprocess.check_call(["git", "worktree", "add", "--detach", "--quiet", worktree, ref], cwd=root)
+    return os.path.join(worktree, prefix), worktree
+
+
+def stat_line(values: List[float]) -> tuple:
+    return (percentile(values, 50) * 1e3, percentile(values, 95) * 1e3, percentile(values, 99) * 1e3)
+
+
+def report(args, results: Dict[str, Result], events: int):
+    print()
+    print(f"轨迹事件: {events}  服务器: {args.server}  速度: {args.speed}×")
+    names = list(results)
+    print(f"{'指标':<40}" + "".join(f"{name:>16}" for name in names) + ("       变化" if len(names) == 2 else ""))
+
+    def row(label: str, values: list, fmt: str = "{:.1f}"):
+        cells = "".join(f"{fmt.format(v) if v is not None else '-':>16}" for v in values)
+        change = ""
+        if len(values) == 2 and None not in values and values[0]:
+            change = f"{(values[1] - values[0]) / values[0]:>+10.1%}"
+        print(f"{label:<40}{cells}{change}")
+
+    first = results[names[0]]
+    for name in sorted(set().union(*(r.latency for r in results.values()))):
+        stats = [stat_line(r.latency.get(name, [])) if r.latency.get(name) else (None, None, None)
+                 for r in results.values()]
+        counts = max(len(r.latency.get(name, [])) for r in results.values())
+        for i, p in enumerate(("p50", "p95", "p99")):
+            row(f"{name} {p} ms (n={counts})" if i == 0 else f"  {p} ms", [s[i] for s in stats], "{:.2f}")
+    row("发送消息", [r.sent for r in results.values()], "{:d}")
+    row("接收消息", [r.received for r in results.values()], "{:d}")
+    row("未送达的中转消息（含接收方已断开）", [r.lost for r in results.values()], "{:d}")
+    row("rate-limited", [r.rate_limited for r in results.values()], "{:d}")
+    row("错误", [r.errors for r in results.values()], "{:d}")
+    row("耗时 s", [r.elapsed for r in results.values()], "{:.2f}")
+    row("回放最大滞后 ms", [r.lag * 1e3 for r in results.values()])
+    if first.cpu is not None:
+        row("服务器 CPU s", [r.cpu for r in results.values()], "{:.2f}")
+        row("服务器峰值内存 MB", [r.peak_rss / 1024 if r.peak_rss else None for r in results.values()])
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="按录制的流量轨迹回放并比较两个版本")
+    parser.add_argument("trace")
+    parser.add_argument("--server", choices=sorted(SERVERS), help="默认取轨迹头里的 source")
+    parser.add_argument("--speed", type=float, default=1.0, help="回放倍速，1~50")
+    parser.add_argument("--candidate", default=BACKEND_DIR, help="被测版本的 backend 目录，默认当前代码")
+    parser.add_argument("--baseline", help="对照版本：backend 目录或 git ref")
+    parser.add_argument("--url", help="直接回放到已在运行的服务器（不启动子进程，不统计资源）")
+    parser.add_argument("--limit", type=float, help="只回放轨迹的前 N 秒")
+    parser.add_argument("--quiet-server", action="store_true", help="丢弃服务器输出")
+    args = parser.parse_args()
+    if not 1 <= args.speed <= 50:
+        parser.error("--speed 应在 1~50 之间")
+
+    header, events = read_trace(args.trace)
+    if args.limit:
+        events = [event for event in events if event["t"] <= args.limit]
+    args.server = args.server or header.get("source", "websocket_server")
+    raise_fd_limit()
+
+    results: Dict[str, Result] = {}
+    worktree = None
+    try:
+        if args.url:
+            results["server"] = await replay_version(args, events, None)
+        else:
+            if args.baseline:
+                directory = args.baseline
+                if not os.path.isdir(directory):
+                    directory, worktree = checkout(args.baseline)
+                results["baseline"] = await replay_version(args, events, directory)
+            results["candidate"] = await replay_version(args, events, args.candidate)
+    finally:
+        if worktree:
+            subprocess.call(["git", "worktree", "remove", "--force", worktree], cwd=BACKEND_DIR)
+            shutil.rmtree(worktree, ignore_errors=True)
+    report(args, results, len(events))
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,102 @@
+# snapshot.py - 信令状态快照：SQLite 增量写入，重启时一次性恢复
+#
+# 只记录自上次快照以来变化过的 key（房间 / 待接呼叫），写盘开销与变化量成正比，
+# 和房间总数无关。每个服务器进程需要各自的 SNAPSHOT_PATH；未设置时整个模块是空操作。
+import asyncio
+import logging
+import os
+import sqlite3
+import time
+from typing import Callable, Dict, List, Optional, Set, Tuple
+
+import fastjson
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_INTERVAL = float(os.getenv("SNAPSHOT_INTERVAL", "5"))
+
+# resolve(kind, key) 返回 key 当前的可序列化值，None 表示已删除
+Resolver = Callable[[str, str], Optional[object]]
+
+
+class StateStore:
+    def __init__(self, path: Optional[str]):
+        self.path = path
+        self.dirty: Set[Tuple[str, str]] = set()
+        self.conn: Optional[sqlite3.Connection] = None
+        self.lock = asyncio.Lock()
+        self.written = 0
+        self.last_flush_ms = 0.0
+        if path:
+            # 写盘在线程池里执行，同一时间只有一个 flush（见 self.lock）
+            self.conn = sqlite3.connect(path, check_same_thread=False)
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("PRAGMA synchronous=NORMAL")
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS state ("
+                "kind TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL, "
+                "PRIMARY KEY (kind, key)) WITHOUT ROWID"
+            )
+
+    @property
+    def enabled(self) -> bool:
+        return self.conn is not None
+
+    def mark(self, kind: str, key: str):
+        if self.conn is not None:
+            self.dirty.add((kind, key))
+
+    def load(self, kind: str) -> Dict[str, object]:
+        if self.conn is None:
+            return {}
+        rows = self.conn.execute("SELECT key, value FROM state WHERE kind = ?", (kind,))
+        return {key: fastjson.loads(value) for key, value in rows}
+
+    def collect(self, resolve: Resolver) -> Tuple[List[tuple], List[tuple]]:
+        """在事件循环线程上取出脏 key 的当前值并序列化，之后的写盘不再读内存状态"""
+        dirty, self.dirty = self.dirty, set()
+        upserts, deletes = [], []
+        for kind, key in dirty:
+            value = resolve(kind, key)
+            if value is None:
+                deletes.append((kind, key))
+            else:
+                upserts.append((kind, key, fastjson.dumps(value)))
+        return upserts, deletes
+
+    def write(self, upserts: List[tuple], deletes: List[tuple]):
+        start = time.perf_counter()
+        with self.conn:
+            self.conn.executemany("INSERT OR REPLACE INTO state (kind, key, value) VALUES (?, ?, ?)", upserts)
+            self.conn.executemany("DELETE FROM state WHERE kind = ? AND key = ?", deletes)
+        self.written += len(upserts) + len(deletes)
+        self.last_flush_ms = (time.perf_counter() - start) * 1e3
+
+    async def flush(self, resolve: Resolver):
+        if self.conn is None or not self.dirty:
+            return
+        async with self.lock:
+            upserts, deletes = self.collect(resolve)
+            await asyncio.to_thread(self.write, upserts, deletes)
+
+    def flush_sync(self, resolve: Resolver):
+        """进程退出前的最后一次快照"""
+        if self.conn is None or not self.dirty:
+            return
+        self.write(*self.collect(resolve))
+
+    async def run(self, resolve: Resolver, interval: float = SNAPSHOT_INTERVAL):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.flush(resolve)
+            except Exception as e:
+                logger.error("写入状态快照失败: %s", e, extra={"event": "error"})
+
+    def stats(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "dirty": len(self.dirty),
+            "written": self.written,
+            "last_flush_ms": round(self.last_flush_ms, 2),
+        }
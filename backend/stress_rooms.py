@@ -0,0 +1,172 @@
+# stress_rooms.py - complex_server 房间并发压测：一个热点房间 + 大量冷门房间
+# 用法: python stress_rooms.py [--hot-users 500] [--cold-rooms 5000] [--racers 500] [--rounds 3]
+#       python stress_rooms.py --sweep   # 依次测只有热点房间、不同冷门房间数量、只有冷门房间时的吞吐
+#
+# 假连接的 send_text 会让出事件循环并随机延迟，制造尽可能多的交错。
+# 另有一批用户同时加入两个不同的房间、或对同一房间并发发两次加入。
+# 每轮结束后检查不变式：房间不超过 2 人、用户只在一个房间里、用户和房间双向一致、没有残留空房间。
+import argparse
+import asyncio
+import random
+import time
+
+import complex_server
+from complex_server import ConnectionManager
+
+
+class SlowWebSocket:
+    async def send_text(self, data: str):
+        await asyncio.sleep(random.random() * 0.002)
+
+
+def add_user(manager: ConnectionManager, user_id: str):
+    manager.active_connections[user_id] = SlowWebSocket()
+    manager.users[user_id] = {"status": "online", "room_id": None}
+
+
+def check_invariants(manager: ConnectionManager) -> list:
+    problems = []
+    memberships = {}
+    for room_id, room in manager.rooms.items():
+        for user_id in room["users"]:
+            memberships.setdefault(user_id, []).append(room_id)
+        if len(room["users"]) > 2:
+            problems.append(f"房间 {room_id} 超员: {room['users']}")
+        if not room["users"]:
+            problems.append(f"房间 {room_id} 为空但未删除")
+        if len(set(room["users"])) != len(room["users"]):
+            problems.append(f"房间 {room_id} 有重复用户")
+        for user_id in room["users"]:
+            if manager.users.get(user_id, {}).get("room_id") != room_id:
+                problems.append(f"用户 {user_id} 在房间 {room_id} 中但状态不一致")
+    for user_id, user in manager.users.items():
+        room_id = user["room_id"]
+        if room_id and user_id not in manager.rooms.get(room_id, {}).get("users", []):
+            problems.append(f"用户 {user_id} 指向不存在的房间成员关系 {room_id}")
+    for user_id, rooms in memberships.items():
+        if len(rooms) > 1:
+            problems.append(f"用户 {user_id} 同时在多个房间中: {rooms}")
+    return problems
+
+
+async def run_round(manager: ConnectionManager, hot_users: int, cold_rooms: int, racers: int, offer: dict):
+    hot_joined = 0
+    hot_peak = 0
+    problems = []
+
+    async def hot(user_id: str):
+        nonlocal hot_joined, hot_peak
+        result = await manager.join_room(user_id, "hot", offer)
+        if result["success"]:
+            hot_joined += 1
+            hot_peak = max(hot_peak, len(manager.rooms["hot"]["users"]))
+            await asyncio.sleep(random.random() * 0.005)
+            await manager.leave_room(user_id, "hot")
+
+    async def cold(room: int):
+        a, b = f"c{room}a", f"c{room}b"
+        await asyncio.gather(
+            manager.join_room(a, f"cold-{room}", offer),
+            manager.join_room(b, f"cold-{room}", offer),
+        )
+        await asyncio.gather(manager.leave_room(a, f"cold-{room}"), manager.leave_room(b, f"cold-{room}"))
+
+    async def cross(n: int):
+        # 同一用户并发加入两个房间：最后只能在其中一个里
+        user_id = f"x{n}"
+        await asyncio.gather(
+            manager.join_room(user_id, f"cross-{n}-a", offer),
+            manager.join_room(user_id, f"cross-{n}-b", offer),
+        )
+        rooms = [r for r in (f"cross-{n}-a", f"cross-{n}-b") if user_id in manager.rooms.get(r, {}).get("users", [])]
+        if len(rooms) != 1:
+            problems.append(f"用户 {user_id} 并发加入两个房间后所在房间: {rooms}")
+        for room_id in rooms:
+            await manager.leave_room(user_id, room_id)
+
+    async def twice(n: int):
+        # 同一用户对同一房间并发加入两次：只能成功一次
+        user_id = f"y{n}"
+        results = await asyncio.gather(
+            manager.join_room(user_id, f"twice-{n}", offer),
+            manager.join_room(user_id, f"twice-{n}", offer),
+        )
+        succeeded = sum(result["success"] for result in results)
+        if succeeded != 1:
+            problems.append(f"用户 {user_id} 对同一房间并发加入成功 {succeeded} 次")
+        await manager.leave_room(user_id, f"twice-{n}")
+
+    tasks = [hot(f"h{n}") for n in range(hot_users)] + [cold(n) for n in range(cold_rooms)]
+    tasks += [cross(n) for n in range(racers)] + [twice(n) for n in range(racers)]
+    random.shuffle(tasks)
+    start = time.perf_counter()
+    await asyncio.gather(*tasks)
+    elapsed = time.perf_counter() - start
+    return hot_joined, hot_peak, elapsed, problems
+
+
+async def run_config(hot_users: int, cold_rooms: int, racers: int, rounds: int, offer: dict):
+    """用一个新的 ConnectionManager 跑 rounds 轮，返回 (ops/s, 最后一轮热点房间成功加入数, 不变式违反列表)"""
+    manager = ConnectionManager()
+    for n in range(hot_users):
+        add_user(manager, f"h{n}")
+    for n in range(cold_rooms):
+        add_user(manager, f"c{n}a")
+        add_user(manager, f"c{n}b")
+    for n in range(racers):
+        add_user(manager, f"x{n}")
+        add_user(manager, f"y{n}")
+
+    total_ops = (hot_users + cold_rooms * 4 + racers * 6) * rounds
+    total_time = 0.0
+    hot_joined = 0
+    problems = []
+    for _ in range(rounds):
+        hot_joined, hot_peak, elapsed, round_problems = await run_round(
+            manager, hot_users, cold_rooms, racers, offer)
+        total_time += elapsed
+        problems += round_problems
+        if hot_peak > 2:
+            problems.append(f"热点房间峰值人数 {hot_peak}")
+        problems += check_invariants(manager)
+        if manager.rooms:
+            problems.append(f"残留房间 {len(manager.rooms)} 个")
+    return total_ops / total_time, hot_joined, problems
+
+
+def print_problems(problems: list):
+    for problem in problems[:5]:
+        print(f"  ❌ {problem}")
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--hot-users", type=int, default=500)
+    parser.add_argument("--cold-rooms", type=int, default=5000)
+    parser.add_argument("--rounds", type=int, default=3)
+    parser.add_argument("--racers", type=int, default=500)
+    parser.add_argument("--sweep", action="store_true",
+                        help="扫描热点房间 / 冷门房间数量的组合，分别输出吞吐（不含并发竞争用户）")
+    args = parser.parse_args()
+
+    complex_server.logger.disabled = True
+    offer = {"type": "offer", "sdp": "v=0\r\n"}
+
+    if args.sweep:
+        # 热点房间的争用和冷门房间的数量分开看：只有热点房间、热点 + 不同数量的冷门房间、只有冷门房间
+        configs = [(args.hot_users, cold) for cold in sorted({0, 100, 1000, args.cold_rooms})]
+        configs.append((0, args.cold_rooms))
+        print(f"{'热点用户':>8} {'冷门房间':>8} {'ops/s':>10}  不变式违反")
+        for hot_users, cold_rooms in configs:
+            ops, _, problems = await run_config(hot_users, cold_rooms, 0, args.rounds, offer)
+            print(f"{hot_users:>12} {cold_rooms:>12} {ops:>10.0f}  {len(problems)}")
+            print_problems(problems)
+        return
+
+    ops, hot_joined, problems = await run_config(args.hot_users, args.cold_rooms, args.racers, args.rounds, offer)
+    print(f"{ops:10.0f} ops/s  "
+          f"热点房间成功加入 {hot_joined}/{args.hot_users}  不变式违反 {len(problems)}")
+    print_problems(problems)
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,267 @@
+# traffic_trace.py - 流量轨迹录制：只记录请求 / 消息的时间和“形状”，不记录内容，供 replay_trace.py 回放
+#
+# 默认关闭，设置 TRACE_PATH 后开启（以 .gz 结尾时 gzip 压缩）。纯标准库，信令服务器、cohost 和 emotion_api 共用；
+# emotion_api 单独部署时需要把 backend/ 加进 PYTHONPATH 才能录制。
+# 事件循环上只把原始数据放进队列；解码、脱敏、编码和写盘都在后台线程完成，队列满时丢弃并计数。
+#
+# 脱敏规则（同一份轨迹内一致，跨轨迹无法关联）:
+#   - 用户 / 房间 / 会话 ID：用本次录制的随机密钥做 HMAC，截断为 "#<10 位十六进制>"，密钥不落盘
+#   - SDP：只保留长度、行数、m= 段数、candidate 行数 -> "$sdp:长度:行数:m段:候选数"
+#   - ICE candidate：只保留长度和类型 -> "$cand:长度:host|srflx|prflx|relay"
+#   - 二进制（上传的图像）：只保留长度 -> "$bin:长度"
+#   - 其他字符串只保留长度 "$长度"；type、sdpMid 等枚举字段原样保留；数字、布尔原样保留
+#   - HTTP：按路由模板（如 /api/room/{room_id}）把路径参数填成对应的 "#" ID，丢弃查询串；JSON 请求体按以上规则记录形状，
+#     multipart 请求由接口把字段放进 request.state.trace
+#
+# 轨迹为 JSON 行，首行是头 {"trace": 1, "source": 服务名, "started": 时间戳}（收到第一个事件时写出，
+# 在此之前可以修改 source，如 cohost 复用 websocket_server 的录制器），之后每行一个事件:
+#   {"t": 秒, "e": "open", "c": 连接, "b": 1(二进制子协议)}      {"t", "e": "close", "c", "r": 原因}
+#   {"t", "e": "msg", "c", "n": 字节数, "b": 1(二进制帧), "m": 消息形状}
+#   {"t", "e": "http", "x": 方法, "p": 路径, "n": 请求体字节数, "s": 状态码, "d": 耗时毫秒, "m": 形状}
+#
+# 环境变量: TRACE_PATH  TRACE_QUEUE_SIZE=100000  TRACE_MAX_EVENTS=5000000  TRACE_BODY_LIMIT=65536
+import atexit
+import gzip
+import hashlib
+import hmac
+import json
+import logging
+import os
+import queue
+import re
+import threading
+import time
+
+TRACE_PATH = os.getenv("TRACE_PATH")
+TRACE_QUEUE_SIZE = int(os.getenv("TRACE_QUEUE_SIZE", "100000"))
+TRACE_MAX_EVENTS = int(os.getenv("TRACE_MAX_EVENTS", "5000000"))
+TRACE_BODY_LIMIT = int(os.getenv("TRACE_BODY_LIMIT", "65536"))
+
+ID_KEYS = {"roomId", "room_id", "userId", "user_id", "session_id", "to", "from", "target", "call_id",
+           "caller_id", "callee_id"}
+ENUM_KEYS = {"type", "sdpMid", "image_mode", "final_emotion", "label", "reason"}
+CANDIDATE_TYPES = ("host", "srflx", "prflx", "relay")
+MAX_DEPTH = 6
+MAX_ITEMS = 50
+# 接口标注里已经是形状的二进制字段（binary() 的输出），原样保留
+BINARY_SHAPE = re.compile(r"\$bin:\d+")
+
+logger = logging.getLogger(__name__)
+
+
+def binary(data) -> str:
+    return f"$bin:{len(data) if data else 0}"
+
+
+def sdp_shape(sdp: str) -> str:
+    return f"$sdp:{len(sdp)}:{sdp.count(chr(10))}:{sdp.count('m=')}:{sdp.count('a=candidate')}"
+
+
+def candidate_shape(candidate: str) -> str:
+    parts = candidate.split()
+    kind = next((parts[i + 1] for i in range(len(parts) - 1) if parts[i] == "typ"), "")
+    return f"$cand:{len(candidate)}:{kind if kind in CANDIDATE_TYPES else ''}"
+
+
+class TraceRecorder:
+    def __init__(self, source: str, path: str = TRACE_PATH, max_events: int = TRACE_MAX_EVENTS):
+        self.source = source
+        self.path = path
+        self.enabled = bool(path)
+        self.max_events = max_events
+        self.recorded = 0
+        self.dropped = 0
+        self.started = time.monotonic()
+        self.started_at = time.time()
+        self.key = os.urandom(16)
+        self.queue = queue.Queue(TRACE_QUEUE_SIZE)
+        self.thread = None
+        if self.enabled:
+            self.thread = threading.Thread(target=self.write_loop, name="trace-writer", daemon=True)
+            self.thread.start()
+            atexit.register(self.stop)
+
+    # ---- 事件循环线程：只入队 ----
+
+    def put(self, item: tuple):
+        if self.recorded >= self.max_events:
+            if self.enabled:
+                self.enabled = False
+                logger.warning("轨迹已达到 %d 条事件，停止录制", self.max_events, extra={"event": "trace"})
+            return
+        try:
+            self.queue.put_nowait((time.monotonic() - self.started,) + item)
+            self.recorded += 1
+        except queue.Full:
+            self.dropped += 1
+
+    def opened(self, conn: str, binary_protocol: bool = False):
+        self.put(("open", conn, binary_protocol))
+
+    def closed(self, conn: str, reason: str):
+        self.put(("close", conn, reason))
+
+    def message(self, conn: str, data, decode):
+        """data 是收到的原始帧（str / bytes），decode 在后台线程把它解码成 dict"""
+        self.put(("msg", conn, data, decode))
+
+    def http(self, scope: dict, size: int, status: int, duration_ms: float, body: bytes = None):
+        annotated = (scope.get("state") or {}).get("trace")
+        # FastAPI 把匹配到的路由放在 scope["route"]；没匹配到路由（404 等）时没有路径参数，记录原路径
+        template = getattr(scope.get("route"), "path_format", None)
+        params = dict(scope.get("path_params") or {}) if template else {}
+        self.put(("http", scope["method"], template or scope["path"], params,
+                  size, status, duration_ms, body, annotated))
+
+    def stats(self) -> dict:
+        return {"enabled": self.enabled, "recorded": self.recorded, "dropped": self.dropped,
+                "queued": self.queue.qsize()}
+
+    def stop(self):
+        if self.thread is not None and self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join(timeout=5)
+        self.enabled = False
+
+    # ---- 后台线程：脱敏、编码、写盘 ----
+
+    def pseudonym(self, value) -> str:
+        digest = hmac.new(self.key, str(value).encode(), hashlib.sha256).hexdigest()
+        return f"#{digest[:10]}"
+
+    def shape(self, value, key=None, depth=0):
+        if isinstance(value, str):
+            if key in ID_KEYS:
+                return self.pseudonym(value)
+            if key == "sdp":
+                return sdp_shape(value)
+            if key == "candidate":
+                return candidate_shape(value)
+            if key in ENUM_KEYS and len(value) <= 32:
+                return value
+            if BINARY_SHAPE.fullmatch(value):
+                return value
+            return f"${len(value)}"
+        if isinstance(value, (bytes, bytearray, memoryview)):
+            return binary(value)
+        if isinstance(value, dict):
+            if depth >= MAX_DEPTH:
+                return f"${len(value)}"
+            return {k: self.shape(v, k, depth + 1) for k, v in value.items()}
+        if isinstance(value, (list, tuple)):
+            return [self.shape(v, key, depth + 1) for v in list(value)[:MAX_ITEMS]]
+        return value
+
+    def encode(self, item: tuple) -> dict:
+        t, kind = round(item[0], 4), item[1]
+        if kind == "open":
+            event = {"t": t, "e": "open", "c": self.pseudonym(item[2])}
+            if item[3]:
+                event["b"] = 1
+            return event
+        if kind == "close":
+            return {"t": t, "e": "close", "c": self.pseudonym(item[2]), "r": item[3]}
+        if kind == "msg":
+            _, _, conn, data, decode = item
+            event = {"t": t, "e": "msg", "c": self.pseudonym(conn), "n": len(data)}
+            if isinstance(data, bytes):
+                event["b"] = 1
+            try:
+                event["m"] = self.shape(decode(data))
+            except Exception:
+                event["m"] = None
+            return event
+        _, _, method, path, params, size, status, duration, body, annotated = item
+        for name, value in params.items():
+            path = path.replace(f"{{{name}}}", self.pseudonym(value))
+        event = {"t": t, "e": "http", "x": method, "p": path, "n": size, "s": status, "d": round(duration, 2)}
+        if annotated is not None:
+            event["m"] = self.shape(annotated)
+        elif body:
+            try:
+                event["m"] = self.shape(json.loads(body))
+            except ValueError:
+                pass
+        return event
+
+    def write_loop(self):
+        opener = gzip.open if self.path.endswith(".gz") else open
+        item = self.queue.get()
+        if item is None:
+            return
+        with opener(self.path, "at", encoding="utf-8") as f:
+            f.write(json.dumps({"trace": 1, "source": self.source, "started": self.started_at}) + "\n")
+            while True:
+                batch = [item]
+                while item is not None and len(batch) < 1000:
+                    try:
+                        item = self.queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    batch.append(item)
+                lines = [json.dumps(self.encode(entry), ensure_ascii=False, separators=(",", ":"))
+                         for entry in batch if entry is not None]
+                if lines:
+                    f.write("\n".join(lines) + "\n")
+                    f.flush()
+                if batch[-1] is None:
+                    return
+                item = self.queue.get()
+
+
+class TraceMiddleware:
+    """ASGI 中间件：记录每个 HTTP 请求的方法、路径、大小、状态码和耗时；WebSocket 由服务器自行记录"""
+
+    def __init__(self, app, recorder: TraceRecorder):
+        self.app = app
+        self.recorder = recorder
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not self.recorder.enabled:
+            await self.app(scope, receive, send)
+            return
+        started = time.perf_counter()
+        headers = dict(scope.get("headers") or ())
+        is_json = b"json" in headers.get(b"content-type", b"")
+        size, chunks, status = 0, [], 500
+
+        async def traced_receive():
+            nonlocal size
+            message = await receive()
+            if message["type"] == "http.request":
+                chunk = message.get("body", b"")
+                size += len(chunk)
+                if is_json and size <= TRACE_BODY_LIMIT:
+                    chunks.append(chunk)
+            return message
+
+        async def traced_send(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, traced_receive, traced_send)
+        finally:
+            body = b"".join(chunks) if is_json and size <= TRACE_BODY_LIMIT else None
+            self.recorder.http(scope, size, status, (time.perf_counter() - started) * 1000, body)
+
+
+def read_trace(path: str):
+    """返回 (头, 事件列表)"""
+    opener = gzip.open if path.endswith(".gz") else open
+    header, events, offset = {}, [], 0.0
+    with opener(path, "rt", encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            if "trace" in entry:
+                # 追加写入的多段录制：后一段的时间接在前一段之后
+                offset = events[-1]["t"] if events else 0.0
+                header = header or entry
+                continue
+            entry["t"] += offset
+            events.append(entry)
+    return header, events
@@ -1,17 +1,80 @@
 # websocket_server.py - WebSocket 版本的 WebRTC 信令服务器
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect
+from fastapi import FastAPI, Header, HTTPException, Query, WebSocket, WebSocketDisconnect
+from fastapi.responses import PlainTextResponse
 from fastapi.middleware.cors import CORSMiddleware
-import json
+from pydantic import BaseModel
+import asyncio
+import hmac
 import logging
-from typing import Dict, Optional
+import os
+import random
+import time
+import uuid
+from typing import Dict, Optional, Union
 from datetime import datetime
 
-# 配置日志
-logging.basicConfig(level=logging.INFO)
+import binproto
+import fastjson
+import logpipe
+from budget import TokenBuckets
+from traffic_trace import TraceMiddleware, TraceRecorder
+from expiry import ExpiryWheel
+from logpipe import setup_logging
+from matchmaking import MatchQueue
+from metrics import SignalingMetrics
+from snapshot import StateStore
+
+# 配置日志（队列 + 后台线程写出，见 logpipe.py）
+setup_logging()
 logger = logging.getLogger(__name__)
 
 app = FastAPI(title="WebRTC 信令服务器 (WebSocket版)")
 
+# 心跳：空闲 HEARTBEAT_INTERVAL 秒后发送 ping，再过 HEARTBEAT_TIMEOUT 秒无任何消息视为死连接
+HEARTBEAT_INTERVAL = float(os.getenv("HEARTBEAT_INTERVAL", "20"))
+HEARTBEAT_TIMEOUT = float(os.getenv("HEARTBEAT_TIMEOUT", "10"))
+
+# 匹配队列最长等待时间；房间列表快照最短重建间隔
+MATCH_TIMEOUT = float(os.getenv("MATCH_TIMEOUT", "60"))
+ROOM_SNAPSHOT_TTL = float(os.getenv("ROOM_SNAPSHOT_TTL", "1"))
+
+# 重启前后的状态交接：快照文件（未设置则不持久化）、恢复后等待用户重连的时间、
+# /api/drain 通知客户端重连时的随机延迟上限（毫秒），避免所有客户端同时涌向新进程
+SNAPSHOT_PATH = os.getenv("SNAPSHOT_PATH")
+RESTORE_GRACE = float(os.getenv("RESTORE_GRACE", "60"))
+DRAIN_JITTER_MS = int(os.getenv("DRAIN_JITTER_MS", "5000"))
+
+# 房间容量：默认 2 人；创建房间时可在 join-room 中指定 capacity（mesh 多人通话），上限 MAX_ROOM_CAPACITY
+ROOM_CAPACITY = int(os.getenv("ROOM_CAPACITY", "2"))
+MAX_ROOM_CAPACITY = int(os.getenv("MAX_ROOM_CAPACITY", "8"))
+
+# 单个信令帧的字节上限；SDP 解压后另有 binproto.MAX_SDP_BYTES 限制
+# 同时作为 uvicorn 的 ws_max_size，超限的帧在协议层就被拒绝（关闭码 1009），不会整帧读进内存；
+# 用 uvicorn 命令行启动时需自行传 --ws-max-size（默认 16 MB）
+MAX_FRAME_BYTES = int(os.getenv("MAX_FRAME_BYTES", str(256 * 1024)))
+
+# 消息预算（条/秒 + 突发上限）：单个用户、单个房间各一个令牌桶，防止一个房间占满服务器 CPU
+USER_MESSAGE_RATE = float(os.getenv("USER_MESSAGE_RATE", "50"))
+USER_MESSAGE_BURST = float(os.getenv("USER_MESSAGE_BURST", "200"))
+ROOM_MESSAGE_RATE = float(os.getenv("ROOM_MESSAGE_RATE", "200"))
+ROOM_MESSAGE_BURST = float(os.getenv("ROOM_MESSAGE_BURST", "1000"))
+
+# 情绪推送：每个接收方最多每 EMOTION_MIN_INTERVAL 秒收到一批 emotion-update，
+# 等待期间同一发送者的新结果覆盖旧结果。
+# /api/emotion-update 必须携带 X-Publish-Token 且与 EMOTION_PUBLISH_TOKEN 一致，未设置令牌时拒绝所有请求；
+# cohost.py 在同一进程内直接调用 manager.publish_emotion，不经过这个接口
+EMOTION_MIN_INTERVAL = float(os.getenv("EMOTION_MIN_INTERVAL", "0.5"))
+EMOTION_PUBLISH_TOKEN = os.getenv("EMOTION_PUBLISH_TOKEN")
+
+# 心跳消息不计入预算，否则超限的用户会被当成死连接
+HEARTBEAT_TYPES = ("ping", "pong")
+
+# 客户端可能发送的消息类型，/metrics 按这些类型分别计数，其余归入 other
+CLIENT_MESSAGE_TYPES = (
+    "join-room", "offer", "answer", "ice-candidate", "leave-room",
+    "ping", "pong", "match-request", "match-cancel",
+)
+
 # 允许跨域
 app.add_middleware(
     CORSMiddleware,
@@ -21,6 +84,11 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# 流量轨迹录制（TRACE_PATH 开启，见 traffic_trace.py），用 replay_trace.py 回放
+trace = TraceRecorder("websocket_server")
+if trace.enabled:
+    app.add_middleware(TraceMiddleware, recorder=trace)
+
 
 # 连接管理器
 class ConnectionManager:
@@ -28,75 +96,329 @@ class ConnectionManager:
         self.active_connections: Dict[str, WebSocket] = {}
         self.rooms: Dict[str, Dict] = {}
         self.user_rooms: Dict[str, str] = {}
+        # 通过子协议协商使用二进制（MessagePack）帧的用户
+        self.binary_users = set()
+        # 所有连接共用一个时间轮做心跳，而不是每个连接一个 sleep 任务
+        self.heartbeats = ExpiryWheel(tick=1.0)
+        self.background_tasks = set()
+        self.matchmaking = MatchQueue(MATCH_TIMEOUT)
+        # 房间每次变化递增版本号，/api/rooms 只在版本变化时重建快照
+        self.rooms_version = 0
+        self.snapshot: Optional[dict] = None
+        self.state = StateStore(SNAPSHOT_PATH)
+        # 从快照恢复、尚未重新发送 join-room 的用户（重连后的 join-room 视为回到原房间）；
+        # draining 期间断开连接不清理房间
+        self.restored = set()
+        self.draining = False
+        self.metrics = SignalingMetrics(CLIENT_MESSAGE_TYPES)
+        self.user_budget = TokenBuckets(USER_MESSAGE_RATE, USER_MESSAGE_BURST)
+        self.room_budget = TokenBuckets(ROOM_MESSAGE_RATE, ROOM_MESSAGE_BURST)
+        # 每个用户最新的情绪结果；每个接收方待发送的更新 {recipient: {sender: update}}
+        self.emotions: Dict[str, dict] = {}
+        self.emotion_pending: Dict[str, Dict[str, dict]] = {}
 
     async def connect(self, websocket: WebSocket, user_id: str):
-        await websocket.accept()
+        subprotocol = binproto.negotiate(websocket.scope.get("subprotocols", []))
+        await websocket.accept(subprotocol=subprotocol)
         self.active_connections[user_id] = websocket
-        logger.info(f"用户 {user_id} 建立 WebSocket 连接")
+        if subprotocol:
+            self.binary_users.add(user_id)
+        else:
+            self.binary_users.discard(user_id)
+        self.metrics.connections_opened += 1
+        if trace.enabled:
+            trace.opened(user_id, bool(subprotocol))
+        self.touch(user_id)
+        logger.info("用户 %s 建立 WebSocket 连接", user_id, extra={"event": "connect"})
 
     def disconnect(self, user_id: str):
         if user_id in self.active_connections:
             del self.active_connections[user_id]
+        self.binary_users.discard(user_id)
+        self.heartbeats.cancel(("ping", user_id))
+        self.heartbeats.cancel(("dead", user_id))
+        self.matchmaking.remove(user_id)
+        self.user_budget.discard(user_id)
+        self.emotions.pop(user_id, None)
         if user_id in self.user_rooms:
             room_id = self.user_rooms[user_id]
             self.leave_room(user_id, room_id)
-        logger.info(f"用户 {user_id} 断开连接")
+        logger.info("用户 %s 断开连接", user_id, extra={"event": "disconnect"})
+
+    async def drop_user(self, user_id: str, websocket: Optional[WebSocket] = None, reason: str = "closed"):
+        """断开用户并通知房间内的其他人；websocket 已被新连接替换时忽略"""
+        if websocket is not None and self.active_connections.get(user_id) is not websocket:
+            return
+        if user_id in self.active_connections:
+            self.metrics.connections_closed["drain" if self.draining else reason] += 1
+            if trace.enabled:
+                trace.closed(user_id, reason)
+        if self.draining:
+            # 服务即将重启：只释放连接，房间关系留给快照，由新进程恢复
+            self.active_connections.pop(user_id, None)
+            self.binary_users.discard(user_id)
+            self.heartbeats.cancel(("ping", user_id))
+            self.heartbeats.cancel(("dead", user_id))
+            self.matchmaking.remove(user_id)
+            return
+        room_id = self.user_rooms.get(user_id)
+        self.disconnect(user_id)
+        if room_id:
+            await self.broadcast_to_room({
+                "type": "user-left",
+                "user_id": user_id,
+                "message": f"用户 {user_id} 已离开房间"
+            }, room_id, exclude_user=user_id)
+
+    def touch(self, user_id: str):
+        """收到任意消息即视为存活，重新计时"""
+        self.heartbeats.cancel(("dead", user_id))
+        self.heartbeats.schedule(("ping", user_id), HEARTBEAT_INTERVAL)
+
+    def spawn(self, coro):
+        task = asyncio.create_task(coro)
+        self.background_tasks.add(task)
+        task.add_done_callback(self.background_tasks.discard)
+
+    async def on_heartbeat(self, key: tuple):
+        """心跳时间轮到期回调"""
+        kind, user_id = key
+        if kind == "restore":
+            # 恢复后只挂一个定时器，到期时统一清理仍未重连的用户
+            stale, self.restored = self.restored, set()
+            logger.info("%d 个恢复的用户未在 %.0fs 内重连，移出房间", len(stale), RESTORE_GRACE,
+                        extra={"event": "restore_expired"})
+            for user_id in stale:
+                if user_id not in self.active_connections:
+                    # 这些用户从未在本进程建立连接，drop_user 不会替他们计数
+                    self.metrics.connections_closed["restore_expired"] += 1
+                    await self.drop_user(user_id, reason="restore_expired")
+            return
+        if user_id not in self.active_connections:
+            return
+        if kind == "ping":
+            self.heartbeats.schedule(("dead", user_id), HEARTBEAT_TIMEOUT)
+            # 半开连接上的发送可能阻塞，不能卡住调度循环
+            self.spawn(self.send_personal_message({"type": "ping", "ts": time.time()}, user_id))
+        elif kind == "dead":
+            logger.warning("用户 %s 心跳超时，回收连接", user_id, extra={"event": "heartbeat_timeout"})
+            websocket = self.active_connections[user_id]
+            await self.drop_user(user_id, reason="heartbeat_timeout")
+            self.spawn(self.close_quietly(websocket))
+
+    async def close_quietly(self, websocket: WebSocket, code: int = 1001):
+        try:
+            await asyncio.wait_for(websocket.close(code=code), timeout=HEARTBEAT_TIMEOUT)
+        except Exception:
+            pass
+
+    def encode(self, message: dict, binary: bool) -> Union[str, bytes]:
+        return binproto.encode(message) if binary else fastjson.dumps(message)
+
+    def transcode(self, frame: Union[str, bytes], user_id: str) -> Union[str, bytes]:
+        """仅在收发双方协议不同时转换帧格式"""
+        binary = user_id in self.binary_users
+        if isinstance(frame, bytes) == binary:
+            return frame
+        if binary:
+            return binproto.encode(fastjson.loads(frame))
+        return fastjson.dumps(binproto.decode(frame))
 
     async def send_personal_message(self, message: dict, user_id: str):
+        return await self.send_raw(self.encode(message, user_id in self.binary_users), user_id)
+
+    async def send_raw(self, data: Union[str, bytes], user_id: str):
+        """发送已编码好的帧，广播和中转时复用同一份编码结果"""
         if user_id in self.active_connections:
             try:
-                await self.active_connections[user_id].send_text(json.dumps(message))
+                if isinstance(data, bytes):
+                    await self.active_connections[user_id].send_bytes(data)
+                else:
+                    await self.active_connections[user_id].send_text(data)
                 return True
             except Exception as e:
-                logger.error(f"发送消息给 {user_id} 失败: {e}")
+                logger.error("发送消息给 %s 失败: %s", user_id, e, extra={"event": "send_failed"})
+                self.metrics.send_failures += 1
         return False
 
     async def broadcast_to_room(self, message: dict, room_id: str, exclude_user: Optional[str] = None):
         if room_id not in self.rooms:
             return
-        for user_id in self.rooms[room_id]["users"]:
+        # 每种协议最多编码一次
+        encoded = {}
+        for user_id in list(self.rooms[room_id]["users"]):
             if exclude_user and user_id == exclude_user:
                 continue
-            await self.send_personal_message(message, user_id)
+            binary = user_id in self.binary_users
+            if binary not in encoded:
+                encoded[binary] = self.encode(message, binary)
+            await self.send_raw(encoded[binary], user_id)
+
+    async def enforce_budget(self, user_id: str) -> bool:
+        """先扣用户预算再扣房间预算；超限的消息直接丢弃，连续超限只通知一次"""
+        if not self.user_budget.allow(user_id):
+            scope, budget, key = "user", self.user_budget, user_id
+        else:
+            room_id = self.user_rooms.get(user_id)
+            if room_id is None or self.room_budget.allow(room_id):
+                return True
+            scope, budget, key = "room", self.room_budget, room_id
+        self.metrics.rate_limited[scope] += 1
+        if budget.first_rejection(key):
+            logger.warning("%s %s 消息超出预算", scope, key, extra={"event": "rate_limited"})
+            await self.send_personal_message({
+                "type": "rate-limited",
+                "scope": scope,
+                "message": "消息过于频繁，部分消息已被丢弃"
+            }, user_id)
+        return False
 
-    def join_room(self, user_id: str, room_id: str) -> dict:
-        logger.info(f"用户 {user_id} 尝试加入房间 {room_id}")
+    def publish_emotion(self, user_id: str, result: dict) -> Optional[int]:
+        """情绪服务的融合结果：记下最新值并排队推送给同房间的其他成员，返回接收方数量
+
+        只接受当前在线的用户，断开时随 disconnect 一起清掉，缓存不会超过连接数；不在线时返回 None。
+        """
+        if user_id not in self.active_connections:
+            return None
+        update = {
+            "type": "emotion-update",
+            "user_id": user_id,
+            "final_emotion": result.get("final_emotion"),
+            "text_emotion": result.get("text_emotion"),
+            "image_emotion": result.get("image_emotion"),
+            "ts": time.time()
+        }
+        self.emotions[user_id] = update
+        self.metrics.emotion_updates["published"] += 1
+        room_id = self.user_rooms.get(user_id)
+        if room_id is None:
+            return 0
+        recipients = [u for u in self.rooms[room_id]["users"] if u != user_id]
+        for recipient in recipients:
+            self.queue_emotion(recipient, update)
+        return len(recipients)
+
+    def queue_emotion(self, recipient: str, update: dict):
+        pending = self.emotion_pending.get(recipient)
+        if pending is None:
+            pending = self.emotion_pending[recipient] = {}
+            self.spawn(self.flush_emotions(recipient))
+        elif update["user_id"] in pending:
+            self.metrics.emotion_updates["coalesced"] += 1
+        pending[update["user_id"]] = update
+
+    async def flush_emotions(self, recipient: str):
+        """每个接收方同时只有一个发送任务；发送变慢或限速等待时，新到的更新只会覆盖而不会堆积"""
+        try:
+            while self.emotion_pending.get(recipient):
+                pending, self.emotion_pending[recipient] = self.emotion_pending[recipient], {}
+                for update in pending.values():
+                    await self.send_personal_message(update, recipient)
+                await asyncio.sleep(EMOTION_MIN_INTERVAL)
+        finally:
+            self.emotion_pending.pop(recipient, None)
+
+    def join_room(self, user_id: str, room_id: str, capacity: Optional[int] = None) -> dict:
+        logger.info("用户 %s 尝试加入房间 %s", user_id, room_id, extra={"event": "join"})
         if user_id in self.user_rooms:
             old_room = self.user_rooms[user_id]
             if old_room == room_id:
+                if user_id in self.restored:
+                    # 重启后重连的用户重新发送 join-room，视为成功
+                    self.restored.discard(user_id)
+                    return self.join_result(user_id, room_id)
                 return {"success": False, "message": "您已在此房间中"}
             else:
                 self.leave_room(user_id, old_room)
 
         if room_id not in self.rooms:
-            self.rooms[room_id] = {"users": [], "created_at": datetime.now()}
-            logger.info(f"创建新房间: {room_id}")
+            capacity = min(max(capacity or ROOM_CAPACITY, 2), MAX_ROOM_CAPACITY)
+            self.rooms[room_id] = {"users": [], "capacity": capacity, "created_at": datetime.now()}
+            logger.info("创建新房间: %s", room_id, extra={"event": "room_created"})
 
         room = self.rooms[room_id]
-        if len(room["users"]) >= 2:
-            return {"success": False, "message": "房间已满（最多2人）"}
+        if len(room["users"]) >= room["capacity"]:
+            return {"success": False, "message": f"房间已满（最多{room['capacity']}人）"}
 
         room["users"].append(user_id)
         self.user_rooms[user_id] = room_id
-        logger.info(f"用户 {user_id} 成功加入房间 {room_id}")
+        self.room_changed(room_id)
+        logger.info("用户 %s 成功加入房间 %s", user_id, room_id, extra={"event": "join"})
+        return self.join_result(user_id, room_id)
 
+    def join_result(self, user_id: str, room_id: str) -> dict:
+        room = self.rooms[room_id]
         other_users = [u for u in room["users"] if u != user_id]
         return {
             "success": True,
             "room_id": room_id,
             "user_count": len(room["users"]),
+            "capacity": room["capacity"],
             "other_users": other_users,
-            "is_room_full": len(room["users"]) == 2
+            "is_room_full": len(room["users"]) >= room["capacity"]
         }
 
     def leave_room(self, user_id: str, room_id: str):
+        self.restored.discard(user_id)
         if room_id in self.rooms and user_id in self.rooms[room_id]["users"]:
             self.rooms[room_id]["users"].remove(user_id)
+            self.room_changed(room_id)
             if len(self.rooms[room_id]["users"]) == 0:
-                del self.rooms[room_id]
+                room = self.rooms.pop(room_id)
+                self.room_budget.discard(room_id)
+                self.metrics.room_lifetime.observe((datetime.now() - room["created_at"]).total_seconds())
         if user_id in self.user_rooms:
             del self.user_rooms[user_id]
 
+    def room_changed(self, room_id: str):
+        self.rooms_version += 1
+        self.state.mark("room", room_id)
+
+    def snapshot_value(self, kind: str, room_id: str) -> Optional[dict]:
+        room = self.rooms.get(room_id)
+        if room is None:
+            return None
+        return {"users": room["users"], "capacity": room["capacity"], "created_at": room["created_at"].isoformat()}
+
+    def restore(self) -> int:
+        """从快照恢复房间；用户在 RESTORE_GRACE 秒内重连即可继续通话，否则按离开处理"""
+        for room_id, room in self.state.load("room").items():
+            self.rooms[room_id] = {
+                "users": room["users"],
+                "capacity": room.get("capacity", ROOM_CAPACITY),
+                "created_at": datetime.fromisoformat(room["created_at"])
+            }
+            for user_id in room["users"]:
+                self.user_rooms[user_id] = room_id
+                self.restored.add(user_id)
+        self.heartbeats.schedule(("restore", ""), RESTORE_GRACE)
+        self.rooms_version += 1
+        return len(self.rooms)
+
+    async def drain(self) -> int:
+        """通知所有客户端带随机延迟重连，然后关闭连接并写快照；房间状态保持不变"""
+        self.draining = True
+        connections = list(self.active_connections.items())
+        for user_id, _ in connections:
+            await self.send_personal_message({
+                "type": "server-restart",
+                "reconnect_after_ms": random.randint(0, DRAIN_JITTER_MS),
+                "message": "服务器即将重启，请稍后重连"
+            }, user_id)
+        for _, websocket in connections:
+            self.spawn(self.close_quietly(websocket, code=1012))
+        await self.state.flush(self.snapshot_value)
+        return len(connections)
+
+    def route_target(self, user_id: str, room_id: str, to: Optional[str]) -> Optional[str]:
+        """O(1) 确定接收方：指定了 to 时必须和发送方在同一房间；两人房间可以省略 to"""
+        if to is not None:
+            return to if to != user_id and self.user_rooms.get(to) == room_id else None
+        room = self.rooms.get(room_id)
+        if room is not None and len(room["users"]) == 2:
+            return self.get_room_other_user(room_id, user_id)
+        return None
+
     def get_room_other_user(self, room_id: str, current_user: str) -> Optional[str]:
         if room_id in self.rooms:
             for user in self.rooms[room_id]["users"]:
@@ -108,27 +430,106 @@ class ConnectionManager:
         return [
             {
                 "room_id": room_id,
-                "users": room["users"],
+                "users": list(room["users"]),
                 "user_count": len(room["users"]),
+                "capacity": room["capacity"],
                 "created_at": room["created_at"].isoformat()
             }
             for room_id, room in self.rooms.items()
         ]
 
+    def room_snapshot(self) -> dict:
+        """房间列表快照：房间有变化且距上次重建超过 ROOM_SNAPSHOT_TTL 才重建"""
+        now = time.monotonic()
+        snapshot = self.snapshot
+        if snapshot is None or (snapshot["version"] != self.rooms_version
+                                and now - snapshot["built_at"] >= ROOM_SNAPSHOT_TTL):
+            rooms = self.get_all_rooms()
+            snapshot = self.snapshot = {
+                "version": self.rooms_version,
+                "built_at": now,
+                "rooms": rooms,
+                "available": [room for room in rooms if room["user_count"] < room["capacity"]],
+            }
+        return snapshot
+
+    async def on_match_timeout(self, key: tuple):
+        user_id = key[1]
+        if self.matchmaking.expire(user_id):
+            await self.send_personal_message({
+                "type": "match-timeout",
+                "message": "暂时没有找到匹配的用户，请稍后再试"
+            }, user_id)
+
 
 manager = ConnectionManager()
 
 
+@app.on_event("startup")
+async def start_heartbeats():
+    if manager.state.enabled:
+        logger.info("从快照恢复了 %d 个房间", manager.restore(), extra={"event": "restore"})
+        app.state.snapshot_task = asyncio.create_task(manager.state.run(manager.snapshot_value))
+    app.state.heartbeat_task = asyncio.create_task(manager.heartbeats.run(manager.on_heartbeat))
+    app.state.match_task = asyncio.create_task(manager.matchmaking.timeouts.run(manager.on_match_timeout))
+    app.state.loop_lag_task = asyncio.create_task(manager.metrics.monitor_loop_lag())
+
+
+@app.on_event("shutdown")
+async def save_snapshot():
+    # 未经 /api/drain 直接停止时，连接在此之前已被关闭、房间已清空，保留上一次定期快照
+    if manager.draining:
+        manager.state.flush_sync(manager.snapshot_value)
+    trace.stop()
+
+
 @app.websocket("/ws/{user_id}")
 async def websocket_endpoint(websocket: WebSocket, user_id: str):
     await manager.connect(websocket, user_id)
     try:
         while True:
-            data = await websocket.receive_text()
-            message = json.loads(data)
+            frame = await websocket.receive()
+            if frame["type"] == "websocket.disconnect":
+                raise WebSocketDisconnect(frame.get("code", 1000))
+            received = time.perf_counter()
+            data = frame["text"] if frame.get("text") is not None else frame.get("bytes")
+            manager.touch(user_id)
+            if len(data) > MAX_FRAME_BYTES:
+                await manager.send_personal_message({
+                    "type": "error",
+                    "message": f"消息过大（上限 {MAX_FRAME_BYTES} 字节）"
+                }, user_id)
+                continue
+
+            # SDP / ICE 只做中转，不做完整的解码再编码
+            binary = isinstance(data, bytes)
+            if trace.enabled:
+                trace.message(user_id, data, binproto.decode if binary else fastjson.loads)
+            message_type = binproto.peek_type(data) if binary else fastjson.peek_type(data)
+            if message_type not in HEARTBEAT_TYPES and not await manager.enforce_budget(user_id):
+                continue
+            if message_type in fastjson.RELAY_TYPES and await handle_relay(user_id, data):
+                manager.metrics.observe_message(message_type, received)
+                continue
+            try:
+                message = binproto.decode(data) if binary else fastjson.loads(data)
+                if not isinstance(message, dict):
+                    raise ValueError("信令消息必须是对象")
+            except ValueError as e:
+                # 坏帧只回复错误，不断开连接
+                logger.warning("用户 %s 的消息无法解析: %r", user_id, e, extra={"event": "bad_frame"})
+                await manager.send_personal_message({
+                    "type": "error",
+                    "message": "无法解析的消息"
+                }, user_id)
+                continue
             message_type = message.get("type")
 
-            if message_type == "join-room":
+            if message_type == "pong":
+                continue
+            elif message_type == "ping":
+                await manager.send_personal_message({"type": "pong"}, user_id)
+            elif message_type == "join-room":
                 await handle_join_room(user_id, message)
             elif message_type == "offer":
                 await handle_offer(user_id, message)
@@ -138,15 +539,60 @@ async def websocket_endpoint(websocket: WebSocket, user_id: str):
                 await handle_ice_candidate(user_id, message)
             elif message_type == "leave-room":
                 await handle_leave_room(user_id, message)
+            elif message_type == "match-request":
+                await handle_match_request(user_id, message)
+            elif message_type == "match-cancel":
+                manager.matchmaking.remove(user_id)
+            manager.metrics.observe_message(message_type, received)
     except WebSocketDisconnect:
-        manager.disconnect(user_id)
-        if user_id in manager.user_rooms:
-            room_id = manager.user_rooms[user_id]
-            await manager.broadcast_to_room({
-                "type": "user-left",
-                "user_id": user_id,
-                "message": f"用户 {user_id} 已离开房间"
-            }, room_id, exclude_user=user_id)
+        await manager.drop_user(user_id, websocket, reason="client")
+    except Exception as e:
+        logger.error("WebSocket 错误: %s", e, extra={"event": "error"})
+        await manager.drop_user(user_id, websocket, reason="error")
+        # 不主动关闭的话客户端会留着一个不再有人读的连接，心跳也回收不了
+        await manager.close_quietly(websocket, code=1011)
+
+
+async def handle_match_request(user_id: str, message: dict):
+    """进入匹配队列；配对成功后分配新房间并通知双方"""
+    # 已在房间里的用户要先离开，否则配对会把他悄悄移出原房间，原房间的其他人收不到 user-left
+    if user_id in manager.user_rooms:
+        await manager.send_personal_message({
+            "type": "error",
+            "message": "请先离开当前房间再匹配"
+        }, user_id)
+        return
+    try:
+        result = manager.matchmaking.enqueue(user_id, message.get("attributes"))
+    except ValueError as e:
+        await manager.send_personal_message({"type": "error", "message": str(e)}, user_id)
+        return
+    if result is None:
+        await manager.send_personal_message({
+            "type": "match-queued",
+            "waiting": len(manager.matchmaking)
+        }, user_id)
+        return
+
+    peer_id, waited = result
+    room_id = f"match-{uuid.uuid4().hex[:12]}"
+    manager.join_room(peer_id, room_id, capacity=2)
+    manager.join_room(user_id, room_id, capacity=2)
+    logger.info("匹配成功: %s <-> %s，等待 %.1fs，房间 %s", peer_id, user_id, waited, room_id,
+                extra={"event": "matched"})
+    # 和 room-joined 的 is_room_full 一致：后到的一方发起 offer
+    await manager.send_personal_message({
+        "type": "match-found",
+        "room_id": room_id,
+        "peer_id": peer_id,
+        "initiator": True
+    }, user_id)
+    await manager.send_personal_message({
+        "type": "match-found",
+        "room_id": room_id,
+        "peer_id": user_id,
+        "initiator": False
+    }, peer_id)
 
 
 async def handle_join_room(user_id: str, message: dict):
@@ -158,29 +604,93 @@ async def handle_join_room(user_id: str, message: dict):
         }, user_id)
         return
 
-    result = manager.join_room(user_id, room_id)
+    capacity = message.get("capacity")
+    # bool 也是 int 的子类，要单独排除
+    if capacity is not None and (not isinstance(capacity, int) or isinstance(capacity, bool) or capacity < 1):
+        await manager.send_personal_message({
+            "type": "error",
+            "message": "capacity 必须是正整数"
+        }, user_id)
+        return
+
+    result = manager.join_room(user_id, room_id, capacity)
+    if result["success"]:
+        # 手动加入了房间就退出匹配队列，不会之后再被配对到另一个房间
+        manager.matchmaking.remove(user_id)
     await manager.send_personal_message({
         "type": "room-joined",
         **result
     }, user_id)
 
     if result["success"] and result["other_users"]:
+        # 每种协议只编码一次，发给房间里所有已有成员；新成员负责向每个人发起 offer
         await manager.broadcast_to_room({
             "type": "user-joined",
             "user_id": user_id,
+            "user_count": result["user_count"],
             "message": f"用户 {user_id} 加入了房间"
         }, room_id, exclude_user=user_id)
+        # 新成员直接拿到已有成员最近一次的情绪结果，不用等下一次推理
+        for other_user in result["other_users"]:
+            if other_user in manager.emotions:
+                manager.queue_emotion(user_id, manager.emotions[other_user])
 
 
-async def handle_offer(user_id: str, message: dict):
+async def handle_relay(user_id: str, data: Union[str, bytes]) -> bool:
+    """把原始帧附上 from 字段后转发给接收方；无法直接拼接时返回 False 交给完整解析路径"""
+    room_id = manager.user_rooms.get(user_id)
+    room = manager.rooms.get(room_id) if room_id else None
+    if room is None:
+        return False
+    # 只解码不重新编码，转发的仍是原始帧；解码用来确认帧是合法的信令消息（否则接收方的 JSON.parse 会失败），
+    # 多人房间还要读出 to。解码失败交给完整解析路径回复错误
+    try:
+        message = binproto.decode(data) if isinstance(data, bytes) else fastjson.loads(data)
+    except Exception:
+        return False
+    if not isinstance(message, dict):
+        return False
+    to = message.get("to") if len(room["users"]) > 2 else None
+    target_user = manager.route_target(user_id, room_id, to)
+    if target_user is None and len(room["users"]) > 1:
+        return False
+    if isinstance(data, bytes):
+        frame = binproto.append_from(data, user_id)
+    else:
+        frame = fastjson.append_field(data, "from", user_id)
+    if frame is None:
+        return False
+    if target_user:
+        try:
+            frame = manager.transcode(frame, target_user)
+        except ValueError:
+            return False
+        await manager.send_raw(frame, target_user)
+    return True
+
+
+async def resolve_target(user_id: str, message: dict, required: bool = True) -> Optional[str]:
+    """完整解析路径上确定接收方；找不到时回复错误（ICE candidate 静默丢弃）"""
     room_id = manager.user_rooms.get(user_id)
     if not room_id:
+        if required:
+            await manager.send_personal_message({
+                "type": "error",
+                "message": "您还未加入房间"
+            }, user_id)
+        return None
+    to = message.get("to")
+    target_user = manager.route_target(user_id, room_id, to)
+    if target_user is None and required and (to is not None or len(manager.rooms[room_id]["users"]) > 2):
         await manager.send_personal_message({
             "type": "error",
-            "message": "您还未加入房间"
+            "message": "接收方不在此房间中" if to is not None else "多人房间需要用 to 指定接收方"
         }, user_id)
-        return
-    target_user = manager.get_room_other_user(room_id, user_id)
+    return target_user
+
+
+async def handle_offer(user_id: str, message: dict):
+    target_user = await resolve_target(user_id, message)
     if target_user:
         await manager.send_personal_message({
             "type": "offer",
@@ -190,14 +700,7 @@ async def handle_offer(user_id: str, message: dict):
 
 
 async def handle_answer(user_id: str, message: dict):
-    room_id = manager.user_rooms.get(user_id)
-    if not room_id:
-        await manager.send_personal_message({
-            "type": "error",
-            "message": "您还未加入房间"
-        }, user_id)
-        return
-    target_user = manager.get_room_other_user(room_id, user_id)
+    target_user = await resolve_target(user_id, message)
     if target_user:
         await manager.send_personal_message({
             "type": "answer",
@@ -207,10 +710,7 @@ async def handle_answer(user_id: str, message: dict):
 
 
 async def handle_ice_candidate(user_id: str, message: dict):
-    room_id = manager.user_rooms.get(user_id)
-    if not room_id:
-        return
-    target_user = manager.get_room_other_user(room_id, user_id)
+    target_user = await resolve_target(user_id, message, required=False)
     if target_user:
         await manager.send_personal_message({
             "type": "ice-candidate",
@@ -221,6 +721,7 @@ async def handle_ice_candidate(user_id: str, message: dict):
 
 async def handle_leave_room(user_id: str, message: dict):
     room_id = manager.user_rooms.get(user_id)
+    manager.matchmaking.remove(user_id)
     if room_id:
         await manager.broadcast_to_room({
             "type": "user-left",
@@ -236,24 +737,82 @@ async def root():
         "message": "WebRTC WebSocket 信令服务器运行中",
         "status": "ok",
         "connected_users": len(manager.active_connections),
-        "active_rooms": len(manager.rooms)
+        "active_rooms": len(manager.rooms),
+        "heartbeat": manager.heartbeats.stats(),
+        "snapshot": manager.state.stats()
+    }
+
+
+def metric_gauges() -> dict:
+    log_stats = logpipe.stats()
+    return {
+        "connected_users": len(manager.active_connections),
+        "binary_users": len(manager.binary_users),
+        "active_rooms": len(manager.rooms),
+        "matchmaking_waiting": len(manager.matchmaking),
+        "heartbeat_timers": len(manager.heartbeats),
+        "log_queue_dropped": log_stats.get("dropped", 0),
+        "trace_dropped": trace.dropped,
     }
 
 
+class EmotionUpdate(BaseModel):
+    user_id: str
+    final_emotion: str
+    text_emotion: Optional[dict] = None
+    image_emotion: Optional[dict] = None
+
+
+@app.post("/api/emotion-update")
+async def emotion_update(update: EmotionUpdate, x_publish_token: Optional[str] = Header(None)):
+    """情绪服务推送某个用户的融合结果，由信令通道转发给同房间的其他人"""
+    if not EMOTION_PUBLISH_TOKEN or not hmac.compare_digest(
+            (x_publish_token or "").encode(), EMOTION_PUBLISH_TOKEN.encode()):
+        raise HTTPException(status_code=403, detail="invalid publish token")
+    recipients = manager.publish_emotion(update.user_id, update.model_dump())
+    if recipients is None:
+        raise HTTPException(status_code=404, detail="user not connected")
+    return {"success": True, "recipients": recipients}
+
+
+@app.get("/metrics")
+async def metrics(format: str = Query("prometheus", pattern="^(prometheus|json)$")):
+    """Prometheus 文本格式；format=json 返回分位数摘要，方便压测脚本直接读取"""
+    if format == "json":
+        return manager.metrics.summary(metric_gauges())
+    return PlainTextResponse(manager.metrics.render(metric_gauges()), media_type="text/plain; version=0.0.4")
+
+
 @app.get("/api/rooms")
-async def get_all_rooms():
+async def get_all_rooms(
+    offset: int = Query(0, ge=0),
+    limit: int = Query(100, ge=1, le=500),
+    available: bool = False
+):
+    """分页返回房间列表快照；available=true 只返回还有空位的房间"""
+    snapshot = manager.room_snapshot()
+    rooms = snapshot["available"] if available else snapshot["rooms"]
     return {
-        "rooms": manager.get_all_rooms(),
-        "total_rooms": len(manager.rooms),
-        "connected_users": len(manager.active_connections)
+        "rooms": rooms[offset:offset + limit],
+        "total_rooms": len(rooms),
+        "offset": offset,
+        "limit": limit,
+        "snapshot_age": round(time.monotonic() - snapshot["built_at"], 3),
+        "connected_users": len(manager.active_connections),
+        "matchmaking": manager.matchmaking.stats()
     }
 
 
 @app.delete("/api/reset-rooms")
 async def reset_all_rooms():
     room_count = len(manager.rooms)
+    for room_id in manager.rooms:
+        manager.state.mark("room", room_id)
     manager.rooms.clear()
     manager.user_rooms.clear()
+    manager.restored.clear()
+    manager.room_budget.buckets.clear()
+    manager.rooms_version += 1
     for user_id in list(manager.active_connections.keys()):
         await manager.send_personal_message({
             "type": "rooms-reset",
@@ -266,6 +825,14 @@ async def reset_all_rooms():
     }
 
 
+@app.post("/api/drain")
+async def drain():
+    """滚动重启前调用：客户端收到 server-restart 后按各自的随机延迟重连到新进程"""
+    notified = await manager.drain()
+    logger.info("已通知 %d 个连接重连", notified, extra={"event": "drain"})
+    return {"success": True, "notified": notified, "snapshot": manager.state.stats()}
+
+
 @app.delete("/api/reset-room/{room_id}")
 async def reset_single_room(room_id: str):
     if room_id in manager.rooms:
@@ -284,4 +851,4 @@ async def reset_single_room(room_id: str):
 if __name__ == "__main__":
     import uvicorn
     print("🚀 启动 WebRTC WebSocket 信令服务器...")
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    uvicorn.run(app, host="0.0.0.0", port=8000, ws_max_size=MAX_FRAME_BYTES)
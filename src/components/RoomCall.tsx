@@ -57,6 +57,7 @@ export default function RoomCall({ roomTheme }: RoomCallProps) {
   const [isWebSocketConnected, setIsWebSocketConnected] = useState<boolean>(false);
   const [copied, setCopied] = useState<boolean>(false);
   const [isClient, setIsClient] = useState(false);
+  const [peerEmotion, setPeerEmotion] = useState<string | null>(null);
 
   // WebRTC refs
   const localVideoRef = useRef<HTMLVideoElement>(null);
@@ -229,7 +230,11 @@ export default function RoomCall({ roomTheme }: RoomCallProps) {
         }
         break;
       }
+      case 'emotion-update':
+        setPeerEmotion(message.final_emotion);
+        break;
       case 'user-left':
+        setPeerEmotion(null);
         setConnectionStatus('用户已离开');
         setIsInCall(false);
         setIsWaiting(false);
@@ -258,6 +263,23 @@ export default function RoomCall({ roomTheme }: RoomCallProps) {
       ws.onmessage = async (event) => {
         try {
           const message: AnyWebSocketMessage = JSON.parse(event.data);
+          if (message.type === 'ping') {
+            ws.send(JSON.stringify({ type: 'pong' }));
+            return;
+          }
+          if (message.type === 'server-restart') {
+            // 服务器滚动重启：房间状态会被新进程恢复，按服务器给的随机延迟重连，P2P 媒体不受影响
+            console.log(`🔄 服务器即将重启，${message.reconnect_after_ms}ms 后重连`);
+            if (reconnectTimeoutRef.current) {
+              clearTimeout(reconnectTimeoutRef.current);
+            }
+            reconnectTimeoutRef.current = setTimeout(() => {
+              connectWebSocket(userId).then(newWs => {
+                websocketRef.current = newWs;
+              }).catch(console.error);
+            }, message.reconnect_after_ms);
+            return;
+          }
           console.log('📨 收到 WebSocket 消息:', message.type);
           await handleWebSocketMessage(message);
         } catch (error) {
@@ -501,6 +523,9 @@ export default function RoomCall({ roomTheme }: RoomCallProps) {
                 <span className="text-sm font-medium text-gray-700">
                   状态: {connectionStatus}
                 </span>
+                {peerEmotion && (
+                  <span className="text-xs text-gray-500">对方情绪: {peerEmotion}</span>
+                )}
                 <div className="flex items-center space-x-2">
                   {isWebSocketConnected ? (
                     <Wifi className="w-4 h-4 text-green-500" />
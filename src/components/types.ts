@@ -10,6 +10,7 @@ export interface WebSocketMessage {
 export interface JoinRoomMessage extends WebSocketMessage {
   type: 'join-room';
   room_id: string;
+  capacity?: number; // 仅创建房间时生效，默认 2 人
 }
 
 // 房间加入成功响应
@@ -18,6 +19,7 @@ export interface RoomJoinedMessage extends WebSocketMessage {
   success: boolean;
   room_id: string;
   user_count: number;
+  capacity?: number;
   other_users: string[];
   is_room_full: boolean;
   message?: string;
@@ -27,6 +29,7 @@ export interface RoomJoinedMessage extends WebSocketMessage {
 export interface OfferMessage extends WebSocketMessage {
   type: 'offer';
   from?: string;
+  to?: string; // 多人房间必须指定接收方
   offer: RTCSessionDescriptionInit;
 }
 
@@ -34,6 +37,7 @@ export interface OfferMessage extends WebSocketMessage {
 export interface AnswerMessage extends WebSocketMessage {
   type: 'answer';
   from?: string;
+  to?: string; // 多人房间必须指定接收方
   answer: RTCSessionDescriptionInit;
 }
 
@@ -41,6 +45,7 @@ export interface AnswerMessage extends WebSocketMessage {
 export interface IceCandidateMessage extends WebSocketMessage {
   type: 'ice-candidate';
   from?: string;
+  to?: string; // 多人房间必须指定接收方
   candidate: RTCIceCandidateInit;
 }
 
@@ -48,6 +53,7 @@ export interface IceCandidateMessage extends WebSocketMessage {
 export interface UserJoinedMessage extends WebSocketMessage {
   type: 'user-joined';
   user_id: string;
+  user_count?: number;
   message: string;
 }
 
@@ -75,6 +81,36 @@ export interface LeaveRoomMessage extends WebSocketMessage {
   type: 'leave-room';
 }
 
+// 心跳消息（服务器 ping，客户端回 pong）
+export interface HeartbeatMessage extends WebSocketMessage {
+  type: 'ping' | 'pong';
+  ts?: number;
+}
+
+// 服务器重启通知（客户端按 reconnect_after_ms 延迟重连）
+export interface ServerRestartMessage extends WebSocketMessage {
+  type: 'server-restart';
+  reconnect_after_ms: number;
+  message?: string;
+}
+
+// 消息超出服务器预算被丢弃
+export interface RateLimitedMessage extends WebSocketMessage {
+  type: 'rate-limited';
+  scope: 'user' | 'room';
+  message: string;
+}
+
+// 房间内其他成员的情绪识别结果（由情绪服务经信令服务器推送）
+export interface EmotionUpdateMessage extends WebSocketMessage {
+  type: 'emotion-update';
+  user_id: string;
+  final_emotion: string;
+  text_emotion?: { label: string; confidence: number } | null;
+  image_emotion?: { label: string; confidence: number } | null;
+  ts: number;
+}
+
 // 联合类型：所有可能的 WebSocket 消息
 export type AnyWebSocketMessage =
   | JoinRoomMessage
@@ -86,7 +122,11 @@ export type AnyWebSocketMessage =
   | UserLeftMessage
   | ErrorMessage
   | RoomResetMessage
-  | LeaveRoomMessage;
+  | LeaveRoomMessage
+  | HeartbeatMessage
+  | ServerRestartMessage
+  | RateLimitedMessage
+  | EmotionUpdateMessage;
 
 // WebRTC 连接状态
 export type ConnectionStatus =
@@ -1,21 +1,26 @@
 // utils/emotionFusionClient.ts
 
+const EMOTION_API_URL = "https://emotion-api-218860421161.us-central1.run.app";
+
 export async function fuseEmotionFromImageAndText(
   imageFile: File,
-  text: string
+  text: string,
+  userId?: string // 通话中传入，结果会推送给房间里的其他人
 ): Promise<{
   final_emotion: string;
   text_emotion: string;
   image_emotion: string;
   final_confidence: number;
+  next_interval_ms?: number; // 服务器建议的下一帧上传间隔（毫秒），情绪稳定或服务器繁忙时变长
 }> {
   const formData = new FormData();
   formData.append("image", imageFile);
   formData.append("text", text);
+  if (userId) formData.append("user_id", userId);
 
   try {
     const res = await fetch(
-      "https://emotion-api-218860421161.us-central1.run.app/fuse-emotion",
+      `${EMOTION_API_URL}/fuse-emotion`,
       {
         method: "POST",
         body: formData,
@@ -30,3 +35,24 @@ export async function fuseEmotionFromImageAndText(
     throw err;
   }
 }
+
+// 服务器按会话（session_id，默认 user_id）保存的情绪时间线摘要，window 为最近多少秒，不传则为全部
+export interface EmotionTimelineSummary {
+  samples: number;
+  dominant: string | null;
+  histogram: Record<string, number>;
+  transitions: number;
+  since: number | null;
+  until: number | null;
+}
+
+export async function fetchEmotionTimeline(
+  sessionId: string,
+  windowSeconds?: number
+): Promise<EmotionTimelineSummary | null> {
+  const query = windowSeconds ? `?window=${windowSeconds}` : "";
+  const res = await fetch(`${EMOTION_API_URL}/timeline/${encodeURIComponent(sessionId)}${query}`);
+  if (res.status === 404) return null;
+  if (!res.ok) throw new Error("Emotion API 请求失败");
+  return res.json();
+}